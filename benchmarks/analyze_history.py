@@ -0,0 +1,367 @@
+"""离线分析插件数据目录里的状态时间线和工具调用轨迹，了解模型实际怎么使用状态工具。
+
+数据来源：
+-   `state_timeline.bin`：每次状态写入的定长样本（见 `StateTimeline`），用来统计物理状态的转移矩阵
+    （区分工具提交和自然流转里的自动回退）以及每个状态的停留时长分布；
+-   `traces/trace-*.jsonl`：`/state_capture` 录下的工具调用，带结果分类，用来统计各工具的成功 / 拒绝原因、
+    被状态机拒绝的转移，以及冷却拒绝的比例和剩余等待时间；
+-   `global_state.json`：当前状态快照，只取几个关键字段附在报告里。
+
+两类文件都以生成器分块 / 逐行读取，内存占用与文件大小无关；安装 numpy 时每块记录直接按结构化 dtype 解析，
+转移计数和停留时长用数组运算完成，未安装时逐条计算，结果相同。
+时间线里第一段状态的开始时间不可知（更早的样本已被环形缓冲区覆盖或不在时间窗口内），最后一段尚未结束，
+两者都不计入停留时长分布，最后一段单独列为 `open_run_min`。
+
+用法：
+    python benchmarks/analyze_history.py /path/to/plugin_data
+    python benchmarks/analyze_history.py /path/to/plugin_data --hours 168 --format csv --output report/
+    python benchmarks/analyze_history.py /path/to/plugin_data --timeline /path/to/plugin_data/personas/alice/state_timeline.bin
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from astrbot_stub import load_plugin_module
+
+main = load_plugin_module()
+np = main.np
+StateTimeline = main.StateTimeline
+DEFAULT_STATE_NAMES = list(main.CharacterState.STATE_MACHINE)
+TOOL_KINDS = ("apply_state_transition", "update_body_sheet")
+
+
+def iter_timeline_chunks(path: Path, chunk_records: int) -> Iterator[bytes]:
+    """按时间顺序分块读出环形缓冲区里的原始记录字节，每块最多 chunk_records 条。"""
+    with path.open("rb") as timeline_file:
+        header = timeline_file.read(StateTimeline.HEADER_SIZE)
+        if len(header) < StateTimeline.HEADER_SIZE:
+            return
+        magic, version, capacity, total_count = StateTimeline.HEADER.unpack_from(header, 0)
+        if magic != StateTimeline.MAGIC or version != StateTimeline.VERSION:
+            raise SystemExit(f"not a state timeline file: {path}")
+        logical_index = total_count - min(total_count, capacity)
+        while logical_index < total_count:
+            slot = logical_index % capacity
+            count = min(total_count - logical_index, chunk_records, capacity - slot)
+            timeline_file.seek(StateTimeline.HEADER_SIZE + slot * StateTimeline.RECORD.size)
+            yield timeline_file.read(count * StateTimeline.RECORD.size)
+            logical_index += count
+
+
+def iter_timeline_columns(chunks: Iterable[bytes], start_ts: float, end_ts: float) -> Iterator[Dict[str, Any]]:
+    """把原始字节块解码成列（t / state / source），并裁掉时间窗口外的样本。"""
+    for chunk in chunks:
+        if np is not None:
+            records = np.frombuffer(chunk, dtype=StateTimeline.numpy_dtype())
+            records = records[(records["t"] >= start_ts) & (records["t"] <= end_ts)]
+            columns = {"t": records["t"], "state": records["state"], "source": records["source"]}
+        else:
+            rows = [row for row in StateTimeline.RECORD.iter_unpack(chunk) if start_ts <= row[0] <= end_ts]
+            columns = {"t": [row[0] for row in rows], "state": [row[3] for row in rows], "source": [row[5] for row in rows]}
+        if len(columns["t"]):
+            yield columns
+
+
+def iter_tool_calls(trace_paths: Iterable[Path], start_ts: float, end_ts: float) -> Iterator[Dict[str, Any]]:
+    """逐行读取轨迹文件，只产出时间窗口内的工具调用记录。"""
+    for trace_path in trace_paths:
+        with trace_path.open("r", encoding="utf-8") as trace_file:
+            for line in trace_file:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if record.get("kind") in TOOL_KINDS and start_ts <= float(record.get("t", 0.0)) <= end_ts:
+                    yield record
+
+
+def _percentiles(values: List[float], quantiles=(0.5, 0.9)) -> List[float]:
+    if not values:
+        return [0.0 for _ in quantiles]
+    if np is not None:
+        return [float(value) for value in np.quantile(np.asarray(values, dtype=np.float64), quantiles)]
+    # 与 np.quantile 默认的线性插值保持一致。
+    ordered = sorted(values)
+    results = []
+    for quantile in quantiles:
+        position = quantile * (len(ordered) - 1)
+        lower = int(position)
+        upper = min(lower + 1, len(ordered) - 1)
+        results.append(ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower))
+    return results
+
+
+def load_state_names(timeline_path: Path) -> List[str]:
+    """角色可以自定义状态机，时间线的标签文件里记着写入时用的状态名；没有时按默认状态机解码。"""
+    try:
+        labels = json.loads(timeline_path.with_suffix(".labels.json").read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return DEFAULT_STATE_NAMES
+    states = labels.get("states") if isinstance(labels, dict) else None
+    return [str(state_name) for state_name in states] if isinstance(states, list) and states else DEFAULT_STATE_NAMES
+
+
+class TimelineStats:
+    """增量累积转移计数和停留时长；块与块之间只携带上一条样本的状态和当前这一段的开始时间。"""
+
+    def __init__(self, state_names: Optional[List[str]] = None):
+        self.state_names = list(state_names or DEFAULT_STATE_NAMES)
+        self.samples = 0
+        # 状态按 1 字节编码，矩阵按编码上限分配，标签文件缺失或过期时也不会越界。
+        self.transitions = (
+            np.zeros((len(StateTimeline.SOURCE_NAMES), 256, 256), dtype=np.int64)
+            if np is not None else Counter()
+        )
+        self.dwell_sec: Dict[int, List[float]] = {}
+        self.last_state: Optional[int] = None
+        self.last_t = 0.0
+        # None 表示这一段的开始时间不可知（时间线里的第一段），不计入停留时长分布。
+        self.run_start: Optional[float] = None
+
+    def _close_run(self, state: int, end_t: float) -> None:
+        if self.run_start is not None:
+            self.dwell_sec.setdefault(state, []).append(end_t - self.run_start)
+        self.run_start = end_t
+
+    def consume(self, columns: Dict[str, Any]) -> None:
+        self.samples += len(columns["t"])
+        if np is not None:
+            self._consume_numpy(columns)
+            return
+        for t, state, source in zip(columns["t"], columns["state"], columns["source"]):
+            if self.last_state is not None and state != self.last_state:
+                self.transitions[(source, self.last_state, state)] += 1
+                self._close_run(self.last_state, t)
+            self.last_state = state
+            self.last_t = t
+
+    def _consume_numpy(self, columns: Dict[str, Any]) -> None:
+        times, states, sources = columns["t"], columns["state"].astype(np.int64), columns["source"].astype(np.int64)
+        previous_states = np.r_[self.last_state if self.last_state is not None else states[0], states[:-1]]
+        change_indices = np.flatnonzero(states != previous_states)
+        np.add.at(
+            self.transitions,
+            (np.minimum(sources[change_indices], len(StateTimeline.SOURCE_NAMES) - 1),
+             previous_states[change_indices], states[change_indices]),
+            1,
+        )
+        if len(change_indices):
+            change_times = times[change_indices]
+            ended_states = previous_states[change_indices]
+            if self.run_start is not None:
+                durations = np.diff(np.r_[self.run_start, change_times])
+                run_states = ended_states
+            else:
+                durations = np.diff(change_times)
+                run_states = ended_states[1:]
+            for state in np.unique(run_states):
+                self.dwell_sec.setdefault(int(state), []).extend(durations[run_states == state].tolist())
+            self.run_start = float(change_times[-1])
+        self.last_state = int(states[-1])
+        self.last_t = float(times[-1])
+
+    def _state_name(self, index: int) -> str:
+        return self.state_names[index] if 0 <= index < len(self.state_names) else "other"
+
+    def _transition_counts(self) -> Iterator[tuple]:
+        if np is not None:
+            for source, from_index, to_index in zip(*np.nonzero(self.transitions)):
+                yield int(source), int(from_index), int(to_index), int(self.transitions[source, from_index, to_index])
+        else:
+            for (source, from_index, to_index), count in self.transitions.items():
+                yield source, from_index, to_index, count
+
+    def report(self) -> Dict[str, Any]:
+        transitions = sorted(
+            (
+                {
+                    "from": self._state_name(from_index),
+                    "to": self._state_name(to_index),
+                    # 工具提交产生的转移是模型主动切换，自然流转里的转移是超时后的自动回退。
+                    "source": "tool" if source == StateTimeline.SOURCE_COMMIT else "auto_fallback",
+                    "count": count,
+                }
+                for source, from_index, to_index, count in self._transition_counts()
+            ),
+            key=lambda row: (-row["count"], row["from"], row["to"], row["source"]),
+        )
+        dwell = []
+        for state_index in sorted(self.dwell_sec):
+            durations_min = [duration / 60 for duration in self.dwell_sec[state_index]]
+            p50, p90 = _percentiles(durations_min)
+            dwell.append({
+                "state": self._state_name(state_index),
+                "runs": len(durations_min),
+                "mean_min": round(sum(durations_min) / len(durations_min), 1),
+                "p50_min": round(p50, 1),
+                "p90_min": round(p90, 1),
+                "max_min": round(max(durations_min), 1),
+            })
+        return {
+            "samples": self.samples,
+            "transitions": transitions,
+            "dwell": dwell,
+            "open_run": {
+                "state": self._state_name(self.last_state) if self.last_state is not None else None,
+                "open_run_min": round((self.last_t - self.run_start) / 60, 1) if self.run_start is not None else None,
+            },
+        }
+
+
+class ToolCallStats:
+    def __init__(self):
+        self.outcomes: Counter = Counter()
+        self.rejected_transitions: Counter = Counter()
+        self.cooldown_wait_sec: Dict[str, List[float]] = {}
+        self.calls: Counter = Counter()
+
+    def consume(self, record: Dict[str, Any]) -> None:
+        tool_name = record["kind"]
+        outcome = record.get("outcome") or {}
+        # 旧版本录下的轨迹没有结果分类，单独计为 unknown。
+        status = outcome.get("status", "unknown")
+        reason = outcome.get("reason", "")
+        self.calls[tool_name] += 1
+        self.outcomes[(tool_name, status, reason)] += 1
+        if reason == "transition_not_allowed":
+            requested_state = (record.get("args") or {}).get("physical_state")
+            self.rejected_transitions[(outcome.get("from_state", "unknown"), str(requested_state))] += 1
+        if "cooldown_wait_sec" in outcome:
+            self.cooldown_wait_sec.setdefault(reason, []).append(float(outcome["cooldown_wait_sec"]))
+
+    def report(self) -> Dict[str, Any]:
+        cooldown = []
+        for reason, waits in sorted(self.cooldown_wait_sec.items()):
+            tool_name = "update_body_sheet" if reason == "cooldown_body_sheet" else "apply_state_transition"
+            p50, p90 = _percentiles(waits)
+            cooldown.append({
+                "reason": reason,
+                "rejects": len(waits),
+                "share_of_calls": round(len(waits) / max(1, self.calls[tool_name]), 4),
+                "wait_p50_sec": round(p50, 1),
+                "wait_p90_sec": round(p90, 1),
+            })
+        return {
+            "tool_calls": [
+                {"tool": tool_name, "status": status, "reason": reason, "count": count,
+                 "share": round(count / max(1, self.calls[tool_name]), 4)}
+                for (tool_name, status, reason), count in self.outcomes.most_common()
+            ],
+            "rejected_transitions": [
+                {"from": from_state, "to": to_state, "count": count}
+                for (from_state, to_state), count in self.rejected_transitions.most_common()
+            ],
+            "cooldown": cooldown,
+        }
+
+
+def load_current_state(data_dir: Path) -> Dict[str, Any]:
+    state_path = data_dir / "global_state.json"
+    try:
+        state = json.loads(state_path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return {}
+    return {key: state.get(key) for key in ("physical_state", "emotion", "energy_level", "thirst", "updated_at", "History")}
+
+
+def analyze(args) -> Dict[str, Any]:
+    end_ts = time.time() if args.until is None else args.until
+    start_ts = end_ts - args.hours * 3600 if args.hours else 0.0
+
+    timeline_path = args.timeline or args.data_dir / "state_timeline.bin"
+    timeline_stats = TimelineStats(load_state_names(timeline_path))
+    if timeline_path.exists():
+        for columns in iter_timeline_columns(iter_timeline_chunks(timeline_path, args.chunk_records), start_ts, end_ts):
+            timeline_stats.consume(columns)
+
+    tool_stats = ToolCallStats()
+    trace_paths = sorted((args.data_dir / "traces").glob("trace-*.jsonl")) + list(args.trace)
+    for record in iter_tool_calls(trace_paths, start_ts, end_ts):
+        tool_stats.consume(record)
+
+    return {
+        "window": {"start_ts": start_ts, "end_ts": end_ts},
+        "sources": {
+            "timeline": str(timeline_path) if timeline_path.exists() else None,
+            "traces": [str(trace_path) for trace_path in trace_paths],
+        },
+        "current_state": load_current_state(args.data_dir),
+        "timeline": timeline_stats.report(),
+        **tool_stats.report(),
+    }
+
+
+CSV_TABLES = {
+    "transitions": lambda report: report["timeline"]["transitions"],
+    "dwell": lambda report: report["timeline"]["dwell"],
+    "tool_calls": lambda report: report["tool_calls"],
+    "rejected_transitions": lambda report: report["rejected_transitions"],
+    "cooldown": lambda report: report["cooldown"],
+}
+
+
+def _write_csv(rows: List[Dict[str, Any]], stream) -> None:
+    if not rows:
+        return
+    writer = csv.DictWriter(stream, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+
+
+def write_report(report: Dict[str, Any], output_format: str, output: Optional[Path]) -> None:
+    if output_format == "json":
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if output:
+            output.write_text(text + "\n", encoding="utf-8")
+        else:
+            print(text)
+        return
+
+    # CSV：每张表一个文件；没有指定输出目录时依次打印到标准输出，表之间用 `# 表名` 分隔。
+    if output:
+        output.mkdir(parents=True, exist_ok=True)
+    for table_name, select_rows in CSV_TABLES.items():
+        rows = select_rows(report)
+        if output:
+            with (output / f"{table_name}.csv").open("w", encoding="utf-8", newline="") as csv_file:
+                _write_csv(rows, csv_file)
+        else:
+            buffer = io.StringIO()
+            _write_csv(rows, buffer)
+            print(f"# {table_name}")
+            print(buffer.getvalue().rstrip("\n"))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("data_dir", type=Path, help="插件数据目录（包含 state_timeline.bin、traces/、global_state.json）")
+    parser.add_argument(
+        "--timeline",
+        type=Path,
+        default=None,
+        help="改为分析指定的时间线文件，例如 personas/<id>/state_timeline.bin 或分片旁边的 .timeline.bin",
+    )
+    parser.add_argument("--trace", type=Path, action="append", default=[], help="额外的轨迹文件，可重复指定")
+    parser.add_argument("--hours", type=float, default=0, help="只分析最近多少小时，默认 0 表示全部")
+    parser.add_argument("--until", type=float, default=None, help="时间窗口的结束时间戳，默认当前时间")
+    parser.add_argument("--format", choices=("json", "csv"), default="json")
+    parser.add_argument("--output", type=Path, default=None, help="json 时为输出文件，csv 时为输出目录；默认写到标准输出")
+    parser.add_argument("--chunk-records", type=int, default=65536, help="每次从时间线读取的记录数")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if not arguments.data_dir.is_dir():
+        print(f"data dir not found: {arguments.data_dir}", file=sys.stderr)
+        sys.exit(2)
+    write_report(analyze(arguments), arguments.format, arguments.output)
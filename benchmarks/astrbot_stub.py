@@ -0,0 +1,215 @@
+"""在没有 AstrBot 运行时的环境里加载插件，供本目录下的基准脚本使用。
+
+`install()` 往 `sys.modules` 里塞一组最小的 `astrbot.*` 替身模块，只覆盖 main.py 实际用到的名字；
+`load_plugin_module()` 在此基础上导入仓库根目录的 main.py。数据目录指向一个临时目录，
+不会碰到真实的 `global_state.json`。
+
+这里同时提供基准/压测共用的假 Provider、假会话管理器和假事件，
+Provider 的延迟可配置，用来模拟真实模型调用的等待时间。
+"""
+import asyncio
+import importlib
+import json
+import logging
+import sys
+import tempfile
+import types
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+
+_installed_data_dir: Optional[Path] = None
+
+
+def install(data_dir: Optional[Path] = None) -> Path:
+    """注册 astrbot 替身模块，返回插件使用的数据目录。重复调用是幂等的。"""
+    global _installed_data_dir
+    if _installed_data_dir is not None:
+        return _installed_data_dir
+
+    resolved_data_dir = Path(data_dir) if data_dir else Path(tempfile.mkdtemp(prefix="livelystate_bench_"))
+    resolved_data_dir.mkdir(parents=True, exist_ok=True)
+
+    def _module(name: str) -> types.ModuleType:
+        module = types.ModuleType(name)
+        sys.modules[name] = module
+        return module
+
+    for name in [
+        "astrbot",
+        "astrbot.api",
+        "astrbot.api.event",
+        "astrbot.api.star",
+        "astrbot.api.provider",
+        "astrbot.core",
+        "astrbot.core.agent",
+        "astrbot.core.agent.run_context",
+        "astrbot.core.agent.tool",
+        "astrbot.core.astr_agent_context",
+    ]:
+        _module(name)
+
+    def _passthrough(*args, **kwargs):
+        return lambda handler: handler
+
+    class _Filter:
+        llm_tool = staticmethod(_passthrough)
+        command = staticmethod(_passthrough)
+        on_llm_request = staticmethod(_passthrough)
+        permission_type = staticmethod(_passthrough)
+
+        class PermissionType:
+            ADMIN = "admin"
+            MEMBER = "member"
+
+    class MessageChain:
+        def __init__(self):
+            self.text = ""
+
+        def message(self, text: str) -> "MessageChain":
+            self.text += text
+            return self
+
+    class Star:
+        def __init__(self, context: Any):
+            self.context = context
+
+    class StarTools:
+        @staticmethod
+        def get_data_dir() -> Path:
+            return resolved_data_dir
+
+    api = sys.modules["astrbot.api"]
+    api.logger = logging.getLogger("astrbot")
+    api.AstrBotConfig = dict
+
+    event_module = sys.modules["astrbot.api.event"]
+    event_module.filter = _Filter()
+    event_module.AstrMessageEvent = object
+    event_module.MessageEventResult = object
+    event_module.MessageChain = MessageChain
+
+    star_module = sys.modules["astrbot.api.star"]
+    star_module.Star = Star
+    star_module.Context = object
+    star_module.StarTools = StarTools
+    star_module.register = _passthrough
+
+    sys.modules["astrbot.api.provider"].ProviderRequest = object
+    sys.modules["astrbot.core.agent.run_context"].ContextWrapper = object
+    sys.modules["astrbot.core.agent.tool"].FunctionTool = object
+    sys.modules["astrbot.core.agent.tool"].ToolExecResult = object
+    sys.modules["astrbot.core.astr_agent_context"].AstrAgentContext = object
+
+    _installed_data_dir = resolved_data_dir
+    return resolved_data_dir
+
+
+def load_plugin_module(data_dir: Optional[Path] = None, plugin_dir: Optional[Path] = None):
+    """安装替身模块后导入插件的 main.py，默认取仓库根目录，也可以指定另一份插件检出目录。"""
+    install(data_dir)
+    resolved_plugin_dir = str(Path(plugin_dir).resolve() if plugin_dir else REPO_ROOT)
+    if resolved_plugin_dir not in sys.path:
+        sys.path.insert(0, resolved_plugin_dir)
+    return importlib.import_module("main")
+
+
+class FakeLLMResponse:
+    def __init__(self, completion_text: str):
+        self.completion_text = completion_text
+
+
+class FakeProvider:
+    """按固定延迟返回合法总结 JSON 的假 Provider，并记录每次调用的输入大小。"""
+
+    def __init__(self, latency_sec: float = 0.0):
+        self.latency_sec = latency_sec
+        self.call_count = 0
+        self.prompt_chars = 0
+
+    async def text_chat(self, prompt: str = "", system_prompt: str = "", **kwargs) -> FakeLLMResponse:
+        self.call_count += 1
+        self.prompt_chars += len(prompt or "") + len(system_prompt or "")
+        if self.latency_sec > 0:
+            await asyncio.sleep(self.latency_sec)
+        return FakeLLMResponse(json.dumps({
+            "summary": f"第 {self.call_count} 次总结",
+            "events": [{"subject_id": "global", "summary": f"事件 {self.call_count}"}],
+        }, ensure_ascii=False))
+
+
+class FakeConversation:
+    def __init__(self, persona_id: Optional[str] = None):
+        self.history = "[]"
+        self.persona_id = persona_id
+
+
+class FakeConversationManager:
+    """每个 unified_msg_origin 一份会话历史，只实现 add_state 用到的两个方法。"""
+
+    def __init__(self, latency_sec: float = 0.0):
+        self.latency_sec = latency_sec
+        self.conversations: Dict[str, FakeConversation] = {}
+
+    async def get_curr_conversation_id(self, uid: str) -> str:
+        if self.latency_sec > 0:
+            await asyncio.sleep(self.latency_sec)
+        return uid
+
+    async def get_conversation(self, uid: str, cid: str) -> FakeConversation:
+        if self.latency_sec > 0:
+            await asyncio.sleep(self.latency_sec)
+        return self.conversations.setdefault(cid, FakeConversation())
+
+    def record_turn(self, uid: str, user_text: str, assistant_text: str) -> None:
+        conversation = self.conversations.setdefault(uid, FakeConversation())
+        history: List[Dict[str, Any]] = json.loads(conversation.history)
+        history.append({"role": "user", "content": [{"type": "text", "text": user_text}]})
+        history.append({"role": "assistant", "content": [{"type": "text", "text": assistant_text}]})
+        conversation.history = json.dumps(history[-20:], ensure_ascii=False)
+
+
+class FakeContext:
+    def __init__(
+        self,
+        provider: Optional[FakeProvider] = None,
+        conversation_manager: Optional[FakeConversationManager] = None,
+        providers_by_id: Optional[Dict[str, FakeProvider]] = None,
+    ):
+        self.provider = provider or FakeProvider()
+        self.conversation_manager = conversation_manager or FakeConversationManager()
+        self.providers_by_id = providers_by_id or {}
+        self.sent_messages: List[Any] = []
+
+    def get_using_provider(self) -> FakeProvider:
+        return self.provider
+
+    def get_provider_by_id(self, provider_id: str) -> Optional[FakeProvider]:
+        return self.providers_by_id.get(provider_id)
+
+    async def send_message(self, uid: str, message_chain: Any) -> None:
+        self.sent_messages.append((uid, message_chain))
+
+
+class FakeEvent:
+    def __init__(self, unified_msg_origin: str, message_str: str = "", sender_name: str = "user"):
+        self.unified_msg_origin = unified_msg_origin
+        self.message_str = message_str
+        self._sender_name = sender_name
+        self.stopped = False
+
+    def get_sender_name(self) -> str:
+        return self._sender_name
+
+    def get_sender_id(self) -> str:
+        return self._sender_name
+
+    def stop_event(self) -> None:
+        self.stopped = True
+
+
+class FakeProviderRequest:
+    def __init__(self, prompt: str = "", system_prompt: str = ""):
+        self.prompt = prompt
+        self.system_prompt = system_prompt
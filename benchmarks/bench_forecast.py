@@ -0,0 +1,97 @@
+"""对比 StateForecaster 批量预测与逐步调用 CharacterState.update 的朴素循环。
+
+朴素做法模拟线上真实的读取节奏：对每个候选状态从现在开始，每隔 --read-every-min 分钟读一次状态
+（update 的结果作为下一次读取的输入），在每个预测时间点记录读到的值，结果作为正确性基准。
+这样持续状态中途超时回退、之后按回退状态的增量继续推进的过程都会被覆盖，而不只是一次 update 的跳跃。
+StateForecaster 一次性算出整张 (候选状态 x 时间点) 表。脚本先校验两者的 energy / thirst /
+physical_state 完全一致，再报告各自的耗时。
+
+用法：
+    python benchmarks/bench_forecast.py --horizons 96 --repeat 20
+"""
+import argparse
+import copy
+import time
+
+from astrbot_stub import load_plugin_module
+
+main = load_plugin_module()
+
+
+def naive_forecast(character_state, state, horizons_sec, candidate_states, now, read_every_sec):
+    current = character_state.update(now, state=copy.deepcopy(state))
+    rows = [(state, state["physical_state"])]
+    for candidate in candidate_states:
+        candidate_state = copy.deepcopy(current)
+        candidate_state["physical_state"] = candidate
+        candidate_state["LastUpdateTime"] = now
+        candidate_state["_physical_state_since"] = now
+        rows.append((candidate_state, candidate))
+
+    energy, thirst, physical = [], [], []
+    for row_state, _ in rows:
+        energy_row, thirst_row, physical_row = [], [], []
+        projected = copy.deepcopy(row_state)
+        read_time = now
+        for horizon in horizons_sec:
+            # 两个预测时间点之间按固定节奏读取，每次读取都以上一次的结果为起点。
+            while read_time + read_every_sec < now + horizon:
+                read_time += read_every_sec
+                projected = character_state.update(read_time, state=projected)
+            read_time = now + horizon
+            projected = character_state.update(read_time, state=projected)
+            energy_row.append(projected["energy_level"])
+            thirst_row.append(projected["thirst"])
+            physical_row.append(projected["physical_state"])
+        energy.append(energy_row)
+        thirst.append(thirst_row)
+        physical.append(physical_row)
+    return {"energy": energy, "thirst": thirst, "physical_state": physical}
+
+
+def _time(func, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--horizons", type=int, default=96, help="预测多少个时间点，间隔为 --horizon-step-min 分钟")
+    parser.add_argument("--horizon-step-min", type=int, default=15)
+    parser.add_argument("--read-every-min", type=float, default=7, help="基准轨迹里两次读取状态的间隔（分钟）")
+    parser.add_argument("--repeat", type=int, default=20)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    character_state = main.CharacterState(clock=main.VirtualClock(start=1_000_000.0), persist=False)
+    now = character_state.clock.now()
+    state = character_state.default_state()
+    state.update({
+        "physical_state": "Exercising", "energy_level": 80, "thirst": 20,
+        "LastUpdateTime": now - 120, "_physical_state_since": now - 600,
+    })
+    candidate_states = list(character_state.STATE_MACHINE)
+    horizons_sec = [step * args.horizon_step_min * 60 for step in range(1, args.horizons + 1)]
+    forecaster = main.StateForecaster(character_state)
+
+    vectorized = forecaster.forecast(state, horizons_sec, candidate_states, now=now)
+    read_every_sec = args.read_every_min * 60
+    baseline = naive_forecast(character_state, state, horizons_sec, candidate_states, now, read_every_sec)
+    for key in ("energy", "thirst", "physical_state"):
+        assert vectorized[key] == baseline[key], f"{key} mismatch between forecaster and repeated CharacterState.update reads"
+
+    cells = len(vectorized["states"]) * len(horizons_sec)
+    forecaster_ms = _time(lambda: forecaster.forecast(state, horizons_sec, candidate_states, now=now), args.repeat)
+    naive_ms = _time(
+        lambda: naive_forecast(character_state, state, horizons_sec, candidate_states, now, read_every_sec),
+        max(1, args.repeat // 5),
+    )
+    print(f"numpy={'yes' if main.np is not None else 'no'} rows={len(vectorized['states'])} horizons={len(horizons_sec)} cells={cells}")
+    print(f"{'method':<14}{'ms_per_call':>12}{'us_per_cell':>13}")
+    print(f"{'forecaster':<14}{forecaster_ms:>12.3f}{forecaster_ms * 1000 / cells:>13.3f}")
+    print(f"{'naive_update':<14}{naive_ms:>12.3f}{naive_ms * 1000 / cells:>13.3f}")
+    print(f"speedup={naive_ms / forecaster_ms:.1f}x")
@@ -0,0 +1,281 @@
+"""每次请求都会经过的状态引擎与 prompt 构建函数的微基准。
+
+覆盖 `CharacterState.get_whole_state` / `update` / `_normalize_state` / `resolve_physical_state`、
+`LivelyState._handle_apply`（真实形态的工具参数）、`_build_global_state_system_prompt` 与
+`_build_recent_context_prompt`，分别在小 / 大两档 Body_Sheet、History 规模下测量单次调用耗时。
+
+结果可以保存为基线 JSON，之后的运行与基线比较。比较的是相对耗时：每轮用例前紧挨着跑一段固定的参考工作量，
+用例耗时除以参考耗时，抵消机器忽快忽慢；任一用例的相对耗时超过基线的 `--threshold` 倍即视为退化，
+脚本以非零状态码退出，方便接到 CI 或改动前后的手动对比里。基线和机器、Python 版本相关，换环境后需要重新保存。
+
+用法：
+    python benchmarks/bench_hot_path.py
+    python benchmarks/bench_hot_path.py --save-baseline
+    python benchmarks/bench_hot_path.py --compare --threshold 1.3
+"""
+import argparse
+import asyncio
+import copy
+import gc
+import json
+import statistics
+import sys
+import time
+from pathlib import Path
+
+from astrbot_stub import FakeContext, FakeEvent, load_plugin_module
+
+main = load_plugin_module()
+
+DEFAULT_BASELINE_PATH = Path(__file__).with_name("baselines") / "bench_hot_path.json"
+
+SIZES = {
+    # 小档接近刚装好插件时的模板；大档模拟长期运行后 Body_Sheet / History 都被写满的角色。
+    "small": {"body_parts": 3, "attributes_per_part": 3, "history_keys": 5, "observer_messages": 10},
+    "large": {"body_parts": 40, "attributes_per_part": 10, "history_keys": 200, "observer_messages": 200},
+}
+
+
+def _build_state(plugin, size: dict) -> dict:
+    state = plugin.global_state.default_state()
+    state["Body_Sheet"] = {
+        f"部位_{part_index}": {
+            f"属性_{attribute_index}": f"部位 {part_index} 的第 {attribute_index} 项长期描述，保持稳定不轻易改写"
+            for attribute_index in range(size["attributes_per_part"])
+        }
+        for part_index in range(size["body_parts"])
+    }
+    state["History"] = {f"Counter_{key_index}": key_index for key_index in range(size["history_keys"])}
+    state["physical_state"] = "Exercising"
+    state["location"] = "公园跑道"
+    state["post_event_markers"] = ["刚出门", "带了水壶"]
+    state["last_event"] = {"type": "go_out", "subject_id": "bench_user", "note": "出门跑步"}
+    state["pending_tasks"] = ["回家后洗澡"]
+    return state
+
+
+def _tool_payloads(size: dict) -> list:
+    """轮流使用的三种真实形态的工具参数：快状态、上下文锚点 + History 增量、Body_Sheet 补录。"""
+    return [
+        {
+            "physical_state": "Resting",
+            "context_subject_id": "global",
+            "location": "sofa",
+            "energy_level": 42,
+            "update_reason": "外出回来后开始休息",
+        },
+        {
+            "context_subject_id": "bench_user",
+            "post_event_markers": json.dumps(["刚到家", "外套还没收"], ensure_ascii=False),
+            "last_event": json.dumps({"type": "return_home", "subject_id": "bench_user", "note": "刚结束外出"}, ensure_ascii=False),
+            "pending_tasks": json.dumps(["稍后整理包"], ensure_ascii=False),
+            "history_delta": json.dumps({"Counter_0": 1}),
+            "update_reason": "补录最近事件与待办",
+        },
+        {
+            "body_sheet_updates": json.dumps(
+                {f"部位_{size['body_parts'] - 1}": {"新属性": "刚补录的持久性变化"}},
+                ensure_ascii=False,
+            ),
+            "update_reason": "补录长期身体事实",
+        },
+    ]
+
+
+def _round_number(func, number: int, min_round_sec: float) -> int:
+    """和 timeit 一样把每轮调用次数放大到至少 min_round_sec；几微秒的用例跑 200 次只有一两毫秒，噪声太大。"""
+    started = time.perf_counter()
+    func()
+    single_call_sec = max(time.perf_counter() - started, 1e-7)
+    return max(number, int(min_round_sec / single_call_sec))
+
+
+def _time_round(func, number: int) -> float:
+    started = time.perf_counter()
+    for _ in range(number):
+        func()
+    return (time.perf_counter() - started) / number * 1e6
+
+
+def _prepare_plugin(size: dict):
+    plugin = main.LivelyState(FakeContext(), {
+        "fast_state_cooldown_sec": 0,
+        "body_sheet_cooldown_sec": 0,
+        "hot_path_log_level": "off",
+        "observer_persist": False,
+        "loop_watchdog_enabled": False,
+        "trigger_threshold": size["observer_messages"] + 1,
+        "queue_max_size": size["observer_messages"],
+    })
+    state = _build_state(plugin, size)
+    plugin.global_state.save(state)
+
+    observer = plugin.global_observer
+    observer.current_state = {
+        "summary": "群里气氛轻松，大家在聊周末安排",
+        "events": [
+            {"subject_id": "bench_user", "summary": "约好了周末一起跑步"},
+            {"subject_id": "global", "summary": "刚结束一轮闲聊"},
+        ],
+    }
+    observer._apply_recent_summary(observer.current_state)
+    return plugin, state
+
+
+async def _fill_observer(plugin, size: dict) -> None:
+    context = plugin.context
+    for index in range(size["observer_messages"]):
+        await plugin.global_observer.add_message(
+            f"第 {index} 条：今天聊了很多事情，天气不错适合出门",
+            FakeEvent("bench_user" if index % 3 else f"group_{index % 5}"),
+            context,
+            role=main.ObserverRole.USER,
+            sender_name=f"u{index}",
+        )
+
+
+def _reference_workload() -> None:
+    """固定的纯 Python 工作量，和插件代码无关，只用来衡量这台机器此刻有多快。"""
+    payload = {f"key_{index}": [index, str(index) * 3, {"nested": index % 7}] for index in range(50)}
+    json.loads(json.dumps(payload, sort_keys=True))
+
+
+def _measure(cases: dict, number: int, repeat: int, min_round_sec: float) -> dict:
+    """各用例按轮交错执行，每轮用例前紧挨着跑一次参考工作量。
+
+    这台机器忽快忽慢时，一个用例连跑 repeat 轮很容易整段落在慢的时段里。用例耗时除以紧挨着的参考耗时，
+    得到的相对耗时（relative）基本不受机器速度影响，compare 比较的就是它的中位数。
+    计时期间关掉 GC，避免回收时机落在哪个用例上带来的抖动。
+    """
+    reference_number = _round_number(_reference_workload, number, min_round_sec)
+    numbers = {case_name: _round_number(func, number, min_round_sec) for case_name, func in cases.items()}
+    per_call_us = {case_name: [] for case_name in cases}
+    relative = {case_name: [] for case_name in cases}
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            for case_name, func in cases.items():
+                reference_us = _time_round(_reference_workload, reference_number)
+                case_us = _time_round(func, numbers[case_name])
+                per_call_us[case_name].append(case_us)
+                relative[case_name].append(case_us / reference_us)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return {
+        case_name: {
+            "median_us": round(statistics.median(samples), 2),
+            "min_us": round(min(samples), 2),
+            "relative": round(statistics.median(relative[case_name]), 4),
+        }
+        for case_name, samples in per_call_us.items()
+    }
+
+
+def run_suite(number: int, repeat: int, min_round_sec: float) -> dict:
+    results = {}
+    for size_name, size in SIZES.items():
+        plugin, state = _prepare_plugin(size)
+        asyncio.run(_fill_observer(plugin, size))
+        character_state = plugin.global_state
+        uid = "bench_user"
+        event = FakeEvent(uid)
+        payloads = _tool_payloads(size)
+        payload_cursor = {"index": 0}
+
+        def handle_apply():
+            # _handle_apply 会修改并保存状态，这里轮换参数，保证每次都是一次真实的有效写入。
+            payload = dict(payloads[payload_cursor["index"] % len(payloads)])
+            payload_cursor["index"] += 1
+            if "energy_level" in payload:
+                payload["energy_level"] = 30 + payload_cursor["index"] % 50
+            plugin._handle_apply(event, payload)
+
+        state_info = character_state.get_whole_state()
+        cases = {
+            "get_whole_state": lambda: character_state.get_whole_state(),
+            "update": lambda: character_state.update(time.time() + 3600, state=copy.deepcopy(state)),
+            "_normalize_state": lambda: character_state._normalize_state(state),
+            "resolve_physical_state": lambda: character_state.resolve_physical_state("正在 去跑步 的路上"),
+            "_handle_apply": handle_apply,
+            "_build_global_state_system_prompt": lambda: plugin._build_global_state_system_prompt(uid, state_info),
+            "_build_recent_context_prompt": lambda: plugin._build_recent_context_prompt(uid),
+        }
+        # 两档共用同一个数据目录，各档单独测量，避免交错执行时一档的写入改变另一档读到的状态。
+        for case_name, result in _measure(cases, number, repeat, min_round_sec).items():
+            results[f"{size_name}/{case_name}"] = result
+    return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+    regressions = []
+    for case_name, result in results.items():
+        baseline_relative = (baseline.get(case_name) or {}).get("relative", 0)
+        if baseline_relative <= 0:
+            continue
+        ratio = result["relative"] / baseline_relative
+        result["baseline_us"] = baseline[case_name]["median_us"]
+        result["ratio"] = round(ratio, 2)
+        if ratio > threshold:
+            regressions.append(case_name)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=20, help="每轮最少调用次数")
+    parser.add_argument("--min-round-sec", type=float, default=0.01, help="每轮最短耗时（秒），快的用例自动加大调用次数")
+    parser.add_argument("--repeat", type=int, default=30, help="重复轮数")
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE_PATH)
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果写成基线")
+    parser.add_argument("--compare", action="store_true", help="与基线比较，退化时以状态码 1 退出")
+    parser.add_argument("--threshold", type=float, default=1.3, help="相对耗时超过基线多少倍视为退化")
+    return parser.parse_args()
+
+
+def _main(args) -> int:
+    results = run_suite(args.number, args.repeat, args.min_round_sec)
+
+    regressions = []
+    if args.compare:
+        if not args.baseline.exists():
+            print(f"baseline not found: {args.baseline}", file=sys.stderr)
+            return 2
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))
+        regressions = compare(results, baseline.get("results", {}), args.threshold)
+
+    print(f"{'case':<42}{'median_us':>12}{'min_us':>12}{'baseline_us':>13}{'ratio':>8}")
+    for case_name, result in results.items():
+        flag = "  REGRESSION" if case_name in regressions else ""
+        print(
+            f"{case_name:<42}{result['median_us']:>12.2f}{result['min_us']:>12.2f}"
+            f"{result.get('baseline_us', float('nan')):>13.2f}{result.get('ratio', float('nan')):>8.2f}{flag}"
+        )
+
+    if args.save_baseline:
+        args.baseline.parent.mkdir(parents=True, exist_ok=True)
+        args.baseline.write_text(json.dumps({
+            "python": sys.version.split()[0],
+            "number": args.number,
+            "repeat": args.repeat,
+            "min_round_sec": args.min_round_sec,
+            "results": {
+                case_name: {
+                    "median_us": result["median_us"],
+                    "min_us": result["min_us"],
+                    "relative": result["relative"],
+                }
+                for case_name, result in results.items()
+            },
+        }, ensure_ascii=False, indent=2) + "\n", encoding="utf-8")
+        print(f"baseline saved to {args.baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} case(s) regressed beyond {args.threshold}x", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(parse_args()))
@@ -0,0 +1,118 @@
+"""对比全局观察者单次总结与分块并发总结（map-reduce）的墙钟耗时。
+
+假 Provider 的延迟由“固定延迟 + 每千字符延迟”组成，用来近似真实模型随 prompt 变长而变慢的特性。
+
+用法：
+    python benchmarks/bench_observer_map_reduce.py --messages 400 --latency 0.2 --per-kchar-latency 0.05
+
+最后附带一项正确性检查：总结在途时执行 reset，等模型返回后状态和持久化日志都必须仍是空的。
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from astrbot_stub import FakeContext, FakeEvent, FakeProvider, load_plugin_module
+
+main = load_plugin_module()
+
+
+class SizeAwareProvider(FakeProvider):
+    def __init__(self, latency_sec: float, per_kchar_latency_sec: float):
+        super().__init__(latency_sec)
+        self.per_kchar_latency_sec = per_kchar_latency_sec
+
+    async def text_chat(self, prompt: str = "", system_prompt: str = "", **kwargs):
+        await asyncio.sleep(len(prompt or "") / 1000 * self.per_kchar_latency_sec)
+        return await super().text_chat(prompt=prompt, system_prompt=system_prompt, **kwargs)
+
+
+async def _run_once(args, map_reduce_threshold: int):
+    provider = SizeAwareProvider(args.latency, args.per_kchar_latency)
+    context = FakeContext(provider=provider)
+    observer = main.GlobalObserver(
+        max_size=args.messages,
+        # 阈值设得比消息数大，填充阶段不触发总结，只测量最后那一次。
+        trigger_threshold=args.messages + 1,
+        subject_max_size=args.messages,
+        # 输入是模板化的消息，关掉去重，保证每次都总结完整的 --messages 条。
+        dedupe_window=0,
+        map_reduce_threshold=map_reduce_threshold,
+        map_chunk_size=args.chunk_size,
+        map_chunk_by=args.chunk_by,
+        map_concurrency=args.concurrency,
+        reduce_with_llm=args.reduce_with_llm,
+    )
+    for index in range(args.messages):
+        subject_id = f"group_{index % args.subjects}"
+        await observer.add_message(
+            f"第 {index} 条：" + "今天聊了很多事情，" * args.message_repeat,
+            FakeEvent(subject_id),
+            context,
+            role=main.ObserverRole.USER,
+            sender_name=f"u{index}",
+        )
+
+    started = time.perf_counter()
+    succeeded = await observer._trigger_summarization(FakeEvent("global"), context)
+    elapsed = time.perf_counter() - started
+    return elapsed, provider.call_count, provider.prompt_chars, succeeded
+
+
+async def _check_reset_during_summary(latency_sec: float, background: bool) -> bool:
+    context = FakeContext(provider=FakeProvider(latency_sec))
+    journal_path = Path(tempfile.mkdtemp()) / "observer_journal.jsonl"
+    observer = main.GlobalObserver(
+        trigger_threshold=1000,
+        dedupe_window=0,
+        journal=main.ObserverJournal(journal_path, redact=False),
+    )
+    for index in range(10):
+        await observer.add_message(f"第 {index} 条消息", FakeEvent("group_0"), context, role=main.ObserverRole.USER)
+
+    # 后台任务由 reset 直接取消；空闲兜底那种直接 await 的总结取消不到，靠 reset 代数丢弃结果。
+    task = asyncio.create_task(observer._trigger_summarization(FakeEvent("global"), context))
+    if background:
+        observer._summarization_task = task
+    await asyncio.sleep(latency_sec / 2)
+    observer.reset()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return not observer.current_state and not journal_path.exists()
+
+
+async def _main(args):
+    single = await _run_once(args, map_reduce_threshold=0)
+    chunked = await _run_once(args, map_reduce_threshold=1)
+    print(f"messages={args.messages} subjects={args.subjects} chunk_size={args.chunk_size} "
+          f"chunk_by={args.chunk_by} concurrency={args.concurrency} reduce_with_llm={args.reduce_with_llm}")
+    print(f"{'mode':<12}{'wall_sec':>10}{'calls':>8}{'prompt_chars':>14}{'ok':>6}")
+    for name, (elapsed, calls, chars, succeeded) in [("single", single), ("map-reduce", chunked)]:
+        print(f"{name:<12}{elapsed:>10.3f}{calls:>8}{chars:>14}{str(succeeded):>6}")
+    if chunked[0] > 0:
+        print(f"speedup={single[0] / chunked[0]:.2f}x")
+
+    for background in (True, False):
+        clean = await _check_reset_during_summary(args.latency, background)
+        print(f"reset_during_summary background={background} clean={'yes' if clean else 'no'}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=400)
+    parser.add_argument("--subjects", type=int, default=8)
+    parser.add_argument("--message-repeat", type=int, default=4, help="每条消息正文重复多少次，用来控制消息长度")
+    parser.add_argument("--chunk-size", type=int, default=50)
+    parser.add_argument("--chunk-by", choices=["subject", "size"], default="subject")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--reduce-with-llm", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.2, help="每次调用的固定延迟（秒）")
+    parser.add_argument("--per-kchar-latency", type=float, default=0.05, help="prompt 每千字符额外延迟（秒）")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(parse_args()))
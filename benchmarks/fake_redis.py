@@ -0,0 +1,242 @@
+"""进程内的 Redis 替身，只实现 RedisStateBackend / RedisStateStore 用到的那部分 redis-py 接口。
+
+-   哈希命令 `hgetall` / `hget` / `hset(mapping=...)` / `hincrby`，以及 `delete` / `publish`；
+-   `pipeline()`：`watch` 之后进入立即执行模式，`multi` 之后排队，`execute` 时若被 watch 的 key 改过就抛 `WatchError`，
+    语义与真实 Redis 的乐观锁一致；`pipeline(transaction=False)` 只是批量执行；
+-   `pubsub()`：`subscribe(**{channel: handler})` + `run_in_thread(exception_handler=...)`，消息在发布方线程上同步投递；
+    `FakePubSubWorker.fail()` 模拟订阅连接断开。
+
+同一个 URL 的客户端共享一份服务端数据，多个插件实例（模拟多个节点）可以在同一进程、不同线程里并发访问。
+`FakeRedisServer.down = True` 可以模拟 Redis 故障。用法是在导入插件后把 `main.redis` 换成本模块：
+
+    import fake_redis
+    main.redis = fake_redis
+"""
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+
+class RedisError(Exception):
+    pass
+
+
+class ConnectionError(RedisError):
+    pass
+
+
+class WatchError(RedisError):
+    pass
+
+
+class FakeRedisServer:
+    def __init__(self):
+        self.hashes: Dict[str, Dict[str, str]] = {}
+        # 每次写入都递增 key 的版本号，watch 比较的就是它。
+        self.versions: Dict[str, int] = {}
+        self.subscribers: Dict[str, List[Callable[[Dict[str, Any]], None]]] = {}
+        self.lock = threading.RLock()
+        self.down = False
+        self.command_count = 0
+
+    def check(self) -> None:
+        if self.down:
+            raise ConnectionError("fake redis server is down")
+        self.command_count += 1
+
+    def touch(self, key: str) -> None:
+        self.versions[key] = self.versions.get(key, 0) + 1
+
+
+class FakePubSubWorker:
+    """对应 redis-py 的 PubSubWorkerThread。消息同步投递，没有真正的线程，只模拟存活状态和异常处理。"""
+
+    def __init__(self, pubsub: "FakePubSub", exception_handler: Optional[Callable[..., None]] = None):
+        self.pubsub = pubsub
+        self.exception_handler = exception_handler
+        self.alive = True
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+    def stop(self) -> None:
+        self.pubsub.unsubscribe()
+        self.alive = False
+
+    def fail(self, error: Optional[Exception] = None) -> None:
+        """模拟订阅连接断开：订阅丢失，之后发布的消息收不到。
+
+        与 redis-py 一样，没有 exception_handler 时线程直接退出；有的话交给它处理，线程继续运行。
+        """
+        error = error or ConnectionError("fake pubsub connection lost")
+        self.pubsub.unsubscribe()
+        if self.exception_handler is None:
+            self.alive = False
+            return
+        self.exception_handler(error, self.pubsub, self)
+
+
+class FakePubSub:
+    def __init__(self, server: FakeRedisServer):
+        self.server = server
+        self.handlers: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+
+    def subscribe(self, **handlers) -> None:
+        with self.server.lock:
+            self.server.check()
+            for channel, handler in handlers.items():
+                self.handlers[channel] = handler
+                self.server.subscribers.setdefault(channel, []).append(handler)
+
+    def unsubscribe(self) -> None:
+        with self.server.lock:
+            for channel, handler in self.handlers.items():
+                channel_handlers = self.server.subscribers.get(channel, [])
+                if handler in channel_handlers:
+                    channel_handlers.remove(handler)
+            self.handlers = {}
+
+    def run_in_thread(
+        self,
+        sleep_time: float = 0.0,
+        daemon: bool = True,
+        exception_handler: Optional[Callable[..., None]] = None,
+    ) -> FakePubSubWorker:
+        return FakePubSubWorker(self, exception_handler)
+
+
+class FakeRedis:
+    _servers: Dict[str, FakeRedisServer] = {}
+
+    def __init__(self, server: Optional[FakeRedisServer] = None):
+        self.server = server or FakeRedisServer()
+
+    @classmethod
+    def from_url(cls, url: str, **kwargs) -> "FakeRedis":
+        server = cls._servers.get(url)
+        if server is None:
+            server = cls._servers[url] = FakeRedisServer()
+        return cls(server)
+
+    # 以下命令都在服务端锁内执行，返回值形状与 decode_responses=True 的 redis-py 一致。
+    def hgetall(self, key: str) -> Dict[str, str]:
+        with self.server.lock:
+            self.server.check()
+            return dict(self.server.hashes.get(key, {}))
+
+    def hget(self, key: str, field: str) -> Optional[str]:
+        with self.server.lock:
+            self.server.check()
+            return self.server.hashes.get(key, {}).get(field)
+
+    def hset(self, key: str, mapping: Dict[str, Any]) -> int:
+        with self.server.lock:
+            self.server.check()
+            target = self.server.hashes.setdefault(key, {})
+            added = sum(1 for field in mapping if field not in target)
+            target.update({field: str(value) for field, value in mapping.items()})
+            self.server.touch(key)
+            return added
+
+    def hincrby(self, key: str, field: str, amount: int = 1) -> int:
+        with self.server.lock:
+            self.server.check()
+            target = self.server.hashes.setdefault(key, {})
+            value = int(target.get(field, 0)) + int(amount)
+            target[field] = str(value)
+            self.server.touch(key)
+            return value
+
+    def delete(self, *keys: str) -> int:
+        with self.server.lock:
+            self.server.check()
+            deleted = 0
+            for key in keys:
+                if self.server.hashes.pop(key, None) is not None:
+                    deleted += 1
+                self.server.touch(key)
+            return deleted
+
+    def publish(self, channel: str, message: str) -> int:
+        with self.server.lock:
+            self.server.check()
+            handlers = list(self.server.subscribers.get(channel, []))
+        for handler in handlers:
+            handler({"type": "message", "channel": channel, "data": message})
+        return len(handlers)
+
+    def pipeline(self, transaction: bool = True) -> "FakePipeline":
+        return FakePipeline(self, transaction)
+
+    def pubsub(self, ignore_subscribe_messages: bool = True) -> FakePubSub:
+        return FakePubSub(self.server)
+
+
+class FakePipeline:
+    def __init__(self, client: FakeRedis, transaction: bool):
+        self.client = client
+        self.transaction = transaction
+        self.reset()
+
+    def reset(self) -> None:
+        self._watched: Dict[str, int] = {}
+        self._queued: List[Tuple[str, tuple, dict]] = []
+        self._immediate = False
+
+    def watch(self, *keys: str) -> None:
+        with self.client.server.lock:
+            self.client.server.check()
+            for key in keys:
+                self._watched[key] = self.client.server.versions.get(key, 0)
+        self._immediate = True
+
+    def multi(self) -> None:
+        self._immediate = False
+
+    def _command(self, name: str, *args, **kwargs):
+        if self._immediate:
+            return getattr(self.client, name)(*args, **kwargs)
+        self._queued.append((name, args, kwargs))
+        return self
+
+    def hgetall(self, key: str):
+        return self._command("hgetall", key)
+
+    def hget(self, key: str, field: str):
+        return self._command("hget", key, field)
+
+    def hset(self, key: str, mapping: Dict[str, Any]):
+        return self._command("hset", key, mapping=mapping)
+
+    def hincrby(self, key: str, field: str, amount: int = 1):
+        return self._command("hincrby", key, field, amount)
+
+    def delete(self, *keys: str):
+        return self._command("delete", *keys)
+
+    def publish(self, channel: str, message: str):
+        return self._command("publish", channel, message)
+
+    def execute(self) -> List[Any]:
+        queued, self._queued = self._queued, []
+        publishes = []
+        results = []
+        with self.client.server.lock:
+            self.client.server.check()
+            if any(self.client.server.versions.get(key, 0) != version for key, version in self._watched.items()):
+                self._watched = {}
+                raise WatchError("watched key changed")
+            self._watched = {}
+            for name, args, kwargs in queued:
+                if name == "publish":
+                    # 发布放到释放锁之后，避免订阅回调里再访问服务端时和本事务互相等待。
+                    publishes.append(args)
+                    results.append(0)
+                else:
+                    results.append(getattr(self.client, name)(*args, **kwargs))
+        for channel, message in publishes:
+            self.client.publish(channel, message)
+        return results
+
+
+# 与 redis-py 同名的入口，`main.redis = fake_redis` 之后插件里的 `redis.Redis.from_url(...)` 直接可用。
+Redis = FakeRedis
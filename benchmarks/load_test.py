@@ -0,0 +1,191 @@
+"""多会话并发压测：模拟 N 个 unified_msg_origin 同时聊天并调用状态工具。
+
+每个会话循环执行“记录一轮对话 -> add_state 注入 -> 按概率调用 apply_state_transition / update_body_sheet
+-> 等待假模型回复”。会话管理器和 Provider 的延迟都可配置，观察者总结也会真实地在后台跑起来。
+
+报告内容：
+-   总吞吐（每秒 add_state 次数）与各处理函数的 p50 / p99 / max 耗时；
+-   事件循环延迟（插件自带看门狗的 loop.lag 分布）以及被归因到插件阶段的阻塞次数；
+-   History 增量是否丢失：成功写入的 history_delta 次数与最终计数之差；
+-   快状态 / Body_Sheet 的冷却拒绝率。
+
+用法：
+    python benchmarks/load_test.py --sessions 200 --turns 10 --provider-latency 0.3 --conversation-latency 0.005
+"""
+import argparse
+import asyncio
+import json
+import random
+import statistics
+import time
+from typing import Dict, List
+
+from astrbot_stub import (
+    FakeContext,
+    FakeConversationManager,
+    FakeEvent,
+    FakeProvider,
+    FakeProviderRequest,
+    load_plugin_module,
+)
+
+main = load_plugin_module()
+
+HISTORY_KEY = "LoadTest_Count"
+
+
+def _percentile(samples: List[float], quantile: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(quantile * len(ordered) + 0.5) - 1))]
+
+
+class LoadStats:
+    def __init__(self):
+        self.latencies_ms: Dict[str, List[float]] = {}
+        self.outcomes: Dict[str, Dict[str, int]] = {}
+        self.history_increments_applied = 0
+
+    def record(self, handler_name: str, started: float, report: str = "") -> None:
+        self.latencies_ms.setdefault(handler_name, []).append((time.perf_counter() - started) * 1000)
+        if not report:
+            return
+        if "冷却中" in report:
+            outcome = "cooldown_reject"
+        elif str(report).startswith("Update Failed"):
+            outcome = "rejected"
+        else:
+            outcome = "applied"
+        handler_outcomes = self.outcomes.setdefault(handler_name, {})
+        handler_outcomes[outcome] = handler_outcomes.get(outcome, 0) + 1
+
+
+async def _session(plugin, context, session_index: int, args, stats: LoadStats, rng: random.Random) -> None:
+    uid = f"load_session_{session_index}"
+    sender_name = f"user_{session_index}"
+    for turn in range(args.turns):
+        message_text = f"第 {turn} 轮：" + "随便聊聊今天发生的事，" * rng.randint(1, args.max_message_repeat)
+        context.conversation_manager.record_turn(uid, message_text, f"收到，第 {turn} 轮回复")
+        event = FakeEvent(uid, message_text, sender_name)
+
+        started = time.perf_counter()
+        await plugin.add_state(event, FakeProviderRequest(message_text, "你是一个角色扮演助手。"))
+        stats.record("add_state", started)
+
+        if rng.random() < args.tool_rate:
+            started = time.perf_counter()
+            report = await plugin.apply_state_transition(
+                event,
+                energy_level=rng.randint(10, 100),
+                physical_state=rng.choice(["Resting", "Working", "Exercising", "Socializing"]),
+                context_subject_id=uid,
+                history_delta=json.dumps({HISTORY_KEY: 1}),
+                update_reason="压测",
+            )
+            stats.record("apply_state_transition", started, report)
+            if not str(report).startswith("Update Failed"):
+                stats.history_increments_applied += 1
+
+        if rng.random() < args.body_sheet_rate:
+            started = time.perf_counter()
+            report = await plugin.update_body_sheet(
+                event,
+                body_sheet_updates=json.dumps({"压测部位": {f"属性_{session_index}": f"第 {turn} 轮写入"}}, ensure_ascii=False),
+                update_reason="压测",
+            )
+            stats.record("update_body_sheet", started, report)
+
+        # 模拟主模型生成回复的时间，期间事件循环可以去处理其他会话。
+        await asyncio.sleep(args.reply_latency * rng.uniform(0.5, 1.5))
+
+
+async def _main(args):
+    rng = random.Random(args.seed)
+    context = FakeContext(
+        provider=FakeProvider(args.provider_latency),
+        conversation_manager=FakeConversationManager(args.conversation_latency),
+    )
+    plugin = main.LivelyState(context, {
+        "fast_state_cooldown_sec": args.fast_cooldown,
+        "body_sheet_cooldown_sec": args.body_sheet_cooldown,
+        "hot_path_log_level": "off",
+        "loop_watchdog_enabled": True,
+        "loop_watchdog_threshold_ms": args.block_threshold_ms,
+        "observer_min_interval_sec": args.observer_min_interval,
+    })
+    state = plugin.global_state.get_whole_state(enable_update=False)
+    state["History"][HISTORY_KEY] = 0
+    plugin.global_state.save(state)
+    await plugin.initialize()
+
+    stats = LoadStats()
+    started = time.perf_counter()
+    await asyncio.gather(*[
+        _session(plugin, context, session_index, args, stats, random.Random(rng.random()))
+        for session_index in range(args.sessions)
+    ])
+    wall_sec = time.perf_counter() - started
+    await plugin.terminate()
+
+    final_history = plugin.global_state.get_whole_state(enable_update=False)["History"].get(HISTORY_KEY, 0)
+    metrics = plugin.metrics.snapshot()
+    loop_lag = metrics["stages"].get("loop.lag", {})
+
+    add_state_count = len(stats.latencies_ms.get("add_state", []))
+    print(f"sessions={args.sessions} turns={args.turns} wall_sec={wall_sec:.2f} "
+          f"throughput={add_state_count / wall_sec:.1f} add_state/s")
+    print(f"{'handler':<26}{'calls':>8}{'p50_ms':>10}{'p99_ms':>10}{'max_ms':>10}{'cooldown_reject':>17}{'other_reject':>14}")
+    for handler_name, samples in stats.latencies_ms.items():
+        outcomes = stats.outcomes.get(handler_name, {})
+        cooldown_reject_rate = outcomes.get("cooldown_reject", 0) / len(samples) if outcomes else 0.0
+        # 其余拒绝多半是状态机不允许的直接转移，属于正常业务拒绝，单独列出便于和冷却区分。
+        other_reject_rate = outcomes.get("rejected", 0) / len(samples) if outcomes else 0.0
+        print(f"{handler_name:<26}{len(samples):>8}{_percentile(samples, 0.5):>10.2f}"
+              f"{_percentile(samples, 0.99):>10.2f}{max(samples):>10.2f}"
+              f"{cooldown_reject_rate:>17.1%}{other_reject_rate:>14.1%}")
+    print(f"event_loop_lag p50={loop_lag.get('p50_ms', 0):.2f}ms p99={loop_lag.get('p99_ms', 0):.2f}ms "
+          f"max={loop_lag.get('max_ms', 0):.2f}ms blocking_slices={metrics['counters'].get('loop.blocking_slices', 0)}")
+    print(f"history_increments applied={stats.history_increments_applied} final={final_history} "
+          f"lost={stats.history_increments_applied - final_history}")
+    print(f"observer_summaries={context.provider.call_count} "
+          f"summary_p50={metrics['stages'].get('observer.summarize', {}).get('p50_ms', 0):.1f}ms")
+    if args.json:
+        print(json.dumps({
+            "wall_sec": wall_sec,
+            "handlers": {
+                handler_name: {
+                    "calls": len(samples),
+                    "p50_ms": _percentile(samples, 0.5),
+                    "p99_ms": _percentile(samples, 0.99),
+                    "mean_ms": statistics.fmean(samples),
+                    "outcomes": stats.outcomes.get(handler_name, {}),
+                }
+                for handler_name, samples in stats.latencies_ms.items()
+            },
+            "loop_lag": loop_lag,
+            "history_lost": stats.history_increments_applied - final_history,
+        }, ensure_ascii=False))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=200)
+    parser.add_argument("--turns", type=int, default=10)
+    parser.add_argument("--tool-rate", type=float, default=0.3, help="每轮调用 apply_state_transition 的概率")
+    parser.add_argument("--body-sheet-rate", type=float, default=0.05, help="每轮调用 update_body_sheet 的概率")
+    parser.add_argument("--max-message-repeat", type=int, default=6, help="消息正文最多重复多少次，用来控制消息长度")
+    parser.add_argument("--provider-latency", type=float, default=0.3, help="观察者总结调用的延迟（秒）")
+    parser.add_argument("--conversation-latency", type=float, default=0.005, help="会话管理器每次查询的延迟（秒）")
+    parser.add_argument("--reply-latency", type=float, default=0.5, help="两轮之间模拟主模型回复的等待（秒）")
+    parser.add_argument("--fast-cooldown", type=int, default=0, help="覆盖 fast_state_cooldown_sec")
+    parser.add_argument("--body-sheet-cooldown", type=int, default=0, help="覆盖 body_sheet_cooldown_sec")
+    parser.add_argument("--observer-min-interval", type=int, default=5, help="覆盖 observer_min_interval_sec，压测时间短时调小才能看到总结")
+    parser.add_argument("--block-threshold-ms", type=int, default=50, help="看门狗判定阻塞的阈值")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--json", action="store_true", help="额外输出一行 JSON 结果")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    asyncio.run(_main(parse_args()))
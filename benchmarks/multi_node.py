@@ -0,0 +1,255 @@
+"""多节点共享状态压测：N 个插件实例（各自一个线程和事件循环）通过 Redis 后端并发写同一份全局状态。
+
+默认使用进程内的 `fake_redis`（把插件里的 `redis` 模块替换掉），也可以用 `--redis-url` 指向真实的 redis-server，
+这时每次运行使用随机的 key 前缀，结束后清理。每个节点循环调用真实的 `apply_state_transition`，
+每次都带一个 History 增量，并随机切换物理状态。
+
+结束时检查：
+-   History 增量是否丢失：所有节点成功写入的次数之和应等于 Redis 里的最终计数；
+-   各节点读到的状态是否一致：订阅失效通知后节点会缓存状态，漏掉通知就会读到旧版本；
+-   版本冲突次数、冲突重试后仍失败的次数，以及各节点收到的失效通知数；
+-   失效通知竞态：节点 A 读完 Redis、还没写入本地缓存时，节点 B 写入新状态并让 A 收到失效通知，
+    A 之后的读取必须看到 B 的状态，而不是把刚读到的旧值缓存下来；
+-   订阅断线（仅 fake_redis）：A 的订阅连接断开、期间 B 写入的通知丢失时，A 必须丢掉缓存读到 B 的状态，
+    重新订阅后恢复缓存。
+
+用法：
+    python benchmarks/multi_node.py --nodes 4 --updates 200
+    python benchmarks/multi_node.py --nodes 4 --updates 200 --redis-url redis://localhost:6379/15
+"""
+import argparse
+import asyncio
+import json
+import random
+import sys
+import threading
+import time
+
+import fake_redis
+from astrbot_stub import FakeContext, FakeEvent, load_plugin_module
+
+main = load_plugin_module()
+
+HISTORY_KEY = "MultiNode_Count"
+
+
+def _node_config(args, key_prefix: str) -> dict:
+    return {
+        "state_backend": "redis",
+        "redis_url": args.redis_url or "fake://multi-node",
+        "redis_key_prefix": key_prefix,
+        "fast_state_cooldown_sec": 0,
+        "hot_path_log_level": "off",
+        "observer_persist": False,
+        "loop_watchdog_enabled": False,
+        "state_timeline_enabled": False,
+    }
+
+
+async def _run_node(node_index: int, args, key_prefix: str, start_barrier: threading.Barrier, result: dict) -> None:
+    rng = random.Random(args.seed + node_index)
+    plugin = main.LivelyState(FakeContext(), _node_config(args, key_prefix))
+    await plugin.initialize()
+    start_barrier.wait()
+
+    applied = 0
+    outcomes = {}
+    event = FakeEvent(f"node_{node_index}_session", "", f"node_{node_index}")
+    started = time.perf_counter()
+    for update_index in range(args.updates):
+        report = await plugin.apply_state_transition(
+            event,
+            physical_state=rng.choice(["Idle", "Resting", "Working", "Socializing"]),
+            energy_level=rng.randint(10, 100),
+            history_delta=json.dumps({HISTORY_KEY: 1}),
+            update_reason=f"node {node_index} update {update_index}",
+        )
+        outcome = plugin._classify_apply_report(report)
+        outcome_key = outcome["status"] if outcome["status"] == "applied" else outcome["reason"]
+        outcomes[outcome_key] = outcomes.get(outcome_key, 0) + 1
+        if outcome["status"] == "applied":
+            applied += 1
+    result["wall_sec"] = time.perf_counter() - started
+    result["applied"] = applied
+    result["outcomes"] = outcomes
+    # 其他节点可能还在写；等所有节点都写完再比较各自读到的状态。
+    start_barrier.wait()
+    result["final_state"] = plugin.global_state.get_whole_state(enable_update=False)
+    result["counters"] = plugin.metrics.snapshot()["counters"]
+    await plugin.terminate()
+
+
+def _node_thread(node_index: int, args, key_prefix: str, start_barrier: threading.Barrier, result: dict) -> None:
+    try:
+        asyncio.run(_run_node(node_index, args, key_prefix, start_barrier, result))
+    except Exception as e:
+        result["error"] = repr(e)
+        start_barrier.abort()
+
+
+class _ReadHookClient:
+    """包一层 redis 客户端：下一次只读批量查询（load 用的 pipeline(transaction=False)）执行完后先调用 hook 再返回结果。"""
+
+    def __init__(self, client):
+        self.client = client
+        self.after_next_read = None
+
+    def pipeline(self, transaction: bool = True):
+        pipe = self.client.pipeline(transaction=transaction)
+        if transaction or self.after_next_read is None:
+            return pipe
+        hook, self.after_next_read = self.after_next_read, None
+        execute = pipe.execute
+
+        def execute_then_hook():
+            results = execute()
+            hook()
+            return results
+
+        pipe.execute = execute_then_hook
+        return pipe
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def _redis_client(args):
+    if args.redis_url:
+        return main.redis.Redis.from_url(args.redis_url, decode_responses=True)
+    return fake_redis.Redis.from_url("fake://multi-node")
+
+
+def check_invalidation_race(args, key_prefix: str) -> bool:
+    """在 A 的读取和缓存写入之间插入 B 的写入，返回 A 随后是否仍读到旧状态。"""
+    client_a = _ReadHookClient(_redis_client(args))
+    backend_a = main.RedisStateBackend(client_a, key_prefix=key_prefix)
+    backend_b = main.RedisStateBackend(_redis_client(args), key_prefix=key_prefix)
+    backend_a.start()
+    backend_b.start()
+    store_a = backend_a.store("race_check")
+    store_b = backend_b.store("race_check")
+    try:
+        store_b.load()
+        store_b.save({"physical_state": "Idle", "History": {}})
+
+        def write_from_b():
+            state = store_b.load()
+            state["physical_state"] = "Working"
+            store_b.save(state)
+            # 真实 Redis 的失效通知由订阅线程异步投递，等它真正到达 A。
+            deadline = time.monotonic() + 5
+            while not backend_a.metrics.snapshot()["counters"].get("state_backend.invalidations") and time.monotonic() < deadline:
+                time.sleep(0.01)
+
+        client_a.after_next_read = write_from_b
+        store_a.load()
+        return store_a.load()["physical_state"] != "Working"
+    finally:
+        store_b.delete()
+        backend_a.stop()
+        backend_b.stop()
+
+
+def check_pubsub_failure(args, key_prefix: str) -> bool:
+    """断开 A 的订阅、在重新订阅前让 B 写入，返回 A 随后是否读到旧状态或没能恢复订阅。"""
+    backend_a = main.RedisStateBackend(_redis_client(args), key_prefix=key_prefix)
+    backend_b = main.RedisStateBackend(_redis_client(args), key_prefix=key_prefix)
+    backend_a.start()
+    backend_b.start()
+    store_a = backend_a.store("pubsub_check")
+    store_b = backend_b.store("pubsub_check")
+    try:
+        store_b.load()
+        store_b.save({"physical_state": "Idle", "History": {}})
+        store_a.load()
+        # 断线期间 B 的写入通知发不到 A：先把 A 的订阅摘掉再写，之后才交给异常处理重新订阅。
+        backend_a._pubsub.unsubscribe()
+        state = store_b.load()
+        state["physical_state"] = "Working"
+        store_b.save(state)
+        backend_a._pubsub_thread.fail()
+        return store_a.load()["physical_state"] != "Working" or not backend_a.listening
+    finally:
+        store_b.delete()
+        backend_a.stop()
+        backend_b.stop()
+
+
+def run(args) -> int:
+    if args.redis_url:
+        if main.redis is None:
+            print("--redis-url requires the redis package", file=sys.stderr)
+            return 2
+        key_prefix = f"livelystate-multinode-{random.getrandbits(32):08x}"
+    else:
+        main.redis = fake_redis
+        key_prefix = "livelystate"
+    # 把线程切换间隔调小，让各节点的“读 -> 校验 -> 写”更频繁地交错，冲突路径才跑得到。
+    sys.setswitchinterval(args.switch_interval)
+
+    seed_plugin = main.LivelyState(FakeContext(), _node_config(args, key_prefix))
+    seed_plugin.global_state.delete()
+    state = seed_plugin.global_state.get_whole_state(enable_update=False)
+    state["History"][HISTORY_KEY] = 0
+    seed_plugin.global_state.save(state)
+
+    start_barrier = threading.Barrier(args.nodes)
+    results = [{} for _ in range(args.nodes)]
+    threads = [
+        threading.Thread(target=_node_thread, args=(node_index, args, key_prefix, start_barrier, results[node_index]))
+        for node_index in range(args.nodes)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    errors = [result["error"] for result in results if "error" in result]
+    if errors:
+        print("node errors: " + "; ".join(errors), file=sys.stderr)
+        return 1
+
+    final_state = seed_plugin.global_state.get_whole_state(enable_update=False)
+    final_history = final_state["History"].get(HISTORY_KEY, 0)
+    applied_total = sum(result["applied"] for result in results)
+    divergent_nodes = [
+        node_index for node_index, result in enumerate(results)
+        if {key: value for key, value in result["final_state"].items() if key != "updated_at"}
+        != {key: value for key, value in final_state.items() if key != "updated_at"}
+    ]
+    if args.redis_url:
+        seed_plugin.global_state.delete()
+
+    print(f"backend={'redis ' + args.redis_url if args.redis_url else 'fake_redis'} nodes={args.nodes} "
+          f"updates_per_node={args.updates}")
+    print(f"{'node':<6}{'applied':>9}{'wall_sec':>10}{'conflicts':>11}{'retries':>9}{'invalidations':>15}{'cache_hits':>12}  outcomes")
+    for node_index, result in enumerate(results):
+        counters = result["counters"]
+        print(f"{node_index:<6}{result['applied']:>9}{result['wall_sec']:>10.2f}"
+              f"{counters.get('state_backend.conflicts', 0):>11}{counters.get('apply.state_conflicts', 0):>9}"
+              f"{counters.get('state_backend.invalidations', 0):>15}{counters.get('state_backend.cache_hits', 0):>12}  "
+              + " ".join(f"{key}={value}" for key, value in sorted(result["outcomes"].items())))
+    lost = applied_total - final_history
+    print(f"history_increments applied={applied_total} final={final_history} lost={lost}")
+    print(f"divergent_nodes={divergent_nodes or 'none'}")
+    stale_read = check_invalidation_race(args, key_prefix)
+    print(f"invalidation_race stale_read={'yes' if stale_read else 'no'}")
+    pubsub_stale = False
+    if not args.redis_url:
+        pubsub_stale = check_pubsub_failure(args, key_prefix)
+        print(f"pubsub_failure stale_read={'yes' if pubsub_stale else 'no'}")
+    return 1 if lost or divergent_nodes or stale_read or pubsub_stale else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--nodes", type=int, default=4, help="模拟的节点（插件实例）数量")
+    parser.add_argument("--updates", type=int, default=200, help="每个节点调用 apply_state_transition 的次数")
+    parser.add_argument("--redis-url", default=None, help="使用真实的 redis-server，例如 redis://localhost:6379/15；默认用进程内假实现")
+    parser.add_argument("--switch-interval", type=float, default=1e-5, help="sys.setswitchinterval，越小各节点交错越频繁")
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    sys.exit(run(parse_args()))
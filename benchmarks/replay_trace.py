@@ -0,0 +1,157 @@
+"""离线回放 `/state_capture` 录下的流量轨迹，并比较两次回放的结果。
+
+回放时通过 `set_clock` 给插件换上 `VirtualClock`，按轨迹里记录的时间戳推进：
+自然流转、冷却、观察者总结调度和 token 预算都和线上当时的节奏一致，而回放本身不需要真的等待。
+每一步记录一次公开状态、注入后的 system prompt / prompt，结束时附上插件的阶段耗时指标。
+插件配置默认沿用轨迹文件头里录制时的配置（冷却、流转间隔、注入模式等），`--config` 里的键再覆盖上去。
+
+同一份轨迹可以分别对两份插件检出（`--plugin-dir`）回放，再用 `--compare` 比较：
+报告状态时间线和注入 prompt 第一次出现分歧的位置、分歧步数，以及各阶段 p50 / 均值耗时的变化。
+
+用法：
+    python benchmarks/replay_trace.py traces/trace-xxx.jsonl --output before.json --plugin-dir ../LivelyState-old
+    python benchmarks/replay_trace.py traces/trace-xxx.jsonl --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import sys
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+
+from astrbot_stub import FakeContext, FakeEvent, FakeProviderRequest, load_plugin_module
+
+
+def load_trace(path: Path) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """返回 (文件头, 记录列表)；旧轨迹没有文件头里的 config 时按空配置处理。"""
+    header: Dict[str, Any] = {}
+    records = []
+    with path.open("r", encoding="utf-8") as trace_file:
+        for line in trace_file:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                if record.get("kind") == "header":
+                    header = header or record
+                else:
+                    records.append(record)
+    return header, records
+
+
+def _digest(text: str) -> str:
+    return hashlib.sha1((text or "").encode("utf-8")).hexdigest()[:16]
+
+
+async def replay(main, records: List[Dict[str, Any]], config: Dict[str, Any], keep_prompts: bool) -> Dict[str, Any]:
+    clock = main.VirtualClock(start=records[0]["t"] if records else None)
+    context = FakeContext()
+    plugin = main.LivelyState(context, {
+        "hot_path_log_level": "off",
+        "observer_persist": False,
+        "loop_watchdog_enabled": False,
+        **config,
+    })
+    plugin.set_clock(clock)
+    plugin.global_state.delete()
+
+    timeline = []
+    for index, record in enumerate(records):
+        clock.set(max(clock.now(), float(record["t"])))
+        uid = record["uid"]
+        step: Dict[str, Any] = {"i": index, "kind": record["kind"], "t": record["t"]}
+        if record["kind"] == "add_state":
+            if "reply" in record:
+                context.conversation_manager.record_turn(uid, record.get("message", ""), record["reply"])
+            request = FakeProviderRequest(record.get("prompt", ""), record.get("system_prompt", ""))
+            await plugin.add_state(FakeEvent(uid, record.get("message", ""), record.get("sender", "user")), request)
+            step["system_prompt_sha"] = _digest(request.system_prompt)
+            step["prompt_sha"] = _digest(request.prompt)
+            if keep_prompts:
+                step["system_prompt"] = request.system_prompt
+                step["prompt"] = request.prompt
+        elif record["kind"] in ("apply_state_transition", "update_body_sheet"):
+            handler = getattr(plugin, record["kind"])
+            report = await handler(FakeEvent(uid), **record.get("args", {}))
+            step["applied"] = not str(report).startswith("Update Failed")
+        else:
+            continue
+
+        # 等后台总结跑完再进入下一步，保证回放结果不依赖协程调度顺序。
+        summarization_task = getattr(plugin.global_observer, "_summarization_task", None)
+        if summarization_task and not summarization_task.done():
+            await summarization_task
+
+        state = plugin._to_public_state(plugin.global_state.get_whole_state(enable_update=False))
+        state.pop("updated_at", None)
+        step["state"] = state
+        timeline.append(step)
+
+    await plugin.terminate()
+    return {"records": len(records), "timeline": timeline, "metrics": plugin.metrics.snapshot()}
+
+
+def _diff_fields(left: Dict[str, Any], right: Dict[str, Any]) -> List[str]:
+    return sorted(key for key in set(left) | set(right) if left.get(key) != right.get(key))
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any]) -> int:
+    state_mismatches = []
+    prompt_mismatches = []
+    for current_step, baseline_step in zip(current["timeline"], baseline["timeline"]):
+        changed_fields = _diff_fields(current_step["state"], baseline_step["state"])
+        if changed_fields:
+            state_mismatches.append((current_step["i"], changed_fields))
+        if (current_step.get("system_prompt_sha"), current_step.get("prompt_sha")) != (
+            baseline_step.get("system_prompt_sha"), baseline_step.get("prompt_sha")
+        ):
+            prompt_mismatches.append(current_step["i"])
+
+    print(f"steps current={len(current['timeline'])} baseline={len(baseline['timeline'])}")
+    print(f"state_mismatches={len(state_mismatches)} prompt_mismatches={len(prompt_mismatches)}")
+    if state_mismatches:
+        first_index, first_fields = state_mismatches[0]
+        print(f"first state divergence at step {first_index}: {', '.join(first_fields)}")
+    if prompt_mismatches:
+        print(f"first prompt divergence at step {prompt_mismatches[0]}")
+
+    print(f"{'stage':<36}{'base_p50':>10}{'cur_p50':>10}{'base_mean':>11}{'cur_mean':>10}{'delta':>9}")
+    current_stages = current["metrics"]["stages"]
+    baseline_stages = baseline["metrics"]["stages"]
+    for stage in sorted(set(current_stages) | set(baseline_stages)):
+        base = baseline_stages.get(stage, {})
+        cur = current_stages.get(stage, {})
+        base_mean = base.get("mean_ms", 0.0)
+        cur_mean = cur.get("mean_ms", 0.0)
+        delta = f"{(cur_mean - base_mean) / base_mean:+.0%}" if base_mean else "n/a"
+        print(f"{stage:<36}{base.get('p50_ms', 0.0):>10.3f}{cur.get('p50_ms', 0.0):>10.3f}"
+              f"{base_mean:>11.3f}{cur_mean:>10.3f}{delta:>9}")
+    return 1 if state_mismatches or prompt_mismatches else 0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("trace", type=Path, help="/state_capture 录下的 trace-*.jsonl")
+    parser.add_argument("--plugin-dir", type=Path, default=None, help="要回放的插件检出目录，默认是当前仓库")
+    parser.add_argument("--config", default="{}", help="覆盖录制时配置的 JSON，例如 '{\"state_injection_mode\": \"delta\"}'")
+    parser.add_argument("--output", type=Path, default=None, help="把回放结果写成 JSON，供之后 --compare 使用")
+    parser.add_argument("--compare", type=Path, default=None, help="与另一次回放结果比较，有分歧时以状态码 1 退出")
+    parser.add_argument("--keep-prompts", action="store_true", help="结果里保留完整 prompt 文本，而不只是哈希")
+    return parser.parse_args()
+
+
+def _main(args) -> int:
+    main = load_plugin_module(plugin_dir=args.plugin_dir)
+    header, records = load_trace(args.trace)
+    config = {**header.get("config", {}), **json.loads(args.config)}
+    result = asyncio.run(replay(main, records, config, args.keep_prompts))
+    print(f"replayed {result['records']} records into {len(result['timeline'])} steps")
+    if args.output:
+        args.output.write_text(json.dumps(result, ensure_ascii=False, indent=1), encoding="utf-8")
+    if args.compare:
+        return compare(result, json.loads(args.compare.read_text(encoding="utf-8")))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(_main(parse_args()))
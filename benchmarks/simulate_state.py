@@ -0,0 +1,115 @@
+"""用虚拟时钟快速模拟角色状态在长时间跨度上的演化。
+
+插件的状态引擎和冷却判断改用 `VirtualClock` 后，这里每一步直接把时钟往前推 `--step-sec` 秒，
+再按概率让“模型”调用一次状态切换（走真实的 `_handle_apply`，包括状态机校验和冷却），
+状态只保存在内存里。几千模拟小时通常只需要一两秒，适合检查数值平衡、自动回退和冷却的长期表现。
+
+用法：
+    python benchmarks/simulate_state.py --hours 2000 --step-sec 300 --transition-rate 0.2
+"""
+import argparse
+import random
+import time
+
+from astrbot_stub import FakeContext, FakeEvent, load_plugin_module
+
+main = load_plugin_module()
+
+
+def simulate(args) -> dict:
+    rng = random.Random(args.seed)
+    plugin = main.LivelyState(FakeContext(), {
+        "hot_path_log_level": "off",
+        "observer_persist": False,
+        "loop_watchdog_enabled": False,
+        "auto_update_interval_sec": args.update_interval,
+        "active_state_timeout_sec": args.active_timeout,
+        "fast_state_cooldown_sec": args.fast_cooldown,
+    })
+    clock = main.VirtualClock(start=0.0)
+    plugin.set_clock(clock)
+    plugin.global_state.persist = False
+    plugin.global_state.delete()
+    event = FakeEvent("simulated_user")
+
+    state_seconds = {state_name: 0.0 for state_name in plugin.global_state.STATE_MACHINE}
+    outcomes = {"applied": 0, "cooldown_reject": 0, "rejected": 0}
+    auto_fallbacks = 0
+    low_energy_steps = 0
+    high_thirst_steps = 0
+    energy_total = 0.0
+
+    total_steps = int(args.hours * 3600 // args.step_sec)
+    state = plugin.global_state.get_whole_state()
+    started = time.perf_counter()
+    for _ in range(total_steps):
+        previous_physical_state = state["physical_state"]
+        clock.advance(args.step_sec)
+        state = plugin.global_state.get_whole_state()
+        if state["physical_state"] != previous_physical_state:
+            auto_fallbacks += 1
+
+        if rng.random() < args.transition_rate:
+            allowed_states = plugin.global_state.get_state_meta(state["physical_state"])["allowed_next_states"]
+            # 有一定比例故意选不允许的状态，观察状态机拒绝的比例。
+            candidates = list(plugin.global_state.STATE_MACHINE) if rng.random() < args.invalid_rate else allowed_states
+            report = plugin._handle_apply(event, {
+                "LastUpdateTime": clock.now(),
+                "physical_state": rng.choice(candidates),
+                "update_reason": "simulated transition",
+            })
+            if "冷却中" in report:
+                outcomes["cooldown_reject"] += 1
+            elif report.startswith("Update Failed"):
+                outcomes["rejected"] += 1
+            else:
+                outcomes["applied"] += 1
+            state = plugin.global_state.get_whole_state(enable_update=False)
+
+        state_seconds[state["physical_state"]] += args.step_sec
+        energy_total += state["energy_level"]
+        low_energy_steps += state["energy_level"] < 20
+        high_thirst_steps += state["thirst"] >= 85
+    wall_sec = time.perf_counter() - started
+
+    simulated_hours = total_steps * args.step_sec / 3600
+    return {
+        "steps": total_steps,
+        "simulated_hours": simulated_hours,
+        "wall_sec": wall_sec,
+        "simulated_hours_per_sec": simulated_hours / wall_sec if wall_sec else 0.0,
+        "state_share": {
+            state_name: seconds / max(1.0, total_steps * args.step_sec)
+            for state_name, seconds in state_seconds.items()
+        },
+        "transitions": outcomes,
+        "auto_fallbacks": auto_fallbacks,
+        "mean_energy": energy_total / max(1, total_steps),
+        "low_energy_share": low_energy_steps / max(1, total_steps),
+        "high_thirst_share": high_thirst_steps / max(1, total_steps),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--hours", type=float, default=2000, help="模拟的总时长（小时）")
+    parser.add_argument("--step-sec", type=int, default=300, help="每一步推进的虚拟秒数")
+    parser.add_argument("--transition-rate", type=float, default=0.2, help="每一步尝试一次状态切换的概率")
+    parser.add_argument("--invalid-rate", type=float, default=0.1, help="状态切换中故意选择任意状态（可能被状态机拒绝）的比例")
+    parser.add_argument("--update-interval", type=int, default=300, help="覆盖 auto_update_interval_sec")
+    parser.add_argument("--active-timeout", type=int, default=1800, help="覆盖 active_state_timeout_sec")
+    parser.add_argument("--fast-cooldown", type=int, default=300, help="覆盖 fast_state_cooldown_sec")
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    result = simulate(parse_args())
+    print(f"steps={result['steps']} simulated_hours={result['simulated_hours']:.0f} wall_sec={result['wall_sec']:.2f} "
+          f"speed={result['simulated_hours_per_sec']:.0f} simulated hours/s")
+    print("state_share " + " ".join(f"{name}={share:.1%}" for name, share in result["state_share"].items()))
+    print(f"transitions applied={result['transitions']['applied']} "
+          f"cooldown_reject={result['transitions']['cooldown_reject']} rejected={result['transitions']['rejected']} "
+          f"auto_fallbacks={result['auto_fallbacks']}")
+    print(f"mean_energy={result['mean_energy']:.1f} low_energy_share={result['low_energy_share']:.1%} "
+          f"high_thirst_share={result['high_thirst_share']:.1%}")
@@ -1,24 +1,617 @@
-from collections import deque
+import asyncio
+import cProfile
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import hashlib
+import heapq
 import json
+import logging
+import math
+import mmap
+import random
+import re
+import struct
+import sys
+import threading
 import time
+import weakref
+from enum import IntEnum
 from pathlib import Path
 from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.api.provider import ProviderRequest
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from astrbot.api.event import MessageChain
 from astrbot.api.star import StarTools
 from astrbot.api import AstrBotConfig
 import json_repair
 
 from pydantic import Field
+
+try:
+    import numpy as np
+except ImportError:  # numpy 是可选依赖，只用来加速批量预测；没有时退回逐项计算。
+    np = None
+try:
+    import redis
+except ImportError:  # redis 只在 state_backend=redis 时需要。
+    redis = None
 from pydantic.dataclasses import dataclass
 
 from astrbot.core.agent.run_context import ContextWrapper
 from astrbot.core.agent.tool import FunctionTool, ToolExecResult
 from astrbot.core.astr_agent_context import AstrAgentContext
 
+class SystemClock:
+    """状态引擎使用的时钟，默认就是墙钟。"""
+
+    def now(self) -> float:
+        return time.time()
+
+
+class VirtualClock(SystemClock):
+    """可手动推进的虚拟时钟，用于模拟长时间跨度的状态推进和冷却，不必真实等待。"""
+
+    def __init__(self, start: Optional[float] = None):
+        self.current = time.time() if start is None else float(start)
+
+    def now(self) -> float:
+        return self.current
+
+    def advance(self, seconds: float) -> float:
+        self.current += max(0.0, float(seconds))
+        return self.current
+
+    def set(self, timestamp: float) -> None:
+        self.current = float(timestamp)
+
+
+class HotPathLogger:
+    """热路径上的结构化日志：按级别开关、按比例采样、惰性格式化、截断长载荷。
+
+    每次 LLM 请求都会经过的调试日志（观察者缓冲区、上一条会话历史、新状态全文）如果直接用
+    INFO + f-string 打印，格式化和写盘本身就会成为 CPU 热点。这里先判断级别和采样，
+    命中后才调用 payload_factory 生成内容，再截断到 max_chars。
+    """
+
+    LEVELS = {"debug": logging.DEBUG, "info": logging.INFO}
+
+    def __init__(self, level: str = "debug", sample_rate: float = 1.0, max_chars: int = 500):
+        self.level = self.LEVELS.get(str(level).strip().lower())
+        self.sample_rate = min(1.0, max(0.0, float(sample_rate)))
+        self.max_chars = max(0, int(max_chars))
+
+    def log(self, event_name: str, payload_factory: Callable[[], Any]) -> None:
+        if self.level is None or not logger.isEnabledFor(self.level):
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            return
+
+        payload = payload_factory()
+        if isinstance(payload, str):
+            payload_text = payload
+        else:
+            payload_text = json.dumps(payload, ensure_ascii=False, separators=(",", ":"), default=str)
+        if self.max_chars and len(payload_text) > self.max_chars:
+            payload_text = f"{payload_text[:self.max_chars]}…(+{len(payload_text) - self.max_chars} chars)"
+        logger.log(self.level, "[LivelyState] %s %s", event_name, payload_text)
+
+
+class PluginMetrics:
+    """进程内的耗时分布与计数器。
+
+    每个阶段保留最近 RESERVOIR_SIZE 个耗时样本用来算 p50/p95/p99，同时累计总次数和总耗时；
+    计数器记录冷却拒绝、解析失败、总结失败、缓存命中等离散事件。
+    既可以通过 `/state_metrics` 查看，也可以导出成 Prometheus 文本格式写到数据目录。
+    """
+
+    RESERVOIR_SIZE = 1024
+    RECENT_SPAN_LIMIT = 256
+
+    def __init__(self):
+        self.samples: Dict[str, deque] = {}
+        self.totals: Dict[str, Tuple[int, float]] = {}
+        self.counters: Dict[str, int] = {}
+        # 事件循环看门狗开启时记录最近的 (阶段, 开始, 结束)，用于把阻塞片段归因到具体阶段。
+        self.track_spans = False
+        self.recent_spans: deque = deque(maxlen=self.RECENT_SPAN_LIMIT)
+        self.open_spans: Dict[int, Tuple[str, float]] = {}
+        self._span_seq = 0
+
+    @contextmanager
+    def span(self, stage: str, blocking: bool = True):
+        """记录一个阶段的耗时。
+
+        内部有 await 的阶段要传 blocking=False：它们挂起等待期间事件循环在跑别的协程，
+        不能参与看门狗的阻塞归因，否则会把别人的阻塞算到自己头上。
+        """
+        started = time.perf_counter()
+        span_id = None
+        if self.track_spans and blocking:
+            self._span_seq += 1
+            span_id = self._span_seq
+            self.open_spans[span_id] = (stage, started)
+        try:
+            yield
+        finally:
+            finished = time.perf_counter()
+            if span_id is not None:
+                self.open_spans.pop(span_id, None)
+                self.recent_spans.append((stage, started, finished))
+            self.observe(stage, (finished - started) * 1000)
+
+    def observe(self, stage: str, duration_ms: float) -> None:
+        stage_samples = self.samples.get(stage)
+        if stage_samples is None:
+            stage_samples = self.samples[stage] = deque(maxlen=self.RESERVOIR_SIZE)
+        stage_samples.append(duration_ms)
+        count, total_ms = self.totals.get(stage, (0, 0.0))
+        self.totals[stage] = (count + 1, total_ms + duration_ms)
+
+    def increment(self, counter_name: str, amount: int = 1) -> None:
+        self.counters[counter_name] = self.counters.get(counter_name, 0) + amount
+
+    @staticmethod
+    def _percentile(sorted_samples: List[float], quantile: float) -> float:
+        if not sorted_samples:
+            return 0.0
+        index = min(len(sorted_samples) - 1, max(0, math.ceil(quantile * len(sorted_samples)) - 1))
+        return sorted_samples[index]
+
+    def snapshot(self) -> Dict[str, Any]:
+        stages: Dict[str, Dict[str, float]] = {}
+        for stage, stage_samples in sorted(self.samples.items()):
+            sorted_samples = sorted(stage_samples)
+            count, total_ms = self.totals[stage]
+            stages[stage] = {
+                "count": count,
+                "mean_ms": round(total_ms / count, 3) if count else 0.0,
+                "p50_ms": round(self._percentile(sorted_samples, 0.50), 3),
+                "p95_ms": round(self._percentile(sorted_samples, 0.95), 3),
+                "p99_ms": round(self._percentile(sorted_samples, 0.99), 3),
+                "max_ms": round(sorted_samples[-1], 3) if sorted_samples else 0.0,
+            }
+        return {
+            "stages": stages,
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def to_prometheus(self) -> str:
+        """导出成 Prometheus 文本格式：阶段耗时用 summary，计数器用 counter。"""
+        lines = [
+            "# HELP livelystate_stage_duration_ms LivelyState per-stage latency in milliseconds.",
+            "# TYPE livelystate_stage_duration_ms summary",
+        ]
+        for stage, stage_samples in sorted(self.samples.items()):
+            sorted_samples = sorted(stage_samples)
+            count, total_ms = self.totals[stage]
+            for quantile in (0.5, 0.95, 0.99):
+                lines.append(
+                    f'livelystate_stage_duration_ms{{stage="{stage}",quantile="{quantile}"}} '
+                    f"{self._percentile(sorted_samples, quantile):.3f}"
+                )
+            lines.append(f'livelystate_stage_duration_ms_sum{{stage="{stage}"}} {total_ms:.3f}')
+            lines.append(f'livelystate_stage_duration_ms_count{{stage="{stage}"}} {count}')
+
+        lines.extend([
+            "# HELP livelystate_events_total LivelyState event counters.",
+            "# TYPE livelystate_events_total counter",
+        ])
+        for counter_name, value in sorted(self.counters.items()):
+            lines.append(f'livelystate_events_total{{event="{counter_name}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus_file(self, path: Path) -> None:
+        temp_path = path.with_suffix(path.suffix + ".tmp")
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(self.to_prometheus(), encoding="utf-8")
+            temp_path.replace(path)
+        except OSError as e:
+            logger.warning(f"Failed to write Prometheus metrics file: {e}")
+
+
+class LoopWatchdog:
+    """事件循环阻塞看门狗。
+
+    后台协程每隔 interval_sec 醒来一次，实际醒来时间比预期晚多少就是这段时间里事件循环被同步代码
+    占住的时长。超过阈值时，在 PluginMetrics 记录的阶段区间里找与这段窗口重叠最多、且最内层的阶段，
+    认定为阻塞来源并计数、记日志；没有重叠的阻塞多半来自其他插件，只计数不告警。
+    """
+
+    def __init__(self, metrics: PluginMetrics, interval_sec: float = 0.1, threshold_ms: float = 100.0):
+        self.metrics = metrics
+        self.interval_sec = max(0.01, float(interval_sec))
+        self.threshold_ms = max(1.0, float(threshold_ms))
+        self.last_blocks: deque = deque(maxlen=20)
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self.metrics.track_spans = True
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        self.metrics.track_spans = False
+
+    async def _run(self):
+        while True:
+            expected_wake = time.perf_counter() + self.interval_sec
+            await asyncio.sleep(self.interval_sec)
+            actual_wake = time.perf_counter()
+            lag_ms = (actual_wake - expected_wake) * 1000
+            self.metrics.observe("loop.lag", max(0.0, lag_ms))
+            if lag_ms >= self.threshold_ms:
+                self.record_block(expected_wake, actual_wake)
+
+    def attribute(self, window_start: float, window_end: float) -> str:
+        """按阶段的“自身时间”归因：外层阶段（如 add_state.total）扣掉内层阶段覆盖的部分后再比较。"""
+        spans = list(self.metrics.recent_spans)
+        spans.extend((stage, started, window_end) for stage, started in self.metrics.open_spans.values())
+
+        def overlap_of(started: float, finished: float) -> float:
+            return max(0.0, min(finished, window_end) - max(started, window_start))
+
+        overlapping = [span for span in spans if overlap_of(span[1], span[2]) > 0]
+        exclusive_overlap: Dict[str, float] = {}
+        for index, (stage, started, finished) in enumerate(overlapping):
+            children = [
+                child for child_index, child in enumerate(overlapping)
+                if child_index != index and started <= child[1] and child[2] <= finished
+            ]
+            # 只扣直接子阶段，避免孙阶段被重复扣减。
+            direct_children = [
+                child for child in children
+                if not any(other is not child and other[1] <= child[1] and child[2] <= other[2] for other in children)
+            ]
+            own_overlap = overlap_of(started, finished) - sum(overlap_of(child[1], child[2]) for child in direct_children)
+            exclusive_overlap[stage] = exclusive_overlap.get(stage, 0.0) + max(0.0, own_overlap)
+
+        if not exclusive_overlap:
+            return ""
+        return max(exclusive_overlap.items(), key=lambda item: item[1])[0]
+
+    def record_block(self, window_start: float, window_end: float) -> str:
+        lag_ms = (window_end - window_start) * 1000
+        stage = self.attribute(window_start, window_end)
+        if not stage:
+            self.metrics.increment("loop.blocking_unattributed")
+            logger.debug(f"Event loop blocked for {lag_ms:.1f} ms outside LivelyState handlers")
+            return stage
+
+        self.metrics.increment("loop.blocking_slices")
+        self.metrics.increment(f"loop.blocking.{stage}")
+        self.last_blocks.append({"stage": stage, "lag_ms": round(lag_ms, 1), "at": round(time.time(), 3)})
+        logger.warning(f"LivelyState blocked the event loop for {lag_ms:.1f} ms in stage {stage}")
+        return stage
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "running": self._task is not None,
+            "interval_sec": self.interval_sec,
+            "threshold_ms": self.threshold_ms,
+            "last_blocks": list(self.last_blocks),
+        }
+
+
+class HandlerProfiler:
+    """按需开启的 cProfile 采样：每 N 次调用采一次，或者调用耗时超过阈值时保留。
+
+    cProfile 同一时间只能挂一个，所以并发进入的调用只有第一个会被采样，其他直接放行。
+    协程在 await 期间让出事件循环，采到的数据里会混入同时运行的其他协程，
+    看结果时以自身耗时（tottime）排序更可靠。
+    """
+
+    def __init__(
+        self,
+        output_dir: Path,
+        enabled: bool = False,
+        every_n: int = 50,
+        slow_threshold_ms: float = 0.0,
+        max_files: int = 20,
+        metrics: Optional[PluginMetrics] = None,
+    ):
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.every_n = max(0, int(every_n))
+        self.slow_threshold_ms = max(0.0, float(slow_threshold_ms))
+        self.max_files = max(1, int(max_files))
+        self.metrics = metrics or PluginMetrics()
+        self.call_counts: Dict[str, int] = {}
+        self._active = False
+
+    def _should_profile(self, handler_name: str) -> Tuple[bool, bool]:
+        """返回 (是否挂 profiler, 是否无论耗时都保留)。"""
+        call_count = self.call_counts.get(handler_name, 0) + 1
+        self.call_counts[handler_name] = call_count
+        if not self.enabled or self._active:
+            return False, False
+
+        sampled = self.every_n > 0 and call_count % self.every_n == 0
+        # 要判断“慢调用”只能先挂上 profiler，结束后再决定丢弃还是落盘。
+        return sampled or self.slow_threshold_ms > 0, sampled
+
+    @contextmanager
+    def profile(self, handler_name: str):
+        should_profile, keep_always = self._should_profile(handler_name)
+        if not should_profile:
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # 其他工具（例如外部挂上的 profiler）已经占用了 sys.setprofile。
+            yield
+            return
+
+        self._active = True
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self._active = False
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            if keep_always or (self.slow_threshold_ms > 0 and elapsed_ms >= self.slow_threshold_ms):
+                self._dump(profiler, handler_name, elapsed_ms)
+
+    def _dump(self, profiler: cProfile.Profile, handler_name: str, elapsed_ms: float) -> None:
+        timestamp = time.time()
+        file_name = (
+            f"{handler_name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(timestamp))}"
+            f"-{int(timestamp * 1000) % 1000:03d}-{elapsed_ms:.0f}ms.pstats"
+        )
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            profiler.dump_stats(str(self.output_dir / file_name))
+        except OSError as e:
+            logger.warning(f"Failed to write profile for {handler_name}: {e}")
+            return
+
+        self.metrics.increment("profiler.dumps")
+        self._rotate()
+
+    def _rotate(self) -> None:
+        profile_files = sorted(self.output_dir.glob("*.pstats"), key=lambda path: path.stat().st_mtime)
+        for stale_file in profile_files[:-self.max_files]:
+            try:
+                stale_file.unlink()
+            except OSError:
+                pass
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "every_n": self.every_n,
+            "slow_threshold_ms": self.slow_threshold_ms,
+            "max_files": self.max_files,
+            "output_dir": str(self.output_dir),
+            "stored_profiles": len(list(self.output_dir.glob("*.pstats"))) if self.output_dir.exists() else 0,
+            "calls": dict(sorted(self.call_counts.items())),
+        }
+
+
+class TrafficRecorder:
+    """按需开启的流量录制：把 add_state 的输入和两个状态工具的参数写成紧凑的 JSONL 轨迹。
+
+    轨迹用于 benchmarks/replay_trace.py 离线回放。会话 id 和发送者名称（包括 JSON 参数里的 subject_id）
+    始终替换成带随机盐的哈希，同一轨迹内保持一致；redact_text 开启时，除了 id、数值和 ENUM_FIELDS 里的
+    规范枚举值，所有字符串都替换成等长的占位串（开头带内容哈希，保证去重行为与原文一致），只保留长度分布。
+    JSON 字符串参数（事件锚点、待办、身体档案等）按结构逐个替换叶子字符串，键名和数值保留。
+    文件头记录录制时影响回放结果的配置（replay_config），回放时默认沿用。
+    每个文件写满 max_records 条后切换到新文件。
+    """
+
+    TRACE_VERSION = 1
+    ID_FIELDS = ("context_subject_id", "target_id")
+    # 值是 JSON 字符串的参数。
+    JSON_FIELDS = ("post_event_markers", "last_event", "pending_tasks", "history_delta", "body_sheet_updates")
+    # 值属于有限枚举的参数；不在 enum_values 里的输入（例如自然语言状态）仍按自由文本处理。
+    ENUM_FIELDS = ("physical_state",)
+
+    def __init__(
+        self,
+        output_dir: Path,
+        enabled: bool = False,
+        redact_text: bool = True,
+        max_records: int = 5000,
+        enum_values: Optional[List[str]] = None,
+        replay_config: Optional[Dict[str, Any]] = None,
+        clock: Optional[SystemClock] = None,
+    ):
+        # 记录里的时间戳取自插件时钟，虚拟时钟下录出的轨迹也能按原节奏回放。
+        self.clock = clock or SystemClock()
+        self.output_dir = output_dir
+        self.enabled = enabled
+        self.redact_text = redact_text
+        self.max_records = max(1, int(max_records))
+        self.enum_values = frozenset(enum_values or ())
+        self.replay_config = dict(replay_config or {})
+        self.salt = format(random.getrandbits(64), "016x")
+        self.path: Optional[Path] = None
+        self.record_count = 0
+        self._id_map: Dict[str, str] = {}
+
+    def _sanitize_id(self, value: Any) -> Any:
+        if not isinstance(value, str) or not value or value in ("global", "none"):
+            return value
+        sanitized = self._id_map.get(value)
+        if sanitized is None:
+            sanitized = self._id_map[value] = "s_" + hashlib.sha1((self.salt + value).encode("utf-8")).hexdigest()[:12]
+        return sanitized
+
+    def _sanitize_text(self, value: Any) -> Any:
+        if not self.redact_text or not isinstance(value, str) or not value:
+            return value
+        digest = hashlib.sha1((self.salt + value).encode("utf-8")).hexdigest()[:8]
+        placeholder = f"<{digest}>"
+        return placeholder + "x" * max(0, len(value) - len(placeholder))
+
+    def _sanitize_structure(self, value: Any) -> Any:
+        if isinstance(value, dict):
+            return {
+                key: self._sanitize_id(item) if key == "subject_id" else self._sanitize_structure(item)
+                for key, item in value.items()
+            }
+        if isinstance(value, list):
+            return [self._sanitize_structure(item) for item in value]
+        return self._sanitize_text(value)
+
+    def _sanitize_json_arg(self, value: Any) -> Any:
+        if not isinstance(value, str):
+            return self._sanitize_structure(value)
+        try:
+            parsed = json.loads(value)
+        except ValueError:
+            # 模型偶尔传来不合法的 JSON，整体按自由文本处理。
+            return self._sanitize_text(value)
+        return json.dumps(self._sanitize_structure(parsed), ensure_ascii=False)
+
+    def _sanitize_tool_args(self, tool_args: Dict[str, Any]) -> Dict[str, Any]:
+        sanitized: Dict[str, Any] = {}
+        for key, value in tool_args.items():
+            if value is None or key == "LastUpdateTime":
+                continue
+            if key in self.ID_FIELDS:
+                value = self._sanitize_id(value)
+            elif key in self.JSON_FIELDS:
+                value = self._sanitize_json_arg(value)
+            elif key in self.ENUM_FIELDS and value in self.enum_values:
+                pass
+            else:
+                value = self._sanitize_text(value)
+            sanitized[key] = value
+        return sanitized
+
+    def _open_new_file(self) -> None:
+        self.path = self.output_dir / f"trace-{time.strftime('%Y%m%d-%H%M%S')}-{self.salt[:6]}.jsonl"
+        self.record_count = 0
+        self._write({"kind": "header", "version": self.TRACE_VERSION, "t": self.clock.now(), "config": self.replay_config})
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        try:
+            self.output_dir.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as trace_file:
+                trace_file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to write traffic trace: {e}")
+            self.enabled = False
+
+    def _append(self, record: Dict[str, Any]) -> None:
+        if self.path is None or self.record_count >= self.max_records:
+            self._open_new_file()
+        self._write(record)
+        self.record_count += 1
+
+    def record_add_state(
+        self,
+        uid: str,
+        sender_name: str,
+        message: str,
+        last_reply: Optional[str],
+        prompt: str,
+        system_prompt: str,
+    ) -> None:
+        if not self.enabled:
+            return
+        record = {
+            "kind": "add_state",
+            "t": round(self.clock.now(), 3),
+            "uid": self._sanitize_id(uid),
+            "sender": self._sanitize_id(sender_name),
+            "message": self._sanitize_text(message),
+            "prompt": self._sanitize_text(prompt),
+            "system_prompt": self._sanitize_text(system_prompt),
+        }
+        if last_reply is not None:
+            record["reply"] = self._sanitize_text(last_reply)
+        self._append(record)
+
+    def record_tool_call(
+        self,
+        tool_name: str,
+        uid: str,
+        tool_args: Dict[str, Any],
+        outcome: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        if not self.enabled:
+            return
+        record = {
+            "kind": tool_name,
+            "t": round(self.clock.now(), 3),
+            "uid": self._sanitize_id(uid),
+            "args": self._sanitize_tool_args(tool_args),
+        }
+        if outcome:
+            # 只记录结构化的结果分类（见 LivelyState._classify_apply_report），不写报告原文。
+            record["outcome"] = outcome
+        self._append(record)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "redact_text": self.redact_text,
+            "path": str(self.path) if self.path else "",
+            "records_in_file": self.record_count,
+        }
+
+
+class ContextExpiryQueue:
+    """上下文锚点（post_event_markers / pending_tasks / last_event）到期时间的最小堆，供后台批量清理。
+
+    堆里存 (到期时间, 序号, 状态对象的弱引用)，每个状态只认最近一次登记的最早到期时间；
+    旧条目出堆时直接跳过（惰性删除），重新登记不需要在堆里查找。分片被淘汰后弱引用失效，对应条目自然作废。
+    """
+
+    def __init__(self):
+        self._heap: List[Tuple[float, int, "weakref.ref[CharacterState]"]] = []
+        self._due: "weakref.WeakKeyDictionary[CharacterState, float]" = weakref.WeakKeyDictionary()
+        self._sequence = 0
+
+    def __len__(self) -> int:
+        return len(self._due)
+
+    def schedule(self, owner: "CharacterState", due_at: Optional[float]) -> None:
+        if due_at is None:
+            self._due.pop(owner, None)
+            return
+        if self._due.get(owner) == due_at:
+            return
+        self._due[owner] = due_at
+        self._sequence += 1
+        heapq.heappush(self._heap, (due_at, self._sequence, weakref.ref(owner)))
+        # 作废条目太多时整体重建一次，避免频繁改期的状态把堆撑大。
+        if len(self._heap) > 4 * len(self._due) + 64:
+            self._heap = [entry for entry in self._heap if entry[2]() is not None and self._due.get(entry[2]()) == entry[0]]
+            heapq.heapify(self._heap)
+
+    def next_due(self) -> Optional[float]:
+        while self._heap:
+            due_at, _, owner_ref = self._heap[0]
+            owner = owner_ref()
+            if owner is not None and self._due.get(owner) == due_at:
+                return due_at
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now: float) -> List["CharacterState"]:
+        due_owners = []
+        while self._heap and self._heap[0][0] <= now:
+            due_at, _, owner_ref = heapq.heappop(self._heap)
+            owner = owner_ref()
+            if owner is None or self._due.get(owner) != due_at:
+                continue
+            del self._due[owner]
+            due_owners.append(owner)
+        return due_owners
+
+
 class CharacterState:
     # 这组状态是当前插件认可的“唯一全局身体状态集合”。
     # 目的不是把角色写死，而是把 physical_state 从自由文本收敛为有限状态，
@@ -123,17 +716,67 @@ class CharacterState:
         "路上": "Traveling",
     }
 
-    def __init__(self, update_interval_sec: int = 300, active_state_timeout_sec: int = 1800):
-        self.path = StarTools.get_data_dir() / f"global_state.json"
+    _TEMPLATE_CACHE: Dict[str, Tuple[float, Dict[str, Any]]] = {}
+
+    # 可以带到期时间的上下文锚点字段；到期时间记在内部字段 _context_expiry 里。
+    CONTEXT_EXPIRY_FIELDS = ("post_event_markers", "pending_tasks", "last_event")
+    CONTEXT_LIST_FIELDS = ("post_event_markers", "pending_tasks")
+    # 模型逐条指定存活时长时使用的键（分钟）；pending_tasks 习惯写成 due_in_min。
+    CONTEXT_TTL_KEYS = ("ttl_min", "due_in_min")
+
+    def __init__(
+        self,
+        update_interval_sec: int = 300,
+        active_state_timeout_sec: int = 1800,
+        metrics: Optional[PluginMetrics] = None,
+        clock: Optional[SystemClock] = None,
+        persist: bool = True,
+        timeline: Optional["StateTimeline"] = None,
+        path: Optional[Path] = None,
+        write_back: bool = False,
+        template_path: Optional[Path] = None,
+        state_machine: Optional[Dict[str, Dict[str, Any]]] = None,
+        state_aliases: Optional[Dict[str, str]] = None,
+        store: Optional["RedisStateStore"] = None,
+        context_ttl_sec: Optional[Dict[str, float]] = None,
+        context_max_items: int = 0,
+        expiry_queue: Optional[ContextExpiryQueue] = None,
+    ):
+        self.path = path or StarTools.get_data_dir() / f"global_state.json"
+        self.metrics = metrics or PluginMetrics()
+        self.clock = clock or SystemClock()
+        # persist=False 时状态只保存在内存里，模拟大量时间推进时不必每步读写文件。
+        self.persist = persist
+        self._memory_state: Optional[Dict[str, Any]] = None
+        # write_back=True 时首次读取后状态常驻内存，save 只标记为脏，由 flush 统一落盘（StateManager 的分片使用）。
+        self.write_back = write_back
+        self._dirty = False
+        # 可选的共享存储后端（多节点部署）；设置后不再读写本地文件，也不使用写回。
+        self.store = store
+        # 可选的状态时间序列；每次写入状态都记一条样本。
+        self.timeline = timeline
         # 这是给用户手写 Body_Sheet / History 初始字段的固定模板文件。
         # 把模板从代码里拆出来后，后续扩字段不需要再改 main.py。
-        self.template_path = Path(__file__).with_name("state_profile_template.json")
+        self.template_path = template_path or Path(__file__).with_name("state_profile_template.json")
+        # 多角色可以各自带一套状态机；不传时沿用类上的默认定义。
+        if state_machine is not None:
+            self.STATE_MACHINE = state_machine
+        if state_aliases is not None:
+            self.STATE_ALIASES = state_aliases
         # 这里限制一个最小步长，是为了避免状态每次读取都发生细碎抖动，
         # 否则全局状态会因为请求过于频繁而显得不稳定。
         self.update_interval_sec = max(60, int(update_interval_sec))
         # 持续中的动作不能无限挂着；超过这个时间后自动回落到 Idle，
         # 用确定性规则兜底，避免模型忘记更新状态时出现“永远在跑步”。
         self.active_state_timeout_sec = max(self.update_interval_sec, int(active_state_timeout_sec))
+        # 上下文锚点默认不过期；按字段配置默认存活时长（秒），模型也可以逐条指定。
+        self.context_ttl_sec = {
+            field_name: max(0.0, float((context_ttl_sec or {}).get(field_name, 0) or 0))
+            for field_name in self.CONTEXT_EXPIRY_FIELDS
+        }
+        # post_event_markers / pending_tasks 去重后最多保留的条数，超出时保留最新的；0 表示不限制。
+        self.context_max_items = max(0, int(context_max_items))
+        self.expiry_queue = expiry_queue
 
     def load_profile_template(self) -> Dict[str, Any]:
         """读取可编辑的长期事实模板文件。
@@ -146,27 +789,41 @@ class CharacterState:
             "History": {},
         }
 
-        if not self.template_path.exists():
-            return fallback_template
-
         try:
-            template_data = json_repair.loads(self.template_path.read_text(encoding="utf-8"))
-        except Exception as e:
-            logger.warning(f"Failed to parse profile template, using fallback template. Error: {e}")
+            template_mtime = self.template_path.stat().st_mtime
+        except OSError:
             return fallback_template
 
-        if not isinstance(template_data, dict):
-            return fallback_template
+        # 模板按 (路径, mtime) 缓存在类上：_normalize_state 每次都要用到模板，
+        # 同一份模板文件的解析结果在全局状态、各分片和各角色之间共享。
+        cache_key = str(self.template_path)
+        cached_entry = self._TEMPLATE_CACHE.get(cache_key)
+        if cached_entry is None or cached_entry[0] != template_mtime:
+            try:
+                template_data = json_repair.loads(self.template_path.read_text(encoding="utf-8"))
+            except Exception as e:
+                logger.warning(f"Failed to parse profile template, using fallback template. Error: {e}")
+                return fallback_template
+
+            if not isinstance(template_data, dict):
+                return fallback_template
+
+            cached_entry = self._TEMPLATE_CACHE[cache_key] = (template_mtime, {
+                "Body_Sheet": self.normalize_body_sheet(template_data.get("Body_Sheet", {})),
+                "History": self.normalize_history(template_data.get("History", {})),
+            })
 
+        # 返回副本，调用方把模板骨架直接放进状态里，不能让后续修改污染缓存。
+        cached_template = cached_entry[1]
         return {
-            "Body_Sheet": self.normalize_body_sheet(template_data.get("Body_Sheet", {})),
-            "History": self.normalize_history(template_data.get("History", {})),
+            "Body_Sheet": {part_name: dict(attributes) for part_name, attributes in cached_template["Body_Sheet"].items()},
+            "History": dict(cached_template["History"]),
         }
 
     
     def default_state(self) -> Dict[str, Any]:
         profile_template = self.load_profile_template()
-        current_time = time.time()
+        current_time = self.clock.now()
         return {
             "LastUpdateTime": current_time,
             "updated_at": self.format_timestamp(current_time),
@@ -189,6 +846,10 @@ class CharacterState:
             # 单独记录是为了避免自然状态推进刷新 LastUpdateTime 后，误伤真正的工具冷却逻辑。
             "_last_fast_state_update_time": 0.0,
             "_last_body_sheet_update_time": 0.0,
+            # 进入当前 physical_state 的时间；持续状态的自动回退从这里开始计时，不随自然流转刷新。
+            "_physical_state_since": current_time,
+            # 上下文锚点的到期时间：{"post_event_markers": {文本: 时间戳}, "pending_tasks": {...}, "last_event": 时间戳}。
+            "_context_expiry": {},
         }
 
     def normalize_body_sheet(self, body_sheet: Any) -> Dict[str, Dict[str, str]]:
@@ -264,6 +925,141 @@ class CharacterState:
 
         return normalized
 
+    def normalize_context_list(self, values: Any) -> List[str]:
+        """post_event_markers / pending_tasks 在 normalize_text_list 的基础上去重，并按 context_max_items 保留最新的几条。"""
+        normalized = list(dict.fromkeys(self.normalize_text_list(values)))
+        if self.context_max_items and len(normalized) > self.context_max_items:
+            normalized = normalized[-self.context_max_items:]
+        return normalized
+
+    def _context_item_ttl_sec(self, item: Dict[str, Any]) -> Optional[float]:
+        for ttl_key in self.CONTEXT_TTL_KEYS:
+            if ttl_key in item:
+                try:
+                    return max(0.0, float(item[ttl_key]) * 60)
+                except (TypeError, ValueError):
+                    return None
+        return None
+
+    def merge_context_list(
+        self,
+        field_name: str,
+        items: List[Any],
+        current_values: List[str],
+        current_expiry: Dict[str, float],
+        now: float,
+    ) -> Tuple[List[str], Dict[str, float]]:
+        """把工具传入的新列表整理成 (文本列表, 到期时间)。
+
+        条目可以是字符串，也可以是 `{"text": ..., "ttl_min": ...}`（pending_tasks 也可写 `due_in_min`）。
+        显式给出的时长优先，`0` 表示不过期；沿用的旧条目保留原到期时间，不会因为模型重复列出而续期；
+        新条目使用该字段的默认时长。
+        """
+        texts: List[str] = []
+        expiry: Dict[str, float] = {}
+        for item in items:
+            ttl_sec = None
+            if isinstance(item, dict):
+                ttl_sec = self._context_item_ttl_sec(item)
+                item = item.get("text", item.get("content"))
+            text = str(item).strip() if item is not None else ""
+            if not text:
+                continue
+            texts.append(text)
+            if ttl_sec is not None:
+                due_at = now + ttl_sec if ttl_sec > 0 else None
+            elif text in current_expiry:
+                due_at = current_expiry[text]
+            elif text not in current_values and self.context_ttl_sec[field_name] > 0:
+                due_at = now + self.context_ttl_sec[field_name]
+            else:
+                due_at = None
+            if due_at is None:
+                expiry.pop(text, None)
+            else:
+                expiry[text] = due_at
+
+        texts = self.normalize_context_list(texts)
+        return texts, {text: expiry[text] for text in texts if text in expiry}
+
+    def pop_last_event_ttl_sec(self, last_event: Any) -> Optional[float]:
+        """从工具传入的 last_event 里取出并移除 ttl_min，避免它被当成事件字段存下来。"""
+        if not isinstance(last_event, dict):
+            return None
+        ttl_sec = self._context_item_ttl_sec(last_event)
+        for ttl_key in self.CONTEXT_TTL_KEYS:
+            last_event.pop(ttl_key, None)
+        return ttl_sec
+
+    def normalize_context_expiry(self, value: Any, state: Dict[str, Any]) -> Dict[str, Any]:
+        """只保留 state 里仍存在的条目的到期时间。"""
+        if not isinstance(value, dict):
+            return {}
+
+        normalized: Dict[str, Any] = {}
+        for field_name in self.CONTEXT_LIST_FIELDS:
+            entries = value.get(field_name)
+            if not isinstance(entries, dict):
+                continue
+            present = set(state[field_name])
+            kept = {}
+            for text, due_at in entries.items():
+                if text in present and isinstance(due_at, (int, float)) and not isinstance(due_at, bool):
+                    kept[text] = float(due_at)
+            if kept:
+                normalized[field_name] = kept
+
+        due_at = value.get("last_event")
+        if state["last_event"] and isinstance(due_at, (int, float)) and not isinstance(due_at, bool):
+            normalized["last_event"] = float(due_at)
+        return normalized
+
+    def prune_expired_context(self, state: Dict[str, Any], now: float) -> int:
+        """就地移除已经到期的上下文锚点，返回移除的条数。"""
+        context_expiry = state.get("_context_expiry")
+        if not context_expiry:
+            return 0
+
+        remaining: Dict[str, Any] = {}
+        pruned_count = 0
+        for field_name in self.CONTEXT_LIST_FIELDS:
+            entries = context_expiry.get(field_name) or {}
+            expired = {text for text, due_at in entries.items() if due_at <= now}
+            if expired:
+                state[field_name] = [text for text in state[field_name] if text not in expired]
+                pruned_count += len(expired)
+            kept = {text: due_at for text, due_at in entries.items() if text not in expired}
+            if kept:
+                remaining[field_name] = kept
+
+        due_at = context_expiry.get("last_event")
+        if due_at is not None:
+            if due_at <= now:
+                state["last_event"] = {}
+                pruned_count += 1
+            else:
+                remaining["last_event"] = due_at
+
+        if pruned_count:
+            state["_context_expiry"] = remaining
+            self.metrics.increment("state.context_expired", pruned_count)
+        return pruned_count
+
+    def next_context_expiry(self, state: Dict[str, Any]) -> Optional[float]:
+        context_expiry = state.get("_context_expiry") or {}
+        due_times = [
+            due_at
+            for field_name in self.CONTEXT_LIST_FIELDS
+            for due_at in (context_expiry.get(field_name) or {}).values()
+        ]
+        if context_expiry.get("last_event") is not None:
+            due_times.append(context_expiry["last_event"])
+        return min(due_times) if due_times else None
+
+    def _schedule_context_expiry(self, state: Dict[str, Any]) -> None:
+        if self.expiry_queue is not None:
+            self.expiry_queue.schedule(self, self.next_context_expiry(state))
+
     def normalize_subject_id(
         self,
         value: Any,
@@ -441,11 +1237,11 @@ class CharacterState:
                 fallback=default_state["context_subject_id"],
             ),
             "location": _safe_optional_text(state.get("location"), default_state["location"]),
-            "post_event_markers": self.normalize_text_list(
+            "post_event_markers": self.normalize_context_list(
                 state.get("post_event_markers", default_state["post_event_markers"])
             ),
             "last_event": self.normalize_last_event(state.get("last_event", default_state["last_event"])),
-            "pending_tasks": self.normalize_text_list(
+            "pending_tasks": self.normalize_context_list(
                 state.get("pending_tasks", default_state["pending_tasks"])
             ),
             "update_reason": _safe_text(state.get("update_reason"), default_state["update_reason"]),
@@ -467,6 +1263,7 @@ class CharacterState:
             "_last_fast_state_update_time": _safe_float(state.get("_last_fast_state_update_time"), 0.0),
             "_last_body_sheet_update_time": _safe_float(state.get("_last_body_sheet_update_time"), 0.0),
         }
+        normalized["_context_expiry"] = self.normalize_context_expiry(state.get("_context_expiry"), normalized)
 
         try:
             normalized["LastUpdateTime"] = float(state.get("LastUpdateTime", default_state["LastUpdateTime"]))
@@ -474,6 +1271,8 @@ class CharacterState:
             normalized["LastUpdateTime"] = default_state["LastUpdateTime"]
 
         normalized["updated_at"] = self.format_timestamp(normalized["LastUpdateTime"])
+        # 旧状态没有这个字段时按 LastUpdateTime 处理，与之前“从上次更新起算超时”的行为一致。
+        normalized["_physical_state_since"] = _safe_float(state.get("_physical_state_since"), normalized["LastUpdateTime"])
 
         return normalized
 
@@ -496,7 +1295,18 @@ class CharacterState:
         return current_emotion
 
     def get_whole_state(self, enable_update: bool = True):
-        if not self.path.exists():
+        if self.store is not None:
+            state = self.store.load()
+            if state is None:
+                state = self.default_state()
+                # 读路径上的写回都是尽力而为：其他节点抢先建好了状态也没关系，下一次读取会拿到它。
+                self.save(state, progression=True)
+                return state
+        elif not self.persist or (self.write_back and self._memory_state is not None):
+            state = self._memory_state if self._memory_state is not None else self.default_state()
+            if self._memory_state is None:
+                self.save(state)
+        elif not self.path.exists():
             # File doesn't exist, create with default state
             state = self.default_state()
             self.save(state)
@@ -504,30 +1314,114 @@ class CharacterState:
         else:
             # File exists, read it
             try:
-                state = json_repair.loads(self.path.read_text(encoding="utf-8"))
+                with self.metrics.span("state.read"):
+                    state = json_repair.loads(self.path.read_text(encoding="utf-8"))
+                if self.write_back:
+                    self._memory_state = state
             except Exception as e:
                 logger.error(f"Failed to parse state file, using default state. Error: {e}")
+                self.metrics.increment("state.file_parse_failures")
                 state = self.default_state()
                 self.save(state)
                 return state
 
-        normalized_state = self._normalize_state(state)
-        if normalized_state != state:
-            self.save(normalized_state)
+        with self.metrics.span("state.normalize"):
+            normalized_state = self._normalize_state(state)
+            # 到期的上下文锚点在读取时顺手清掉，并随规范化结果一起写回。
+            self.prune_expired_context(normalized_state, self.clock.now())
+            if normalized_state != state:
+                # 规范化和过期清理是确定性的，写回冲突时放弃即可，不能让读取方收到 StateConflictError。
+                self.save(normalized_state, progression=True)
+            else:
+                self._schedule_context_expiry(normalized_state)
 
         if enable_update:
-            return self.update(time.time(), state=normalized_state)
+            with self.metrics.span("state.update"):
+                return self.update(self.clock.now(), state=normalized_state)
 
         return normalized_state
 
-    def save(self,state):
-        self.path.parent.mkdir(parents=True, exist_ok=True)
-        self.path.write_text(json.dumps(state, ensure_ascii=False, indent=2))
+    def save(self, state, progression: bool = False):
+        if self.store is not None:
+            if not self.store.save(state, progression=progression):
+                # 共享存储放弃了这次写入（冲突或 Redis 异常），时间线和过期调度都不能记录没写进去的状态。
+                return
+        elif not self.persist:
+            self._memory_state = state
+        elif self.write_back:
+            self._memory_state = state
+            self._dirty = True
+        else:
+            self._write_file(state)
+
+        self._schedule_context_expiry(state)
+        if self.timeline is not None:
+            # 来源由调用方显式给出：工具更新不带 update_reason 时会沿用上一次自然流转的说明，不能据此判断。
+            self.timeline.append(
+                self.clock.now(),
+                state,
+                StateTimeline.SOURCE_PROGRESSION if progression else StateTimeline.SOURCE_COMMIT,
+            )
+
+    def _write_file(self, state: Dict[str, Any]) -> None:
+        with self.metrics.span("state.save"):
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_text(json.dumps(state, ensure_ascii=False, indent=2))
+
+    @property
+    def dirty(self) -> bool:
+        return self._dirty
+
+    def flush(self) -> None:
+        """write_back 模式下把内存里的状态写回文件；没有未落盘的修改时什么都不做。"""
+        if self.persist and self._dirty and self._memory_state is not None:
+            self._write_file(self._memory_state)
+        self._dirty = False
+
+    def close(self) -> None:
+        """写回未落盘的修改并关闭时间线；分片被淘汰、角色被卸载和插件停用时调用。"""
+        self.flush()
+        if self.timeline is not None:
+            self.timeline.close()
 
     def delete(self):
-        if self.path.exists():
+        self._memory_state = None
+        self._dirty = False
+        if self.store is not None:
+            self.store.delete()
+            return
+        if self.persist and self.path.exists():
             self.path.unlink()
 
+    def progression_schedule(
+        self,
+        physical_state: str,
+        state_since: float,
+        last_update_time: float,
+        until: float,
+    ) -> List[Tuple[str, int, float]]:
+        """把自然流转按自动回退切成分段，返回 [(状态, 起始步数, 进入该状态的时间)]。
+
+        步数从 last_update_time 起按 update_interval_sec 计；第 i 段从它的起始步开始使用该状态的增量，
+        直到下一段的起始步。持续状态在进入后 active_state_timeout_sec 回退，回退状态若本身也有超时则继续展开，
+        只展开到 until 为止。分段只取决于绝对时间，所以一次跨越很久读取和中途多次读取得到的轨迹相同。
+        """
+        interval = self.update_interval_sec
+        physical_state = self.normalize_physical_state(physical_state)
+        schedule = [(physical_state, 0, float(state_since))]
+        while True:
+            fallback_state = self.get_state_meta(physical_state).get("auto_fallback")
+            if not fallback_state or fallback_state == physical_state:
+                break
+            fallback_at = state_since + self.active_state_timeout_sec
+            if fallback_at > until:
+                break
+            # 结束时间不晚于回退时刻的步仍按原状态计算。
+            start_step = max(schedule[-1][1], int((fallback_at - last_update_time) // interval))
+            physical_state, state_since = self.normalize_physical_state(fallback_state), fallback_at
+            schedule.append((physical_state, start_step, state_since))
+        return schedule
+
     def update(self, current_time: Optional[float] = None, enable_update: bool = True, state: Optional[Dict[str, Any]] = None):
         """按时间推进状态。
 
@@ -539,57 +1433,1755 @@ class CharacterState:
             return state if state is not None else self.get_whole_state(enable_update=False)
 
         current_state = self._normalize_state(state if state is not None else self.get_whole_state(enable_update=False))
-        now = current_time or time.time()
+        now = self.clock.now() if current_time is None else current_time
         elapsed = max(0, now - current_state["LastUpdateTime"])
         steps = int(elapsed // self.update_interval_sec)
+        schedule = self.progression_schedule(
+            current_state["physical_state"],
+            current_state["_physical_state_since"],
+            current_state["LastUpdateTime"],
+            now,
+        )
+        physical_state, _, physical_state_since = schedule[-1]
 
-        if steps <= 0:
+        if steps <= 0 and physical_state == current_state["physical_state"]:
             return current_state
 
         next_state = dict(current_state)
-        state_meta = self.get_state_meta(next_state["physical_state"])
         # 显式状态机让每个状态的数值演化规则可控，
         # 避免“Running”“Workout”“在路上”这种自由文本在不同会话里各算各的。
-        thirst_delta = steps * int(state_meta.get("thirst_delta", 1))
-        energy_delta = steps * int(state_meta.get("energy_delta", 0))
-
-        next_state["energy_level"] = max(0, min(100, next_state["energy_level"] + energy_delta))
-        next_state["thirst"] = max(0, min(100, next_state["thirst"] + thirst_delta))
+        # 持续状态超时后按回退状态的增量继续推进，所以要按分段逐段累加，每段结束时截断到 0-100。
+        for segment_index, (segment_state, start_step, _) in enumerate(schedule):
+            end_step = schedule[segment_index + 1][1] if segment_index + 1 < len(schedule) else steps
+            if end_step <= start_step:
+                continue
+            state_meta = self.get_state_meta(segment_state)
+            segment_steps = end_step - start_step
+            next_state["energy_level"] = max(0, min(100, next_state["energy_level"] + segment_steps * int(state_meta.get("energy_delta", 0))))
+            next_state["thirst"] = max(0, min(100, next_state["thirst"] + segment_steps * int(state_meta.get("thirst_delta", 1))))
 
-        fallback_state = state_meta.get("auto_fallback")
         # 对持续状态设置自动回退，是因为真正的目标不是“记住一个词”，
         # 而是维护一条连续、可信的身体轨迹。
-        if fallback_state and elapsed >= self.active_state_timeout_sec:
-            next_state["physical_state"] = fallback_state
+        next_state["physical_state"] = physical_state
+        next_state["_physical_state_since"] = physical_state_since
 
         next_state["emotion"] = self._derive_emotion(next_state)
         next_state["LastUpdateTime"] = min(now, current_state["LastUpdateTime"] + steps * self.update_interval_sec)
         next_state["updated_at"] = self.format_timestamp(next_state["LastUpdateTime"])
         next_state["update_reason"] = "Natural time-based progression"
 
-        if next_state != current_state:
-            self.save(next_state)
+        if next_state != current_state:
+            self.save(next_state, progression=True)
+
+        return next_state
+
+class StateManager:
+    """按 subject_id 分片的独立状态，供需要“每个群 / 每个用户各一份状态”的部署使用。
+
+    每个分片是一个写回模式的 CharacterState，对应 shard_dir 下的一个 JSON 文件：
+    第一次访问某个 subject 时才创建分片，第一次读状态时才读文件；内存里最多保留 max_hot_shards 个分片，
+    按 LRU 淘汰，淘汰时把未落盘的修改写回文件。每个分片有自己的 asyncio.Lock，
+    不同 subject 的更新互不等待；持有锁的分片不会被淘汰。
+    """
+
+    def __init__(
+        self,
+        shard_dir: Path,
+        factory: Callable[[Path], CharacterState],
+        max_hot_shards: int = 64,
+        metrics: Optional[PluginMetrics] = None,
+    ):
+        self.shard_dir = shard_dir
+        self.factory = factory
+        self.max_hot_shards = max(1, int(max_hot_shards))
+        self.metrics = metrics or PluginMetrics()
+        self._shards: "OrderedDict[str, CharacterState]" = OrderedDict()
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def shard_path(self, subject_id: str) -> Path:
+        # subject_id 通常形如 aiocqhttp:GroupMessage:123，含有不能直接当文件名的字符；
+        # 文件名保留可读前缀，再加上原始 id 的哈希避免不同 id 清洗后撞名。
+        readable_prefix = re.sub(r"[^0-9A-Za-z_.-]+", "_", subject_id).strip("_")[:48] or "subject"
+        digest = hashlib.sha1(subject_id.encode("utf-8")).hexdigest()[:10]
+        return self.shard_dir / f"{readable_prefix}-{digest}.json"
+
+    def get(self, subject_id: str) -> CharacterState:
+        shard = self._shards.get(subject_id)
+        if shard is not None:
+            self._shards.move_to_end(subject_id)
+            self.metrics.increment("state_shard.hits")
+            return shard
+
+        self.metrics.increment("state_shard.loads")
+        shard = self.factory(self.shard_path(subject_id))
+        self._shards[subject_id] = shard
+        self._evict()
+        return shard
+
+    def lock(self, subject_id: str) -> asyncio.Lock:
+        lock = self._locks.get(subject_id)
+        if lock is None:
+            lock = self._locks[subject_id] = asyncio.Lock()
+        return lock
+
+    def _evict(self) -> None:
+        for subject_id in list(self._shards):
+            if len(self._shards) <= self.max_hot_shards:
+                return
+            lock = self._locks.get(subject_id)
+            if lock is not None and lock.locked():
+                continue
+            self._shards.pop(subject_id).close()
+            self._locks.pop(subject_id, None)
+            self.metrics.increment("state_shard.evictions")
+
+    def flush_all(self) -> int:
+        """把所有常驻分片的未落盘修改写回文件，返回写了几个分片。"""
+        dirty_shards = [shard for shard in self._shards.values() if shard.dirty]
+        for shard in dirty_shards:
+            shard.flush()
+        return len(dirty_shards)
+
+    def close_all(self) -> None:
+        for shard in self._shards.values():
+            shard.close()
+        self._shards.clear()
+        self._locks.clear()
+
+    def hot_shards(self) -> List[CharacterState]:
+        return list(self._shards.values())
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "hot_shards": len(self._shards),
+            "max_hot_shards": self.max_hot_shards,
+            "dirty_shards": sum(1 for shard in self._shards.values() if shard.dirty),
+            "shard_dir": str(self.shard_dir),
+        }
+
+
+class StateConflictError(RuntimeError):
+    """乐观锁冲突：读取状态之后，其他节点已经写入了新版本。"""
+
+
+class StateBackendError(RuntimeError):
+    """共享状态存储暂时不可用。"""
+
+
+class RedisStateBackend:
+    """多节点部署时共享的 Redis 连接，以及跨节点的缓存失效通知。
+
+    每个状态（全局、分片、角色）对应一个 RedisStateStore。写入成功后往 `<prefix>:invalidate` 频道发布
+    “节点 id + 状态 key”，其他节点的订阅线程据此丢掉本地缓存；订阅没有启动时 store 不缓存，每次读取都访问 Redis。
+    client 只用到 redis-py 的一小部分接口，测试时可以换成进程内的假实现（见 benchmarks/fake_redis.py）。
+
+    订阅线程遇到连接错误时不会退出，而是调用 _on_pubsub_error：先让所有 store 丢掉缓存并停止缓存，
+    重新订阅成功后再恢复。断线期间漏掉的失效通知不会让节点继续读旧缓存。
+    """
+
+    # 重新订阅失败后，订阅线程下一轮重试前等待的秒数，避免 Redis 不可用时空转。
+    RESUBSCRIBE_BACKOFF_SEC = 1.0
+
+    def __init__(self, client: Any, key_prefix: str = "livelystate", metrics: Optional[PluginMetrics] = None, errors_module: Any = None):
+        self.client = client
+        self.key_prefix = key_prefix
+        self.metrics = metrics or PluginMetrics()
+        self.node_id = format(random.getrandbits(48), "012x")
+        self.channel = f"{key_prefix}:invalidate"
+        errors_module = errors_module or redis
+        self.watch_error = getattr(errors_module, "WatchError", StateConflictError)
+        self.redis_error = getattr(errors_module, "RedisError", OSError)
+        self._stores: "weakref.WeakValueDictionary[str, RedisStateStore]" = weakref.WeakValueDictionary()
+        self._pubsub = None
+        self._pubsub_thread = None
+        # 订阅是否完好；连接出错后置为 False，重新订阅成功前不缓存。
+        self._subscribed = False
+
+    @classmethod
+    def from_url(cls, url: str, key_prefix: str = "livelystate", metrics: Optional[PluginMetrics] = None) -> "RedisStateBackend":
+        # 状态引擎是同步代码，命令直接在事件循环里执行；超时设短一些，Redis 异常时尽快失败而不是卡住整个循环。
+        client = redis.Redis.from_url(url, decode_responses=True, socket_timeout=2, socket_connect_timeout=2)
+        return cls(client, key_prefix=key_prefix, metrics=metrics)
+
+    @property
+    def listening(self) -> bool:
+        return self._subscribed and self._pubsub_thread is not None and self._pubsub_thread.is_alive()
+
+    def start(self) -> None:
+        if self._pubsub_thread is not None:
+            return
+        try:
+            self._pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{self.channel: self._on_message})
+            self._subscribed = True
+            self._pubsub_thread = self._pubsub.run_in_thread(
+                sleep_time=0.5,
+                daemon=True,
+                exception_handler=self._on_pubsub_error,
+            )
+        except self.redis_error as e:
+            logger.warning(f"Failed to subscribe state invalidation channel, local state cache disabled: {e}")
+            self._pubsub = None
+            self._pubsub_thread = None
+            self._subscribed = False
+
+    def stop(self) -> None:
+        self._subscribed = False
+        if self._pubsub_thread is not None:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+        self._pubsub = None
+        self.invalidate_all()
+
+    def invalidate_all(self) -> None:
+        for store in list(self._stores.values()):
+            store.invalidate()
+
+    def store(self, name: str) -> "RedisStateStore":
+        state_key = f"{self.key_prefix}:{name}:state"
+        store = self._stores.get(state_key)
+        if store is None:
+            store = RedisStateStore(self, name)
+            self._stores[state_key] = store
+        return store
+
+    def publish_invalidation(self, pipe: Any, state_key: str) -> None:
+        pipe.publish(self.channel, f"{self.node_id} {state_key}")
+
+    def _on_pubsub_error(self, error: Exception, pubsub: Any, worker: Any) -> None:
+        """订阅线程里的连接错误：丢掉全部缓存，尝试重新订阅；失败时下一轮由订阅线程再次回到这里。"""
+        # 先停止缓存再失效，避免失效之后、标记之前又有读取把旧数据缓存回去。
+        self._subscribed = False
+        self.invalidate_all()
+        self.metrics.increment("state_backend.pubsub_errors")
+        logger.warning(f"State invalidation subscription lost, local state cache disabled until resubscribed: {error}")
+        try:
+            pubsub.subscribe(**{self.channel: self._on_message})
+        except self.redis_error as e:
+            logger.warning(f"Failed to resubscribe state invalidation channel: {e}")
+            time.sleep(self.RESUBSCRIBE_BACKOFF_SEC)
+            return
+        # 重新订阅之前发起的读取可能拿到了断线期间的旧数据，再失效一次让它们的结果进不了缓存。
+        self.invalidate_all()
+        self._subscribed = True
+
+    def _on_message(self, message: Dict[str, Any]) -> None:
+        # 运行在订阅线程里；只改缓存标记，不碰事件循环。
+        node_id, _, state_key = str(message.get("data", "")).partition(" ")
+        if node_id == self.node_id:
+            return
+        store = self._stores.get(state_key)
+        if store is not None:
+            store.invalidate()
+            self.metrics.increment("state_backend.invalidations")
+
+
+class RedisStateStore:
+    """一份状态在 Redis 里的读写。
+
+    `<prefix>:<name>:state` 哈希里存除 History 外的状态 JSON（data）和版本号（rev），
+    History 计数单独放在 `<prefix>:<name>:history` 哈希，按增量 HINCRBY。
+    写入时 WATCH 状态 key 并确认版本号仍是上次读到的值，再在 MULTI 里写快状态、累加 History、递增版本号并发布失效通知；
+    版本号变了说明其他节点抢先写入，抛出 StateConflictError 由调用方基于最新状态重做。
+    自然流转是确定性的，冲突时直接放弃本次写入即可。
+    """
+
+    def __init__(self, backend: RedisStateBackend, name: str):
+        self.backend = backend
+        self.state_key = f"{backend.key_prefix}:{name}:state"
+        self.history_key = f"{backend.key_prefix}:{name}:history"
+        self._cached: Optional[Tuple[str, Dict[str, int]]] = None
+        self._read_rev = 0
+        self._read_history: Dict[str, int] = {}
+        # 失效代数：每次失效加一。读写前记下代数，结果只有在期间没有失效时才写入缓存，
+        # 否则在“Redis 已返回、缓存还没写”之间到达的失效通知会被旧数据覆盖掉。
+        self._generation = 0
+        self._cache_lock = threading.Lock()
+
+    def invalidate(self) -> None:
+        with self._cache_lock:
+            self._generation += 1
+            self._cached = None
+
+    def _store_cache(self, cached: Tuple[str, Dict[str, int]], generation: int) -> None:
+        if not self.backend.listening:
+            return
+        with self._cache_lock:
+            if self._generation == generation:
+                self._cached = cached
+
+    def load(self) -> Optional[Dict[str, Any]]:
+        # 订阅线程随时可能把 _cached 置空，只读一次，后面都用这份局部引用。
+        cached = self._cached
+        if cached is None:
+            generation = self._generation
+            try:
+                with self.backend.metrics.span("state_backend.read"):
+                    pipe = self.backend.client.pipeline(transaction=False)
+                    pipe.hgetall(self.state_key)
+                    pipe.hgetall(self.history_key)
+                    state_fields, history = pipe.execute()
+            except self.backend.redis_error as e:
+                self.backend.metrics.increment("state_backend.errors")
+                raise StateBackendError(str(e)) from e
+            if not state_fields or "data" not in state_fields:
+                self._read_rev = 0
+                self._read_history = {}
+                return None
+            self._read_rev = int(state_fields.get("rev", 0))
+            cached = (state_fields["data"], {key: int(value) for key, value in history.items()})
+            self._store_cache(cached, generation)
+        else:
+            self.backend.metrics.increment("state_backend.cache_hits")
+
+        data, history = cached
+        self._read_history = dict(history)
+        state = json.loads(data)
+        state["History"] = dict(history)
+        return state
+
+    def save(self, state: Dict[str, Any], progression: bool = False) -> bool:
+        """写入成功返回 True；progression 模式下冲突或 Redis 异常时放弃写入并返回 False。"""
+        data = json.dumps({key: value for key, value in state.items() if key != "History"}, ensure_ascii=False)
+        history = state.get("History", {}) if isinstance(state.get("History"), dict) else {}
+        history_deltas = {
+            counter_name: int(value) - self._read_history.get(counter_name, 0)
+            for counter_name, value in history.items()
+            if counter_name not in self._read_history or int(value) != self._read_history[counter_name]
+        }
+
+        client = self.backend.client
+        generation = self._generation
+        try:
+            with self.backend.metrics.span("state_backend.write"):
+                pipe = client.pipeline()
+                try:
+                    pipe.watch(self.state_key)
+                    current_rev = int(pipe.hget(self.state_key, "rev") or 0)
+                    if current_rev != self._read_rev:
+                        raise self.backend.watch_error(f"rev {current_rev} != {self._read_rev}")
+                    pipe.multi()
+                    pipe.hset(self.state_key, mapping={"data": data})
+                    pipe.hincrby(self.state_key, "rev", 1)
+                    for counter_name, delta in history_deltas.items():
+                        pipe.hincrby(self.history_key, counter_name, delta)
+                    self.backend.publish_invalidation(pipe, self.state_key)
+                    pipe.execute()
+                finally:
+                    pipe.reset()
+        except self.backend.watch_error:
+            self.invalidate()
+            self.backend.metrics.increment("state_backend.conflicts")
+            if progression:
+                return False
+            raise StateConflictError(self.state_key)
+        except self.backend.redis_error as e:
+            self.invalidate()
+            self.backend.metrics.increment("state_backend.errors")
+            if progression:
+                logger.warning(f"Failed to save natural progression to redis: {e}")
+                return False
+            raise StateBackendError(str(e)) from e
+
+        merged_history = {
+            counter_name: self._read_history.get(counter_name, 0) + history_deltas.get(counter_name, 0)
+            for counter_name in set(self._read_history) | set(history_deltas)
+        }
+        self._read_rev += 1
+        self._read_history = merged_history
+        self._store_cache((data, merged_history), generation)
+        return True
+
+    def delete(self) -> None:
+        try:
+            pipe = self.backend.client.pipeline()
+            pipe.delete(self.state_key, self.history_key)
+            self.backend.publish_invalidation(pipe, self.state_key)
+            pipe.execute()
+        except self.backend.redis_error as e:
+            raise StateBackendError(str(e)) from e
+        finally:
+            self.invalidate()
+            self._read_rev = 0
+            self._read_history = {}
+
+
+class StateMachineDefinition:
+    """一套角色专属的状态机规则（STATE_MACHINE + STATE_ALIASES）。
+
+    内容相同的定义在多个角色之间共享同一个对象，连同按需编译的 StateForecaster 一起复用；
+    所有引用它的角色都卸载后由弱引用表自动回收。
+    """
+
+    def __init__(self, state_machine: Dict[str, Dict[str, Any]], state_aliases: Dict[str, str], digest: str):
+        self.state_machine = state_machine
+        self.state_aliases = state_aliases
+        self.digest = digest
+        self.forecaster: Optional["StateForecaster"] = None
+
+
+class PersonaRuntime:
+    """一个已加载角色的运行时：状态存储、可选的分片管理器、状态预测器和更新锁。"""
+
+    def __init__(
+        self,
+        persona_id: str,
+        character: CharacterState,
+        state_manager: Optional[StateManager] = None,
+        forecaster: Optional["StateForecaster"] = None,
+        definition: Optional[StateMachineDefinition] = None,
+    ):
+        self.persona_id = persona_id
+        self.character = character
+        self.state_manager = state_manager
+        self.forecaster = forecaster
+        self.definition = definition
+        self.lock = asyncio.Lock()
+        self.last_used = 0.0
+
+    def flush(self) -> None:
+        if self.state_manager:
+            self.state_manager.flush_all()
+
+    def close(self) -> None:
+        if self.state_manager:
+            self.state_manager.close_all()
+        self.character.close()
+
+
+class CharacterRegistry:
+    """按 persona id 管理多个角色，同一个 AstrBot 实例上的多个人格各自拥有独立的状态。
+
+    角色定义放在 personas_dir/<persona_id>/ 下：可选的 `state_profile_template.json` 覆盖长期事实模板，
+    可选的 `state_machine.json`（`STATE_MACHINE` / `STATE_ALIASES` 两个键）覆盖状态机，状态文件也写在这个目录里。
+    没有对应目录的 persona 使用默认角色。角色第一次被用到时才加载，超过 idle_unload_sec 没有访问的角色
+    在之后的访问中顺带卸载（卸载前写回分片、关闭时间线），内存占用只和活跃角色数有关。
+    """
+
+    STATE_MACHINE_FILE = "state_machine.json"
+    TEMPLATE_FILE = "state_profile_template.json"
+    SWEEP_INTERVAL_SEC = 60.0
+
+    def __init__(
+        self,
+        personas_dir: Path,
+        build_runtime: Callable[[str, Path, Optional[StateMachineDefinition]], PersonaRuntime],
+        idle_unload_sec: int = 1800,
+        clock: Optional[SystemClock] = None,
+        metrics: Optional[PluginMetrics] = None,
+    ):
+        self.personas_dir = personas_dir
+        self.build_runtime = build_runtime
+        self.idle_unload_sec = max(60, int(idle_unload_sec))
+        self.clock = clock or SystemClock()
+        self.metrics = metrics or PluginMetrics()
+        self._loaded: Dict[str, PersonaRuntime] = {}
+        # 没有目录的 persona 也会被频繁查询，记住检查时间，避免每次请求都去 stat 文件系统。
+        self._missing: Dict[str, float] = {}
+        self._definitions: "weakref.WeakValueDictionary[str, StateMachineDefinition]" = weakref.WeakValueDictionary()
+        self._last_sweep = 0.0
+
+    def persona_dir(self, persona_id: str) -> Optional[Path]:
+        persona_id = str(persona_id or "").strip()
+        if not persona_id or persona_id.startswith(".") or "/" in persona_id or "\\" in persona_id:
+            return None
+        return self.personas_dir / persona_id
+
+    def get(self, persona_id: str) -> Optional[PersonaRuntime]:
+        """返回已加载或刚加载的角色；persona 没有定义目录时返回 None，由调用方回退到默认角色。"""
+        now = self.clock.now()
+        if now - self._last_sweep >= self.SWEEP_INTERVAL_SEC:
+            self._last_sweep = now
+            self.unload_idle(now)
+
+        runtime = self._loaded.get(persona_id)
+        if runtime is None:
+            missing_checked_at = self._missing.get(persona_id)
+            if missing_checked_at is not None and now - missing_checked_at < self.SWEEP_INTERVAL_SEC:
+                return None
+            persona_dir = self.persona_dir(persona_id)
+            if persona_dir is None or not persona_dir.is_dir():
+                self._missing[persona_id] = now
+                return None
+            self._missing.pop(persona_id, None)
+            runtime = self.build_runtime(persona_id, persona_dir, self.load_definition(persona_dir))
+            self._loaded[persona_id] = runtime
+            self.metrics.increment("persona.loads")
+        runtime.last_used = now
+        return runtime
+
+    def load_definition(self, persona_dir: Path) -> Optional[StateMachineDefinition]:
+        definition_path = persona_dir / self.STATE_MACHINE_FILE
+        if not definition_path.exists():
+            return None
+        try:
+            normalized = self._normalize_definition(json_repair.loads(definition_path.read_text(encoding="utf-8")))
+        except Exception as e:
+            logger.warning(f"Failed to parse persona state machine {definition_path}, using default. Error: {e}")
+            return None
+        if normalized is None:
+            logger.warning(f"Persona state machine {definition_path} is invalid (needs an Idle state), using default")
+            return None
+
+        state_machine, state_aliases = normalized
+        digest = hashlib.sha1(
+            json.dumps([state_machine, state_aliases], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        definition = self._definitions.get(digest)
+        if definition is None:
+            definition = StateMachineDefinition(state_machine, state_aliases, digest)
+            self._definitions[digest] = definition
+        else:
+            self.metrics.increment("persona.shared_definitions")
+        return definition
+
+    @staticmethod
+    def _normalize_definition(data: Any) -> Optional[Tuple[Dict[str, Dict[str, Any]], Dict[str, str]]]:
+        """补齐状态元数据的默认值，丢掉指向未定义状态的转移；状态引擎依赖 Idle 作为兜底，缺了就视为无效。"""
+        if not isinstance(data, dict):
+            return None
+        raw_machine = data.get("STATE_MACHINE")
+        if not isinstance(raw_machine, dict) or "Idle" not in raw_machine:
+            return None
+
+        state_names = [str(state_name) for state_name in raw_machine]
+        state_machine: Dict[str, Dict[str, Any]] = {}
+        for state_name, meta in raw_machine.items():
+            state_name = str(state_name)
+            meta = meta if isinstance(meta, dict) else {}
+            auto_fallback = meta.get("auto_fallback")
+            allowed_next_states = meta.get("allowed_next_states", state_names)
+            state_machine[state_name] = {
+                "label": str(meta.get("label", state_name)),
+                "description": str(meta.get("description", "")),
+                "energy_delta": int(meta.get("energy_delta", 0)),
+                "thirst_delta": int(meta.get("thirst_delta", 1)),
+                "auto_fallback": auto_fallback if auto_fallback in state_names else None,
+                "allowed_next_states": [
+                    next_state for next_state in allowed_next_states if next_state in state_names
+                ] if isinstance(allowed_next_states, list) else list(state_names),
+            }
+
+        raw_aliases = data.get("STATE_ALIASES", {})
+        state_aliases = {
+            str(alias).strip().lower(): state_name
+            for alias, state_name in (raw_aliases.items() if isinstance(raw_aliases, dict) else [])
+            if state_name in state_machine and str(alias).strip()
+        }
+        return state_machine, state_aliases
+
+    def unload_idle(self, now: Optional[float] = None) -> int:
+        now = self.clock.now() if now is None else now
+        unloaded = 0
+        for persona_id, runtime in list(self._loaded.items()):
+            if now - runtime.last_used < self.idle_unload_sec or runtime.lock.locked():
+                continue
+            runtime.close()
+            del self._loaded[persona_id]
+            unloaded += 1
+            self.metrics.increment("persona.unloads")
+        return unloaded
+
+    def loaded(self) -> List[PersonaRuntime]:
+        return list(self._loaded.values())
+
+    def flush_all(self) -> None:
+        for runtime in self._loaded.values():
+            runtime.flush()
+
+    def close_all(self) -> None:
+        for runtime in self._loaded.values():
+            runtime.close()
+        self._loaded.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "loaded_personas": sorted(self._loaded),
+            "shared_state_machines": len(self._definitions),
+            "idle_unload_sec": self.idle_unload_sec,
+            "personas_dir": str(self.personas_dir),
+        }
+
+
+class StateForecaster:
+    """按 STATE_MACHINE 的数值规则预测体力、欲望和物理状态的走向。
+
+    预测语义与 CharacterState.update 完全一致：给定未来某个时刻，算出“那时再读一次状态”会看到的
+    energy / thirst / physical_state，并且不受中途读取次数影响（持续状态超时回退后按回退状态的增量继续推进）。
+    可以一次性对多个时间点、多个候选状态（假设现在就切换过去）批量计算；装了 numpy 时每个分段对所有时间点
+    用数组一次算完，没装时逐项计算，结果相同。
+    """
+
+    # time_until 最多往后推算多久；更远的阈值视为不会发生。
+    MAX_ETA_SEC = 7 * 24 * 3600
+
+    def __init__(self, character_state: "CharacterState"):
+        self.character_state = character_state
+        self.state_names = list(character_state.STATE_MACHINE)
+        state_index = {state_name: index for index, state_name in enumerate(self.state_names)}
+        self.energy_deltas = [int(meta.get("energy_delta", 0)) for meta in character_state.STATE_MACHINE.values()]
+        self.thirst_deltas = [int(meta.get("thirst_delta", 1)) for meta in character_state.STATE_MACHINE.values()]
+        self._state_index = state_index
+
+    def _current_values(self, state: Dict[str, Any], now: float) -> Tuple[int, int, str]:
+        """当前时刻读状态会看到的值，作为候选切换的起点。"""
+        projected = self._project(
+            [self._state_index[self.character_state.normalize_physical_state(state.get("physical_state", "Idle"))]],
+            [float(state.get("energy_level", 100))],
+            [float(state.get("thirst", 0))],
+            [float(state.get("LastUpdateTime", now))],
+            [self._state_since(state, now)],
+            [now],
+        )
+        return int(projected[0][0][0]), int(projected[1][0][0]), self.state_names[projected[2][0][0]]
+
+    @staticmethod
+    def _state_since(state: Dict[str, Any], now: float) -> float:
+        return float(state.get("_physical_state_since", state.get("LastUpdateTime", now)))
+
+    def _segments(self, state_index: int, base_time: float, since: float, until: float) -> List[Tuple[int, int, float]]:
+        """CharacterState.progression_schedule 的分段，状态换成下标：[(状态下标, 起始步数, 进入时间)]。"""
+        return [
+            (self._state_index[state_name], start_step, entered_at)
+            for state_name, start_step, entered_at in self.character_state.progression_schedule(
+                self.state_names[state_index], since, base_time, until
+            )
+        ]
+
+    def _project(
+        self,
+        state_indices: List[int],
+        base_energy: List[float],
+        base_thirst: List[float],
+        base_times: List[float],
+        base_since: List[float],
+        target_times: List[float],
+    ) -> Tuple[List[List[int]], List[List[int]], List[List[int]]]:
+        """与 CharacterState.update 相同的分段推进：持续状态超时前用它自己的增量，之后换成回退状态的增量。
+
+        分段只有几段（由状态机的回退链决定），按行逐段计算；每段内部对所有时间点一次算完。
+        """
+        interval = self.character_state.update_interval_sec
+        until = max(target_times) if target_times else 0.0
+
+        if np is not None:
+            targets = np.asarray(target_times, dtype=np.float64)
+            energy_rows, thirst_rows, physical_rows = [], [], []
+            for state_index, energy_value, thirst_value, base_time, since in zip(
+                state_indices, base_energy, base_thirst, base_times, base_since
+            ):
+                segments = self._segments(state_index, base_time, since, until)
+                steps = np.floor(np.maximum(targets - base_time, 0.0) / interval)
+                energy = np.full(len(target_times), float(energy_value))
+                thirst = np.full(len(target_times), float(thirst_value))
+                for segment_index, (segment_state, start_step, _) in enumerate(segments):
+                    end_step = segments[segment_index + 1][1] if segment_index + 1 < len(segments) else np.inf
+                    segment_steps = np.clip(steps - start_step, 0, end_step - start_step)
+                    energy = np.clip(energy + segment_steps * self.energy_deltas[segment_state], 0, 100)
+                    thirst = np.clip(thirst + segment_steps * self.thirst_deltas[segment_state], 0, 100)
+                # 每个时间点所处的分段：进入时间不晚于该时间点的最后一段。
+                entered_at = np.asarray([segment[2] for segment in segments[1:]], dtype=np.float64)
+                segment_states = np.asarray([segment[0] for segment in segments], dtype=np.int64)
+                physical = segment_states[np.searchsorted(entered_at, targets, side="right")]
+                energy_rows.append(energy.astype(int).tolist())
+                thirst_rows.append(thirst.astype(int).tolist())
+                physical_rows.append(physical.tolist())
+            return energy_rows, thirst_rows, physical_rows
+
+        energy_rows, thirst_rows, physical_rows = [], [], []
+        for state_index, energy_value, thirst_value, base_time, since in zip(
+            state_indices, base_energy, base_thirst, base_times, base_since
+        ):
+            segments = self._segments(state_index, base_time, since, until)
+            energy_row, thirst_row, physical_row = [], [], []
+            for target_time in target_times:
+                steps = math.floor(max(target_time - base_time, 0.0) / interval)
+                energy, thirst, physical = energy_value, thirst_value, state_index
+                for segment_index, (segment_state, start_step, entered_at) in enumerate(segments):
+                    if entered_at > target_time and segment_index > 0:
+                        break
+                    end_step = segments[segment_index + 1][1] if segment_index + 1 < len(segments) else steps
+                    segment_steps = max(0, min(steps, end_step) - start_step)
+                    energy = max(0, min(100, energy + segment_steps * self.energy_deltas[segment_state]))
+                    thirst = max(0, min(100, thirst + segment_steps * self.thirst_deltas[segment_state]))
+                    physical = segment_state
+                energy_row.append(int(energy))
+                thirst_row.append(int(thirst))
+                physical_row.append(physical)
+            energy_rows.append(energy_row)
+            thirst_rows.append(thirst_row)
+            physical_rows.append(physical_row)
+        return energy_rows, thirst_rows, physical_rows
+
+    def forecast(
+        self,
+        state: Dict[str, Any],
+        horizons_sec: List[float],
+        candidate_states: Optional[List[str]] = None,
+        now: Optional[float] = None,
+    ) -> Dict[str, Any]:
+        """预测多个时间点的状态。
+
+        candidate_states 为空时只预测“保持当前状态”；否则第一行是当前状态，
+        后续每行假设此刻切换到对应候选状态。
+        """
+        now = self.character_state.clock.now() if now is None else now
+        current_state_name = self.character_state.normalize_physical_state(state.get("physical_state", "Idle"))
+        current_energy, current_thirst, _ = self._current_values(state, now)
+
+        rows = [current_state_name] + [
+            self.character_state.normalize_physical_state(candidate) for candidate in (candidate_states or [])
+        ]
+        state_indices = [self._state_index[row] for row in rows]
+        # 第一行沿用状态里的 LastUpdateTime 和进入时间；候选切换会把两者都重置到现在。
+        base_times = [float(state.get("LastUpdateTime", now))] + [now] * (len(rows) - 1)
+        base_since = [self._state_since(state, now)] + [now] * (len(rows) - 1)
+        base_energy = [float(state.get("energy_level", 100))] + [float(current_energy)] * (len(rows) - 1)
+        base_thirst = [float(state.get("thirst", 0))] + [float(current_thirst)] * (len(rows) - 1)
+        energy, thirst, physical = self._project(
+            state_indices,
+            base_energy,
+            base_thirst,
+            base_times,
+            base_since,
+            [now + float(horizon) for horizon in horizons_sec],
+        )
+        return {
+            "horizons_sec": [float(horizon) for horizon in horizons_sec],
+            "states": rows,
+            "energy": energy,
+            "thirst": thirst,
+            "physical_state": [[self.state_names[index] for index in row] for row in physical],
+        }
+
+    def time_until(
+        self,
+        state: Dict[str, Any],
+        energy_below: int = 30,
+        thirst_above: int = 85,
+        now: Optional[float] = None,
+    ) -> Dict[str, Optional[float]]:
+        """按当前状态（及其自动回退）推算，体力跌破 / 欲望超过阈值还需多少秒；MAX_ETA_SEC 内不会发生时为 None。"""
+        now = self.character_state.clock.now() if now is None else now
+        interval = self.character_state.update_interval_sec
+        base_time = float(state.get("LastUpdateTime", now))
+        state_index = self._state_index[self.character_state.normalize_physical_state(state.get("physical_state", "Idle"))]
+        segments = self._segments(state_index, base_time, self._state_since(state, now), now + self.MAX_ETA_SEC)
+        energy = int(state.get("energy_level", 100))
+        thirst = int(state.get("thirst", 0))
+
+        def eta(value: int, step_sign: int, limit: int, deltas: List[int]) -> Optional[float]:
+            # value 按 step_sign 方向越过 limit 的第一步；体力看下降（-1），欲望看上升（+1）。
+            for segment_index, (segment_state, start_step, _) in enumerate(segments):
+                if step_sign * (value - limit) > 0:
+                    return max(0.0, base_time + start_step * interval - now)
+                end_step = segments[segment_index + 1][1] if segment_index + 1 < len(segments) else math.inf
+                delta = step_sign * deltas[segment_state]
+                if delta > 0:
+                    needed_steps = math.floor(step_sign * (limit - value) / delta + 1)
+                    if start_step + needed_steps <= end_step:
+                        eta_sec = max(0.0, base_time + (start_step + needed_steps) * interval - now)
+                        return eta_sec if eta_sec <= self.MAX_ETA_SEC else None
+                if end_step == math.inf:
+                    return None
+                value = max(0, min(100, value + (end_step - start_step) * deltas[segment_state]))
+            return None
+
+        return {
+            "energy_below_sec": eta(energy, -1, energy_below, self.energy_deltas),
+            "thirst_above_sec": eta(thirst, 1, thirst_above, self.thirst_deltas),
+        }
+
+
+class StateTimeline:
+    """状态历史的定长环形缓冲区，持久化为内存映射的二进制文件。
+
+    每次状态写入（工具提交、自然流转）追加一条 16 字节的定长样本：
+    时间戳 float64、energy / thirst / physical_state / emotion / 来源各 1 字节。
+    physical_state 按 STATE_MACHINE 顺序编码；emotion 是自由文本，编码表存放在旁边的
+    `.labels.json` 里，超过 254 种之后统一记为 other。写满 capacity 条后覆盖最旧的样本。
+
+    查询只按时间戳二分定位区间，再把该区间的字节切片解码（有 numpy 时直接按结构化 dtype 解析并向量化降采样），
+    不会把整份历史读成 Python 对象。
+    """
+
+    MAGIC = b"LSTL"
+    VERSION = 1
+    HEADER = struct.Struct("<4sIIQ")
+    HEADER_SIZE = 32
+    RECORD = struct.Struct("<dBBBBB3x")
+    TIMESTAMP = struct.Struct("<d")
+    SOURCE_PROGRESSION = 0
+    SOURCE_COMMIT = 1
+    SOURCE_NAMES = {SOURCE_PROGRESSION: "progression", SOURCE_COMMIT: "commit"}
+    EMOTION_OTHER = 255
+
+    def __init__(self, path: Path, state_names: List[str], capacity: int = 20000):
+        self.path = path
+        self.labels_path = path.with_suffix(".labels.json")
+        self.capacity = max(16, int(capacity))
+        self.state_names = list(state_names)
+        self.state_index = {state_name: index for index, state_name in enumerate(self.state_names)}
+        self.emotions: List[str] = self._load_labels()
+        self.emotion_index = {emotion: index for index, emotion in enumerate(self.emotions)}
+        self.total_count = 0
+        self.last_timestamp = 0.0
+        self._file = None
+        self._mm: Optional[mmap.mmap] = None
+        self._open()
+
+    def _load_labels(self) -> List[str]:
+        try:
+            labels = json.loads(self.labels_path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            return []
+        return [str(label) for label in labels.get("emotions", [])] if isinstance(labels, dict) else []
+
+    def _file_size(self, capacity: int) -> int:
+        return self.HEADER_SIZE + capacity * self.RECORD.size
+
+    def _read_existing(self) -> Tuple[int, int, bytes]:
+        """读取已有文件，返回 (capacity, total_count, 原始字节)；格式不对时 capacity 为 0。"""
+        try:
+            raw = self.path.read_bytes()
+        except OSError:
+            return 0, 0, b""
+        if len(raw) < self.HEADER_SIZE:
+            return 0, 0, b""
+        magic, version, capacity, total_count = self.HEADER.unpack_from(raw, 0)
+        if magic != self.MAGIC or version != self.VERSION or len(raw) < self._file_size(capacity):
+            return 0, 0, b""
+        return capacity, total_count, raw
+
+    def _open(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        existing_capacity, existing_count, raw = self._read_existing() if self.path.exists() else (0, 0, b"")
+
+        if existing_capacity != self.capacity:
+            # 容量变化或文件损坏：按时间顺序把还能放下的最新样本迁移到新文件。
+            carried_records: List[bytes] = []
+            if existing_capacity:
+                stored = min(existing_count, existing_capacity)
+                for logical_index in range(existing_count - stored, existing_count):
+                    offset = self.HEADER_SIZE + (logical_index % existing_capacity) * self.RECORD.size
+                    carried_records.append(raw[offset:offset + self.RECORD.size])
+                carried_records = carried_records[-self.capacity:]
+            with self.path.open("wb") as timeline_file:
+                timeline_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.capacity, len(carried_records)))
+                timeline_file.write(b"\0" * (self.HEADER_SIZE - self.HEADER.size))
+                timeline_file.write(b"".join(carried_records))
+                timeline_file.write(b"\0" * ((self.capacity - len(carried_records)) * self.RECORD.size))
+            existing_count = len(carried_records)
+
+        self._file = self.path.open("r+b")
+        self._mm = mmap.mmap(self._file.fileno(), self._file_size(self.capacity))
+        self.total_count = existing_count
+        if self.total_count:
+            self.last_timestamp = self._timestamp_at(self.total_count - 1)
+
+    def close(self) -> None:
+        if self._mm is not None:
+            self._mm.flush()
+            self._mm.close()
+            self._mm = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _offset(self, logical_index: int) -> int:
+        return self.HEADER_SIZE + (logical_index % self.capacity) * self.RECORD.size
+
+    def _timestamp_at(self, logical_index: int) -> float:
+        return self.TIMESTAMP.unpack_from(self._mm, self._offset(logical_index))[0]
+
+    @property
+    def oldest_index(self) -> int:
+        return max(0, self.total_count - self.capacity)
+
+    def _encode_emotion(self, emotion: Any) -> int:
+        emotion = str(emotion or "").strip() or "Normal"
+        index = self.emotion_index.get(emotion)
+        if index is not None:
+            return index
+        if len(self.emotions) >= self.EMOTION_OTHER:
+            return self.EMOTION_OTHER
+        index = len(self.emotions)
+        self.emotions.append(emotion)
+        self.emotion_index[emotion] = index
+        try:
+            # 状态名也一并写进去，离线分析角色自定义状态机的时间线时按它解码。
+            self.labels_path.write_text(
+                json.dumps({"emotions": self.emotions, "states": self.state_names}, ensure_ascii=False),
+                encoding="utf-8",
+            )
+        except OSError as e:
+            logger.warning(f"Failed to write state timeline labels: {e}")
+        return index
+
+    def append(self, timestamp: float, state: Dict[str, Any], source: int = SOURCE_COMMIT) -> None:
+        if self._mm is None:
+            return
+        # 区间查询依赖时间戳单调；墙钟回拨时沿用上一条的时间戳。
+        timestamp = max(float(timestamp), self.last_timestamp)
+        self.RECORD.pack_into(
+            self._mm,
+            self._offset(self.total_count),
+            timestamp,
+            max(0, min(255, int(state.get("energy_level", 0)))),
+            max(0, min(255, int(state.get("thirst", 0)))),
+            self.state_index.get(state.get("physical_state"), 0),
+            self._encode_emotion(state.get("emotion")),
+            source,
+        )
+        self.total_count += 1
+        self.last_timestamp = timestamp
+        self.HEADER.pack_into(self._mm, 0, self.MAGIC, self.VERSION, self.capacity, self.total_count)
+
+    def _lower_bound(self, timestamp: float) -> int:
+        low, high = self.oldest_index, self.total_count
+        while low < high:
+            middle = (low + high) // 2
+            if self._timestamp_at(middle) < timestamp:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range_bytes(self, start_index: int, end_index: int) -> bytes:
+        """按时间顺序取出 [start_index, end_index) 的原始字节，环绕时拼接两段。"""
+        if start_index >= end_index:
+            return b""
+        first_offset = self._offset(start_index)
+        count = end_index - start_index
+        contiguous = min(count, self.capacity - start_index % self.capacity)
+        chunk = self._mm[first_offset:first_offset + contiguous * self.RECORD.size]
+        if contiguous < count:
+            chunk += self._mm[self.HEADER_SIZE:self.HEADER_SIZE + (count - contiguous) * self.RECORD.size]
+        return chunk
+
+    def _label(self, labels: List[str], index: int) -> str:
+        return labels[index] if 0 <= index < len(labels) else "other"
+
+    def query(self, start_ts: float, end_ts: float, max_points: int = 0) -> List[Dict[str, Any]]:
+        """返回时间区间内的样本；max_points > 0 且样本更多时按等宽时间桶降采样。
+
+        降采样后每个点的 energy / thirst 取桶内均值，physical_state / emotion 取桶内最后一条。
+        """
+        if self._mm is None or end_ts < start_ts:
+            return []
+        start_index = self._lower_bound(start_ts)
+        end_index = self._lower_bound(math.nextafter(end_ts, math.inf))
+        raw = self._range_bytes(start_index, end_index)
+        if not raw:
+            return []
+
+        sample_count = end_index - start_index
+        bucket_count = max_points if 0 < max_points < sample_count else 0
+        if np is not None:
+            return self._query_numpy(raw, start_ts, end_ts, bucket_count)
+
+        points: List[Dict[str, Any]] = []
+        bucket_width = (end_ts - start_ts) / bucket_count if bucket_count else 0.0
+        current_bucket = None
+        for timestamp, energy, thirst, state_index, emotion_index, source in self.RECORD.iter_unpack(raw):
+            bucket = min(bucket_count - 1, int((timestamp - start_ts) / bucket_width)) if bucket_count and bucket_width else None
+            if bucket is None or bucket != current_bucket:
+                points.append({"t": timestamp, "energy": 0.0, "thirst": 0.0, "samples": 0})
+                current_bucket = bucket
+            point = points[-1]
+            point["samples"] += 1
+            point["energy"] += (energy - point["energy"]) / point["samples"]
+            point["thirst"] += (thirst - point["thirst"]) / point["samples"]
+            point.update({
+                "t": timestamp,
+                "physical_state": self._label(self.state_names, state_index),
+                "emotion": self._label(self.emotions, emotion_index),
+                "source": self.SOURCE_NAMES.get(source, "other"),
+            })
+        for point in points:
+            point["energy"] = round(point["energy"], 1)
+            point["thirst"] = round(point["thirst"], 1)
+        return points
+
+    @classmethod
+    def numpy_dtype(cls):
+        """与 RECORD 对应的 numpy 结构化 dtype，可以直接 np.frombuffer 原始记录字节。"""
+        return np.dtype({
+            "names": ["t", "energy", "thirst", "state", "emotion", "source"],
+            "formats": ["<f8", "u1", "u1", "u1", "u1", "u1"],
+            "offsets": [0, 8, 9, 10, 11, 12],
+            "itemsize": cls.RECORD.size,
+        })
+
+    def _query_numpy(self, raw: bytes, start_ts: float, end_ts: float, bucket_count: int) -> List[Dict[str, Any]]:
+        records = np.frombuffer(raw, dtype=self.numpy_dtype())
+        if bucket_count:
+            bucket_width = (end_ts - start_ts) / bucket_count
+            bucket_ids = np.minimum(((records["t"] - start_ts) / bucket_width).astype(np.int64), bucket_count - 1)
+        else:
+            bucket_ids = np.arange(len(records))
+        first_indices = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+        last_indices = np.r_[first_indices[1:] - 1, len(records) - 1]
+        counts = last_indices - first_indices + 1
+        energy_means = np.add.reduceat(records["energy"].astype(np.float64), first_indices) / counts
+        thirst_means = np.add.reduceat(records["thirst"].astype(np.float64), first_indices) / counts
+
+        return [
+            {
+                "t": float(records["t"][last_index]),
+                "energy": round(float(energy_mean), 1),
+                "thirst": round(float(thirst_mean), 1),
+                "samples": int(count),
+                "physical_state": self._label(self.state_names, int(records["state"][last_index])),
+                "emotion": self._label(self.emotions, int(records["emotion"][last_index])),
+                "source": self.SOURCE_NAMES.get(int(records["source"][last_index]), "other"),
+            }
+            for last_index, energy_mean, thirst_mean, count in zip(last_indices, energy_means, thirst_means, counts)
+        ]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "capacity": self.capacity,
+            "stored": self.total_count - self.oldest_index,
+            "total_appended": self.total_count,
+            "oldest_ts": round(self._timestamp_at(self.oldest_index), 3) if self.total_count else None,
+            "newest_ts": round(self.last_timestamp, 3) if self.total_count else None,
+        }
+
+
+class TokenBudget:
+    """插件自发 LLM 调用的 token 记账与预算。
+
+    记两类账：全局观察者自己发起的总结调用（输入/输出 token），以及每次用户请求里
+    插件注入的 prompt 片段大小。预算只约束前者——后台工作可以慢下来，用户请求不能被拒绝。
+    每分钟、每小时各一个令牌桶（0 表示不限），桶越空 degradation_factor 越大，
+    观察者据此拉长总结间隔、缩小总结窗口；桶里不够一次调用的估算量时直接推迟这一轮。
+    """
+
+    def __init__(self, per_minute: int = 0, per_hour: int = 0, clock: Optional[SystemClock] = None):
+        self.clock = clock or SystemClock()
+        now = self.clock.now()
+        self.buckets: Dict[str, Dict[str, float]] = {}
+        for bucket_name, capacity, period_sec in [("minute", per_minute, 60.0), ("hour", per_hour, 3600.0)]:
+            capacity = max(0, int(capacity))
+            if capacity > 0:
+                self.buckets[bucket_name] = {
+                    "capacity": float(capacity),
+                    "refill_per_sec": capacity / period_sec,
+                    "level": float(capacity),
+                    "updated_at": now,
+                }
+
+        self.observer_calls = 0
+        self.observer_input_tokens = 0
+        self.observer_output_tokens = 0
+        self.deferred_calls = 0
+        self.injected_requests = 0
+        self.injected_tokens: Dict[str, int] = {}
+
+    @staticmethod
+    def estimate_tokens(text: Any) -> int:
+        """粗略估算 token：CJK 字符按 1 个 token，其余字符按 4 个一 token。"""
+        text = str(text or "")
+        cjk_chars = sum(1 for char in text if "\u2e80" <= char <= "\u9fff" or "\uac00" <= char <= "\ud7af")
+        return cjk_chars + math.ceil((len(text) - cjk_chars) / 4)
+
+    def set_clock(self, clock: SystemClock) -> None:
+        """换时钟后令牌桶从新时钟的当前时刻重新计时，避免两套时间轴之间的差值被当成补充时间。"""
+        self.clock = clock
+        for bucket in self.buckets.values():
+            bucket["updated_at"] = clock.now()
+
+    def _refill(self, now: float) -> None:
+        for bucket in self.buckets.values():
+            elapsed = max(0.0, now - bucket["updated_at"])
+            bucket["level"] = min(bucket["capacity"], bucket["level"] + elapsed * bucket["refill_per_sec"])
+            bucket["updated_at"] = now
+
+    def available_fraction(self, now: Optional[float] = None) -> float:
+        if not self.buckets:
+            return 1.0
+        self._refill(self.clock.now() if now is None else now)
+        return min(max(0.0, bucket["level"]) / bucket["capacity"] for bucket in self.buckets.values())
+
+    def can_spend(self, tokens: int, now: Optional[float] = None) -> bool:
+        if not self.buckets:
+            return True
+        self._refill(self.clock.now() if now is None else now)
+        return all(bucket["level"] >= min(tokens, bucket["capacity"]) for bucket in self.buckets.values())
+
+    def degradation_factor(self, now: Optional[float] = None) -> int:
+        """预算充足时为 1；剩余不足一半翻倍，不足四分之一再翻倍。"""
+        fraction = self.available_fraction(now)
+        if fraction < 0.25:
+            return 4
+        if fraction < 0.5:
+            return 2
+        return 1
+
+    def record_observer_call(self, input_tokens: int, output_tokens: int, now: Optional[float] = None) -> None:
+        self.observer_calls += 1
+        self.observer_input_tokens += input_tokens
+        self.observer_output_tokens += output_tokens
+        if self.buckets:
+            self._refill(self.clock.now() if now is None else now)
+            # 允许扣成负数：超支的部分要在后续补回来，而不是一笔勾销。
+            for bucket in self.buckets.values():
+                bucket["level"] -= input_tokens + output_tokens
+
+    def record_deferred_call(self) -> None:
+        self.deferred_calls += 1
+
+    def record_injection(self, section_tokens: Dict[str, int]) -> None:
+        self.injected_requests += 1
+        for section_name, tokens in section_tokens.items():
+            self.injected_tokens[section_name] = self.injected_tokens.get(section_name, 0) + tokens
+
+    def snapshot(self, now: Optional[float] = None) -> Dict[str, Any]:
+        now = self.clock.now() if now is None else now
+        self._refill(now)
+        return {
+            "observer_calls": self.observer_calls,
+            "observer_input_tokens": self.observer_input_tokens,
+            "observer_output_tokens": self.observer_output_tokens,
+            "deferred_calls": self.deferred_calls,
+            "injected_requests": self.injected_requests,
+            "injected_tokens": dict(self.injected_tokens),
+            "avg_injected_tokens_per_request": round(
+                sum(self.injected_tokens.values()) / self.injected_requests, 1
+            ) if self.injected_requests else 0.0,
+            "buckets": {
+                bucket_name: {
+                    "capacity": int(bucket["capacity"]),
+                    "available": int(bucket["level"]),
+                }
+                for bucket_name, bucket in self.buckets.items()
+            },
+            "degradation_factor": self.degradation_factor(now),
+        }
+
+
+class SummarizationScheduler:
+    """决定全局观察者什么时候该总结。
+
+    固定条数阈值在高峰期会连续触发、在冷清时又迟迟不触发，这里把几条规则合在一起：
+    - 条数阈值：攒够 effective_threshold 条新消息触发；
+    - 最小间隔：距离上次总结不足 min_interval_sec 时不触发，高峰期自然拉开间隔；
+    - 最大陈旧度：有未总结消息且上次总结已超过 max_staleness_sec 时，即使条数不够也触发（空闲时由后台循环兜底）；
+    - 到达速率：用 EWMA 估计消息到达间隔，速率越高，有效阈值越大，使两次总结之间至少相隔 min_interval_sec 的流量。
+    """
+
+    def __init__(
+        self,
+        trigger_threshold: int = 20,
+        min_interval_sec: float = 60,
+        max_staleness_sec: float = 1800,
+        max_threshold: int = 50,
+        rate_alpha: float = 0.2,
+        clock: Optional[SystemClock] = None,
+    ):
+        self.clock = clock or SystemClock()
+        self.trigger_threshold = max(1, int(trigger_threshold))
+        self.min_interval_sec = max(0.0, float(min_interval_sec))
+        self.max_staleness_sec = max(0.0, float(max_staleness_sec))
+        # 有效阈值不能超过缓冲区容量，否则消息还没轮到总结就被挤掉了。
+        self.max_threshold = max(self.trigger_threshold, int(max_threshold))
+        self.rate_alpha = min(1.0, max(0.01, float(rate_alpha)))
+        self.mean_arrival_gap_sec: Optional[float] = None
+        self.last_arrival_time: Optional[float] = None
+        self.last_summary_time = self.clock.now()
+        # 预算紧张时由观察者调大，最小间隔和最大陈旧度都按这个倍数拉长。
+        self.backoff_factor = 1
+
+    def set_clock(self, clock: SystemClock) -> None:
+        """换时钟后从新时钟的当前时刻重新计时：上次总结视为刚刚发生，到达间隔重新估计。"""
+        self.clock = clock
+        self.last_summary_time = clock.now()
+        self.last_arrival_time = None
+
+    def record_arrival(self, now: Optional[float] = None) -> None:
+        now = self.clock.now() if now is None else now
+        if self.last_arrival_time is not None:
+            gap = max(0.0, now - self.last_arrival_time)
+            if self.mean_arrival_gap_sec is None:
+                self.mean_arrival_gap_sec = gap
+            else:
+                self.mean_arrival_gap_sec = self.rate_alpha * gap + (1 - self.rate_alpha) * self.mean_arrival_gap_sec
+        self.last_arrival_time = now
+
+    def arrival_rate_per_sec(self, now: Optional[float] = None) -> float:
+        """当前估计的消息到达速率；长时间没有新消息时按“距上条消息的时长”衰减，避免速率停留在高峰值。"""
+        if self.mean_arrival_gap_sec is None or self.last_arrival_time is None:
+            return 0.0
+        now = self.clock.now() if now is None else now
+        effective_gap = max(self.mean_arrival_gap_sec, now - self.last_arrival_time)
+        if effective_gap <= 0:
+            return float(self.max_threshold)
+        return 1.0 / effective_gap
+
+    def effective_threshold(self, now: Optional[float] = None) -> int:
+        expected_in_interval = math.ceil(self.arrival_rate_per_sec(now) * self.min_interval_sec * self.backoff_factor)
+        return max(self.trigger_threshold, min(self.max_threshold, expected_in_interval))
+
+    def should_summarize(self, pending_count: int, now: Optional[float] = None) -> Tuple[bool, str]:
+        """返回 `(是否触发, 原因)`，原因为 `count` / `stale` / 空字符串。"""
+        if pending_count <= 0:
+            return False, ""
+        now = self.clock.now() if now is None else now
+        since_last_summary = now - self.last_summary_time
+        if self.max_staleness_sec > 0 and since_last_summary >= self.max_staleness_sec * self.backoff_factor:
+            return True, "stale"
+        if since_last_summary < self.min_interval_sec * self.backoff_factor:
+            return False, ""
+        if pending_count >= self.effective_threshold(now):
+            return True, "count"
+        return False, ""
+
+    def record_summary(self, now: Optional[float] = None) -> None:
+        self.last_summary_time = self.clock.now() if now is None else now
+
+    def snapshot(self, pending_count: int, now: Optional[float] = None) -> Dict[str, Any]:
+        now = self.clock.now() if now is None else now
+        return {
+            "pending_messages": pending_count,
+            "base_threshold": self.trigger_threshold,
+            "effective_threshold": self.effective_threshold(now),
+            "arrival_rate_per_min": round(self.arrival_rate_per_sec(now) * 60, 2),
+            "min_interval_sec": self.min_interval_sec,
+            "max_staleness_sec": self.max_staleness_sec,
+            "backoff_factor": self.backoff_factor,
+            "seconds_since_last_summary": round(max(0.0, now - self.last_summary_time), 1),
+        }
+
+
+class ObserverRole(IntEnum):
+    OTHER = 0
+    USER = 1
+    ASSISTANT = 2
+
+
+class ObserverMessage:
+    """观察者缓冲区里的一条紧凑消息记录。
+
+    只保存结构化字段：subject_id / 发送者名字做 intern，角色用枚举，正文按上限截断；
+    `[subject_id:...] [role:...]` 这种提示词格式只在真正送去总结时才渲染，避免缓冲区里常驻大段重复前缀。
+    """
+
+    __slots__ = ("seq", "subject_id", "role", "sender_name", "timestamp", "text", "content_hash")
+
+    def __init__(
+        self,
+        subject_id: str,
+        role: ObserverRole,
+        text: str,
+        sender_name: str = "",
+        timestamp: float = 0.0,
+        seq: int = 0,
+        content_hash: str = "",
+    ):
+        self.seq = seq
+        self.subject_id = sys.intern(subject_id)
+        self.role = role
+        self.sender_name = sys.intern(sender_name) if sender_name else ""
+        self.timestamp = timestamp
+        self.text = text
+        self.content_hash = content_hash
+
+    def render(self) -> str:
+        if self.role == ObserverRole.USER:
+            return f"[subject_id:{self.subject_id}] [role:user,name:{self.sender_name}]: {self.text}"
+        if self.role == ObserverRole.ASSISTANT:
+            return f"[subject_id:{self.subject_id}] [role:assistant,reply to user:name:{self.sender_name}]: {self.text}"
+        return f"[subject_id:{self.subject_id}] {self.text}"
+
+    def to_record(self) -> Dict[str, Any]:
+        return {
+            "type": "message",
+            "seq": self.seq,
+            "subject_id": self.subject_id,
+            "role": int(self.role),
+            "name": self.sender_name,
+            "ts": self.timestamp,
+            "text": self.text,
+            "hash": self.content_hash,
+        }
+
+
+class ObserverJournal:
+    """全局观察者的追加式持久化日志（JSON Lines）。
+
+    每条进入缓冲区的消息、每次成功的总结都追加一行，不做整文件重写，热路径上只是一次小的 append。
+    行数超过 max_records 时由观察者把当前缓冲区和最近总结压缩成一份快照重写回来，
+    所以文件大小始终有界。重启后按顺序回放即可恢复缓冲区和上一轮总结。
+
+    redact 为 True 时消息记录整条不写，聊天原文、昵称和会话 id 都不落盘，热路径上也省掉这次写入；
+    日志里只剩总结记录，重启后只能恢复上一轮总结，缓冲区从空开始重新积累。
+    """
+
+    def __init__(self, path: Path, max_records: int = 200, redact: bool = True):
+        self.path = path
+        self.max_records = max(1, int(max_records))
+        self.redact = bool(redact)
+        self.record_count = 0
+
+    def _keep(self, record: Dict[str, Any]) -> bool:
+        return not (self.redact and record.get("type") == "message")
+
+    def append(self, record: Dict[str, Any]) -> None:
+        if not self._keep(record):
+            return
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with self.path.open("a", encoding="utf-8") as journal_file:
+                journal_file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+        except OSError as e:
+            logger.warning(f"Failed to append observer journal: {e}")
+            return
+        self.record_count += 1
+
+    def needs_compaction(self) -> bool:
+        return self.record_count > self.max_records
+
+    def load(self) -> List[Dict[str, Any]]:
+        """读取全部记录；损坏的行（例如进程在写入中途退出留下的半行）直接跳过。"""
+        if not self.path.exists():
+            return []
+
+        records: List[Dict[str, Any]] = []
+        try:
+            with self.path.open("r", encoding="utf-8") as journal_file:
+                for line in journal_file:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict):
+                        records.append(record)
+        except OSError as e:
+            logger.warning(f"Failed to read observer journal: {e}")
+            return []
+
+        self.record_count = len(records)
+        return records
+
+    def rewrite(self, records: List[Dict[str, Any]]) -> None:
+        """用快照原子替换整个日志文件。"""
+        records = [record for record in records if self._keep(record)]
+        temp_path = self.path.with_suffix(self.path.suffix + ".tmp")
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path.write_text(
+                "".join(
+                    json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n"
+                    for record in records
+                ),
+                encoding="utf-8",
+            )
+            temp_path.replace(self.path)
+        except OSError as e:
+            logger.warning(f"Failed to compact observer journal: {e}")
+            return
+        self.record_count = len(records)
+
+    def delete(self) -> None:
+        try:
+            self.path.unlink(missing_ok=True)
+        except OSError as e:
+            logger.warning(f"Failed to delete observer journal: {e}")
+            return
+        self.record_count = 0
+
+
+class GlobalObserver:
+    # 确定性合并分块总结时最多保留的事件数和 summary 字数，与 send_prompt 里要求模型遵守的上限一致。
+    MAX_MERGED_EVENTS = 5
+    MAX_SUMMARY_CHARS = 50
+    # 模型输出无法解析时使用的占位总结；分块总结遇到它说明这一块其实失败了。
+    FALLBACK_SUMMARY = "最近发生了一些跨用户互动。"
+    # send_prompt 的固定指令部分大约占用的 token，用于调用前的预算估算。
+    SYSTEM_PROMPT_TOKEN_ESTIMATE = 600
+    # 近似去重只看消息开头这么多个 3-gram，长回复的差异基本都体现在前面，也能把热路径开销压住。
+    SIMHASH_MAX_GRAMS = 256
+
+    def __init__(
+        self,
+        max_size=50,
+        trigger_threshold = 20,
+        full_refresh_rounds = 5,
+        subject_max_size = 0,
+        sample_size = 0,
+        map_reduce_threshold = 0,
+        map_chunk_size = 20,
+        map_chunk_by = "subject",
+        map_concurrency = 3,
+        reduce_with_llm = False,
+        dedupe_window = 20,
+        near_duplicate_bits = 0,
+        min_interval_sec = 60,
+        max_staleness_sec = 1800,
+        provider_id = "",
+        fallback_provider_ids = None,
+        fallback_to_chat_provider = True,
+        provider_timeout_sec = 30,
+        max_output_chars = 2000,
+        budget: Optional[TokenBudget] = None,
+        journal: Optional[ObserverJournal] = None,
+        message_max_chars = 500,
+        metrics: Optional[PluginMetrics] = None,
+        profiler: Optional[HandlerProfiler] = None,
+        clock: Optional[SystemClock] = None,
+    ):
+        # 消息时间戳和总结调度都从这个时钟取时间，模拟和回放时与状态引擎共用同一个虚拟时钟。
+        self.clock = clock or SystemClock()
+        # 消息按 subject_id 分区缓存：{subject_id: deque[ObserverMessage]}。
+        # 单个 subject 有自己的上限，总条数再受 max_size 约束；超出总上限时从当前最大的分区淘汰，
+        # 这样某个特别活跃的群不会把其它会话的消息全部挤掉。
+        self.max_size = max(1, int(max_size))
+        # subject_max_size <= 0 表示不单独限制单个会话，只受总上限约束。
+        self.subject_max_size = min(self.max_size, int(subject_max_size)) if int(subject_max_size) > 0 else self.max_size
+        self.subject_buffers: Dict[str, deque] = {}
+        self.buffered_message_count = 0
+        # seq 是全局递增的到达序号，用来还原跨分区的时间顺序，并区分哪些消息已经总结过。
+        self.message_seq = 0
+        self.summarized_seq = 0
+        # 每轮送进模型的最多消息数；超出时按 subject 轮询公平抽样，0 表示沿用 max_size。
+        self.sample_size = int(sample_size) if int(sample_size) > 0 else self.max_size
+        # 单条消息正文的字符上限，长回复只保留开头部分；0 表示不截断。
+        self.message_max_chars = max(0, int(message_max_chars))
+        
+        # 我们可以顺便设一个触发阈值，比如每攒够 20 条新消息就触发一次总结
+        self.trigger_threshold = trigger_threshold
+        self.new_message_count = 0  
+        self.scheduler = SummarizationScheduler(
+            trigger_threshold=trigger_threshold,
+            min_interval_sec=min_interval_sec,
+            max_staleness_sec=max_staleness_sec,
+            max_threshold=self.max_size,
+            clock=self.clock,
+        )
+        
+        # 用来存储大模型总结出来的“当前状态”
+        self.current_state: Dict[str, Any] = {}
+
+        # 增量总结：平时只把上次成功总结之后新增的消息连同上一轮总结发给模型；
+        # 每隔 full_refresh_rounds 轮再用整个缓冲区重新总结一次，纠正增量累积的漂移。
+        # 设为 1 等价于每次都全量总结。
+        self.full_refresh_rounds = max(1, int(full_refresh_rounds))
+        self.incremental_rounds = 0
+        # 总结请求在途时不再重复触发，避免并发请求把同一批消息重复送给模型。
+        self._summarization_in_flight = False
+        self._summarization_task: Optional[asyncio.Task] = None
+        # /reset 的代数；总结开始时记下，写回前对不上就说明中途被清空过。
+        self._reset_epoch = 0
+
+        # 总结模型路由：可以指定一个与聊天主模型不同的（更便宜、更快的）provider，并配置回退链。
+        # 未配置时沿用当前会话正在使用的 provider。每次调用都有超时，超时或全部失败时保留上一轮总结。
+        self.provider_id = str(provider_id or "").strip()
+        self.fallback_provider_ids = [
+            str(fallback_id).strip()
+            for fallback_id in (fallback_provider_ids or [])
+            if str(fallback_id).strip()
+        ]
+        self.fallback_to_chat_provider = bool(fallback_to_chat_provider)
+        self.provider_timeout_sec = max(0.0, float(provider_timeout_sec))
+        self.max_output_chars = max(0, int(max_output_chars))
+        self.budget = budget or TokenBudget()
+        # 可选的持久化日志；为 None 时观察者只存在于内存里。
+        self.journal = journal
+        self.metrics = metrics or PluginMetrics()
+        self.profiler = profiler
+        # subject_id -> events 的索引，每次总结更新时重建，注入时按会话直接取，不再逐条扫描。
+        self.events_by_subject: Dict[str, List[Dict[str, str]]] = {}
+
+        # 分块并发总结：全量总结的输入超过 map_reduce_threshold 条时，把缓冲区切块并发总结再合并。
+        # 0 表示关闭，始终单次调用。
+        self.map_reduce_threshold = max(0, int(map_reduce_threshold))
+        self.map_chunk_size = max(1, int(map_chunk_size))
+        self.map_chunk_by = "size" if str(map_chunk_by).strip().lower() == "size" else "subject"
+        self.map_concurrency = max(1, int(map_concurrency))
+        self.reduce_with_llm = bool(reduce_with_llm)
+
+        # 去重：每个 subject 记住最近 dedupe_window 条消息的指纹，完全重复或 simhash 汉明距离
+        # 不超过 near_duplicate_bits 的消息直接丢弃，不进缓冲也不计入触发计数。
+        # 这样 add_state 每轮回填的上一条助手回复、重试和刷屏都不会把缓冲区塞满重复内容。
+        self.dedupe_window = max(0, int(dedupe_window))
+        self.near_duplicate_bits = max(0, int(near_duplicate_bits))
+        self._recent_fingerprints: Dict[str, deque] = {}
+        # 上一次成功总结时缓冲区内容的指纹；内容没有实质变化时直接跳过模型调用。
+        self.last_summary_fingerprint = ""
+
+    @property
+    def recent_messages(self) -> List[str]:
+        """按到达顺序合并所有分区的消息文本。"""
+        merged = heapq.merge(*self.subject_buffers.values(), key=lambda message: message.seq)
+        return [message.render() for message in merged]
+
+    def _normalize_for_fingerprint(self, text: str) -> str:
+        """去掉大小写、空白和标点差异，只保留用来判断“内容是否相同”的字符。"""
+        return re.sub(r"[\W_]+", "", str(text).lower())
+
+    def _content_hash(self, normalized_text: str) -> str:
+        return hashlib.blake2b(normalized_text.encode("utf-8"), digest_size=8).hexdigest()
+
+    def _simhash(self, normalized_text: str) -> int:
+        """基于字符 3-gram 的 64 位 simhash，只取前 SIMHASH_MAX_GRAMS 个 gram 控制热路径开销。"""
+        if len(normalized_text) < 3:
+            grams = [normalized_text]
+        else:
+            grams = [normalized_text[index:index + 3] for index in range(min(len(normalized_text) - 2, self.SIMHASH_MAX_GRAMS))]
+
+        # 只统计每一位被置 1 的次数，超过半数的位在指纹里置 1，等价于经典 simhash 的 ±1 加权。
+        set_bit_counts = [0] * 64
+        for gram in grams:
+            gram_hash = int.from_bytes(hashlib.blake2b(gram.encode("utf-8"), digest_size=8).digest(), "big")
+            while gram_hash:
+                lowest_bit = gram_hash & -gram_hash
+                set_bit_counts[lowest_bit.bit_length() - 1] += 1
+                gram_hash ^= lowest_bit
+
+        fingerprint = 0
+        for bit, count in enumerate(set_bit_counts):
+            if count * 2 > len(grams):
+                fingerprint |= 1 << bit
+        return fingerprint
+
+    @staticmethod
+    def _author_key(message: ObserverMessage) -> Tuple[int, str]:
+        return int(message.role), message.sender_name
+
+    def _is_duplicate_message(self, message: ObserverMessage, simhash: int) -> bool:
+        """判断消息是否与该 subject 最近窗口内的消息完全重复或近似重复。
+
+        完全重复的哈希本身已包含角色和发送者；近似重复也只在同一角色、同一发送者的消息之间比较，
+        助手接着用户说同一句“晚安”、群里另一个人也说“晚安”都不算重复。
+        """
+        author_key = self._author_key(message)
+        for recent_hash, recent_simhash, recent_author_key in self._recent_fingerprints.get(message.subject_id, ()):
+            if recent_hash == message.content_hash:
+                return True
+            if (
+                self.near_duplicate_bits
+                and recent_author_key == author_key
+                and bin(recent_simhash ^ simhash).count("1") <= self.near_duplicate_bits
+            ):
+                return True
+        return False
+
+    def _remember_fingerprint(self, message: ObserverMessage, simhash: int) -> None:
+        window = self._recent_fingerprints.get(message.subject_id)
+        if window is None:
+            window = self._recent_fingerprints[message.subject_id] = deque(maxlen=self.dedupe_window)
+        window.append((message.content_hash, simhash, self._author_key(message)))
+
+    def _buffer_fingerprint(self) -> str:
+        """整个缓冲区有效内容的指纹：只看各条消息的内容哈希，不看到达序号。"""
+        content_hashes = sorted(
+            message.content_hash
+            for buffer in self.subject_buffers.values()
+            for message in buffer
+        )
+        return hashlib.blake2b("|".join(content_hashes).encode("utf-8"), digest_size=16).hexdigest()
+
+    def _message_content_hash(self, message: ObserverMessage) -> str:
+        return self._content_hash(self._normalize_for_fingerprint(
+            f"{message.subject_id}|{int(message.role)}|{message.sender_name}|{message.text}"
+        ))
+
+    def _append_message(self, message: ObserverMessage) -> None:
+        buffer = self.subject_buffers.get(message.subject_id)
+        if buffer is None:
+            buffer = self.subject_buffers[message.subject_id] = deque(maxlen=self.subject_max_size)
+        if len(buffer) == buffer.maxlen:
+            # deque 满了会自动挤掉该分区最旧的一条，总数要同步扣掉。
+            self.buffered_message_count -= 1
+
+        self.message_seq += 1
+        message.seq = self.message_seq
+        message.content_hash = message.content_hash or self._message_content_hash(message)
+        buffer.append(message)
+        self.buffered_message_count += 1
+
+        while self.buffered_message_count > self.max_size:
+            self._evict_one()
+
+        if self.journal and not self.journal.redact:
+            with self.metrics.span("observer.journal_write"):
+                self.journal.append(message.to_record())
+                if self.journal.needs_compaction():
+                    self._compact_journal()
+
+    def _summary_journal_record(self) -> Dict[str, Any]:
+        return {
+            "type": "summary",
+            "state": self.current_state,
+            "summarized_seq": self.summarized_seq,
+            "fingerprint": self.last_summary_fingerprint,
+            "summary_time": self.scheduler.last_summary_time,
+        }
+
+    def _compact_journal(self) -> None:
+        """把当前缓冲区和最近一轮总结写成快照，替换掉不断增长的日志。"""
+        records: List[Dict[str, Any]] = [
+            message.to_record()
+            for message in heapq.merge(*self.subject_buffers.values(), key=lambda message: message.seq)
+        ]
+        if self.current_state:
+            records.append(self._summary_journal_record())
+        self.journal.rewrite(records)
+
+    def _journal_summary(self) -> None:
+        if self.journal:
+            self.journal.append(self._summary_journal_record())
+
+    def restore_from_journal(self) -> int:
+        """重启时回放持久化日志，恢复缓冲区、上一轮总结和未总结计数。返回恢复的消息条数。"""
+        if not self.journal:
+            return 0
+
+        with self.metrics.span("observer.journal_load"):
+            records = self.journal.load()
+        journal = self.journal
+        # 回放期间不能再往日志里写，否则每次重启都会把旧记录重复追加一遍。
+        self.journal = None
+        try:
+            for record in records:
+                if record.get("type") == "message":
+                    try:
+                        seq = int(record["seq"])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    text = str(record.get("text", ""))
+                    if "role" not in record:
+                        # 旧版日志里存的是已经渲染好的整行文本，去掉 subject 前缀，避免渲染时重复。
+                        text = re.sub(r"^\[subject_id:[^\]]*\]\s*", "", text)
+                    if not text.strip():
+                        continue
+                    try:
+                        role = ObserverRole(int(record.get("role", ObserverRole.OTHER)))
+                        timestamp = float(record.get("ts", 0.0))
+                    except (TypeError, ValueError):
+                        role, timestamp = ObserverRole.OTHER, 0.0
+                    message = ObserverMessage(
+                        subject_id=self._normalize_subject_id(record.get("subject_id"), fallback="global"),
+                        role=role,
+                        text=text,
+                        sender_name=str(record.get("name", "")),
+                        timestamp=timestamp,
+                        content_hash=str(record.get("hash", "")),
+                    )
+                    self.message_seq = seq - 1
+                    self._append_message(message)
+                    if self.dedupe_window > 0:
+                        self._remember_fingerprint(message, self._simhash(self._normalize_for_fingerprint(text)))
+                elif record.get("type") == "summary":
+                    normalized_summary = self._normalize_recent_summary(record.get("state"))
+                    if normalized_summary:
+                        self._apply_recent_summary(normalized_summary)
+                    try:
+                        self.summarized_seq = int(record.get("summarized_seq", 0))
+                        # 脱敏日志里没有消息记录，序号要从总结记录里接上，新消息才不会落在 summarized_seq 之前。
+                        self.message_seq = max(self.message_seq, self.summarized_seq)
+                        self.scheduler.last_summary_time = float(record.get("summary_time", self.scheduler.last_summary_time))
+                    except (TypeError, ValueError):
+                        pass
+                    self.last_summary_fingerprint = str(record.get("fingerprint", ""))
+        finally:
+            self.journal = journal
+
+        self.summarized_seq = min(self.summarized_seq, self.message_seq)
+        self.new_message_count = sum(
+            1
+            for buffer in self.subject_buffers.values()
+            for message in buffer
+            if message.seq > self.summarized_seq
+        )
+        self._compact_journal()
+        return self.buffered_message_count
+
+    def set_clock(self, clock: SystemClock) -> None:
+        self.clock = clock
+        self.scheduler.set_clock(clock)
+
+    def reset(self) -> None:
+        """清空缓冲区、最近总结和持久化日志。
+
+        同时取消后台总结任务并推进 reset 代数；空闲兜底那种直接 await 的总结取消不到，
+        返回后看到代数变了就丢弃结果，不会把旧总结和日志写回来。
+        """
+        self._reset_epoch += 1
+        self.cancel_background_summarization()
+        self.subject_buffers.clear()
+        self.buffered_message_count = 0
+        self._recent_fingerprints.clear()
+        self.summarized_seq = self.message_seq
+        self.new_message_count = 0
+        self.incremental_rounds = 0
+        self.current_state = {}
+        self.events_by_subject = {}
+        self.last_summary_fingerprint = ""
+        if self.journal:
+            self.journal.delete()
+
+    def _evict_one(self) -> None:
+        """从当前消息最多的分区淘汰一条最旧消息；同样大小时先淘汰更早的分区。"""
+        victim_subject_id, victim_buffer = max(
+            self.subject_buffers.items(),
+            key=lambda item: (len(item[1]), -item[1][0].seq),
+        )
+        victim_buffer.popleft()
+        self.buffered_message_count -= 1
+        if not victim_buffer:
+            del self.subject_buffers[victim_subject_id]
+            self._recent_fingerprints.pop(victim_subject_id, None)
+
+    def _sample_messages(self, after_seq: int, limit: int) -> List[str]:
+        """取出序号大于 after_seq 的消息；超过 limit 时按 subject 轮询，从各分区最新的消息开始公平抽样。"""
+        return [text for _, _, text in self._sample_entries(after_seq, limit)]
+
+    def _sample_entries(self, after_seq: int, limit: int) -> List[Tuple[int, str, str]]:
+        """同 `_sample_messages`，但保留 `(seq, subject_id, text)`，供分块总结按 subject 切分。"""
+        candidates = [
+            [(message.seq, subject_id, message.render()) for message in buffer if message.seq > after_seq]
+            for subject_id, buffer in self.subject_buffers.items()
+        ]
+        candidates = [entries for entries in candidates if entries]
+
+        if sum(len(entries) for entries in candidates) <= limit:
+            selected = [entry for entries in candidates for entry in entries]
+        else:
+            selected = []
+            while len(selected) < limit:
+                for entries in candidates:
+                    if entries and len(selected) < limit:
+                        selected.append(entries.pop())
 
-        return next_state
+        selected.sort(key=lambda entry: entry[0])
+        return selected
 
-# class StateManager: 本来想写不同ID独立状态的，想了想还是算了
-#     def __init__(self):
-#         self.character_states =    
+    def _apply_recent_summary(self, normalized_summary: Dict[str, Any]) -> None:
+        """更新当前总结，并重建 subject -> events 索引。"""
+        events_by_subject: Dict[str, List[Dict[str, str]]] = {}
+        for event_data in normalized_summary.get("events", []):
+            events_by_subject.setdefault(event_data["subject_id"], []).append(event_data)
 
+        self.current_state = normalized_summary
+        self.events_by_subject = events_by_subject
 
-class GlobalObserver:
-    def __init__(self, max_size=50, trigger_threshold = 20):
-        self.recent_messages = deque(maxlen=max_size)
-        
-        # 我们可以顺便设一个触发阈值，比如每攒够 20 条新消息就触发一次总结
-        self.trigger_threshold = trigger_threshold
-        self.new_message_count = 0  
-        
-        # 用来存储大模型总结出来的“当前状态”
-        self.current_state: Dict[str, Any] = {}
+    def get_events_for_subject(self, subject_id: str) -> Tuple[List[Dict[str, str]], int]:
+        """返回对当前会话可见的事件（global + 当前 subject）以及被省略的其它 subject 事件数。"""
+        visible_events = list(self.events_by_subject.get("global", []))
+        if subject_id != "global":
+            visible_events.extend(self.events_by_subject.get(subject_id, []))
+        total_events = sum(len(events) for events in self.events_by_subject.values())
+        return visible_events, total_events - len(visible_events)
 
     def _normalize_subject_id(self, value: Any, fallback: str = "global") -> str:
         text = str(value).strip() if value is not None else ""
+        if text.lower() == "global":
+            return "global"
         return text or fallback
 
     def _normalize_recent_event(self, event_data: Any) -> Optional[Dict[str, str]]:
@@ -641,8 +3233,9 @@ class GlobalObserver:
             parsed = json_repair.loads(candidate_text)
         except Exception as e:
             logger.warning(f"Failed to parse recent summary JSON, using safe fallback. Error: {e}")
+            self.metrics.increment("observer.summary_parse_failures")
             return {
-                "summary": "最近发生了一些跨用户互动。",
+                "summary": self.FALLBACK_SUMMARY,
                 "events": [],
             }
 
@@ -651,38 +3244,129 @@ class GlobalObserver:
             return normalized
 
         return {
-            "summary": "最近发生了一些跨用户互动。",
+            "summary": self.FALLBACK_SUMMARY,
             "events": [],
         }
 
-    async def add_message(self, message_text, event, context):
+    async def add_message(self, message_text, event, context, role: ObserverRole = ObserverRole.OTHER, sender_name: str = ""):
         """积累最近对话，供全局观察者做短期环境总结。
 
         这个观察者只负责“最近聊了什么、氛围如何”，不负责定义物理状态真相；
         真正的全局身体/情绪状态仍以 CharacterState 为准。
         """
-        if not str(message_text).strip():
+        text = str(message_text).strip()
+        if not text:
             return
 
-        subject_id = self._normalize_subject_id(getattr(event, "unified_msg_origin", None), fallback="global")
-        normalized_message = str(message_text)
-        if "[subject_id:" not in normalized_message:
-            normalized_message = f"[subject_id:{subject_id}] {normalized_message}"
+        if self.message_max_chars and len(text) > self.message_max_chars:
+            text = text[:self.message_max_chars] + "…"
 
-        self.recent_messages.append(normalized_message)
+        message = ObserverMessage(
+            subject_id=self._normalize_subject_id(getattr(event, "unified_msg_origin", None), fallback="global"),
+            role=role,
+            text=text,
+            sender_name=str(sender_name or "").strip(),
+            timestamp=self.clock.now(),
+        )
+        message.content_hash = self._message_content_hash(message)
+        subject_id = message.subject_id
+        if self.dedupe_window > 0:
+            simhash = self._simhash(self._normalize_for_fingerprint(text))
+            if self._is_duplicate_message(message, simhash):
+                logger.debug("Global observer dropped duplicate message for subject %s", subject_id)
+                self.metrics.increment("observer.duplicates_dropped")
+                return
+            self._remember_fingerprint(message, simhash)
+
+        self._append_message(message)
         self.new_message_count += 1
+        self.scheduler.record_arrival()
+        self.scheduler.backoff_factor = self.budget.degradation_factor()
         
         # 检查是否达到了触发总结的条件
-        if self.new_message_count >= self.trigger_threshold:
-            if await self._trigger_summarization(event, context):
-                self.new_message_count = 0  # 重置计数器
+        should_summarize, _ = self.scheduler.should_summarize(self.new_message_count)
+        if should_summarize and not self._summarization_in_flight:
+            # 总结放到后台任务里跑，当前这次用户请求不用等总结模型返回；
+            # 总结模型慢或不可用时，注入的仍是上一轮总结。
+            self._summarization_in_flight = True
+            self._summarization_task = asyncio.create_task(self._trigger_summarization(event, context))
+
+    def cancel_background_summarization(self) -> None:
+        if self._summarization_task and not self._summarization_task.done():
+            self._summarization_task.cancel()
+        self._summarization_task = None
+
+    async def flush_if_stale(self, context) -> bool:
+        """空闲兜底：没有新消息进来时，由插件后台循环调用，把陈旧的未总结消息刷进总结。"""
+        should_summarize, reason = self.scheduler.should_summarize(self.new_message_count)
+        if not should_summarize or reason != "stale" or self._summarization_in_flight:
+            return False
+        return await self._trigger_summarization(None, context)
+
+    def _should_use_full_summarization(self) -> bool:
+        """判断这一轮是否需要用整个缓冲区重新总结。"""
+        if not self.current_state:
+            return True
+        return self.incremental_rounds + 1 >= self.full_refresh_rounds
+
+    def _build_incremental_prompt(self, new_messages: List[str]) -> str:
+        """把上一轮总结和新增消息拼成增量总结的输入。"""
+        previous_summary = json.dumps(self.current_state, ensure_ascii=False, separators=(",", ":"))
+        return (
+            "<previous_summary>\n"
+            f"{previous_summary}\n"
+            "</previous_summary>\n"
+            "<new_messages>\n"
+            + "\n".join(new_messages)
+            + "\n</new_messages>"
+        )
     
     async def _trigger_summarization(self,event, context):
-        """触发后台总结逻辑。"""
-        
+        """触发后台总结逻辑。
+
+        成功时只扣掉本轮真正送进模型的消息数；总结在途期间新到的消息会留到下一轮，
+        不会因为计数器被直接清零而在增量模式下永远漏掉。
+        """
+        self._summarization_in_flight = True
+        try:
+            with self.metrics.span("observer.summarize", blocking=False):
+                return await self._run_summarization(event, context)
+        finally:
+            self._summarization_in_flight = False
+
+    async def _run_summarization(self, event, context):
         # 1. 把 deque 里的消息拿出来拼成一段文本
-        # 注意：这里我们只要文本，不带 user_id，彻底隔绝隐私
-        chat_history_text = "\n".join(self.recent_messages)
+        # 注意：送给模型的只有正文、角色和昵称，不带 user_id；落盘的日志默认关闭，开启时也默认只写哈希（见 ObserverJournal）
+        snapshot_seq = self.message_seq
+        reset_epoch = self._reset_epoch
+        buffer_fingerprint = self._buffer_fingerprint()
+        if self.current_state and buffer_fingerprint == self.last_summary_fingerprint:
+            # 缓冲区有效内容与上次总结时完全相同，再调一次模型只会得到同样的结果。
+            logger.debug("Global observer buffer unchanged since last summary, skipping summarization")
+            self.metrics.increment("observer.summary_cache_hits")
+            self.scheduler.record_summary()
+            self.summarized_seq = snapshot_seq
+            self.new_message_count = self.message_seq - snapshot_seq
+            self._journal_summary()
+            return True
+
+        use_full_summarization = self._should_use_full_summarization()
+        # 预算紧张时按降级倍数缩小送进模型的窗口。
+        sample_limit = max(1, self.sample_size // self.budget.degradation_factor())
+        full_entries: List[Tuple[int, str, str]] = []
+        if use_full_summarization:
+            full_entries = self._sample_entries(0, sample_limit)
+            chat_history_text = "\n".join(text for _, _, text in full_entries)
+        else:
+            new_messages = self._sample_messages(self.summarized_seq, sample_limit)
+            chat_history_text = self._build_incremental_prompt(new_messages)
+
+        estimated_tokens = TokenBudget.estimate_tokens(chat_history_text) + self.SYSTEM_PROMPT_TOKEN_ESTIMATE
+        if not self.budget.can_spend(estimated_tokens):
+            logger.info(f"Global observer token budget exhausted, deferring summarization (~{estimated_tokens} tokens)")
+            self.budget.record_deferred_call()
+            self.metrics.increment("observer.summaries_deferred_by_budget")
+            return False
         
         # 2. 这里将来会调用大模型API，传入 chat_history_text
         # task_prompt = (f"你是一个系统后台的“认知状态提取器。\n"
@@ -693,20 +3377,169 @@ class GlobalObserver:
         #                 f"以下是你最近与多位用户的聊天记录。assistant表示AI助手的回复，user表示用户的提问：\n"
         #                 f"{chat_history_text}\n"
         #                 )
-        try:
-            summary = await self.send_prompt(event, context, extra_prompt=chat_history_text)
-        except Exception as e:
-            logger.warning(f"Global observer summarization failed: {e}")
-            return False
+        if use_full_summarization and 0 < self.map_reduce_threshold < len(full_entries):
+            normalized_summary = await self._map_reduce_summarization(event, context, full_entries)
+        else:
+            try:
+                summary = await self.send_prompt(
+                    event,
+                    context,
+                    extra_prompt=chat_history_text,
+                    mode="full" if use_full_summarization else "incremental",
+                )
+            except Exception as e:
+                logger.warning(f"Global observer summarization failed: {e}")
+                self.metrics.increment("observer.summarization_failures")
+                return False
 
-        normalized_summary = self._parse_recent_summary(summary)
+            normalized_summary = self._parse_recent_summary(summary)
         if not normalized_summary:
+            self.metrics.increment("observer.summarization_failures")
+            return False
+        if reset_epoch != self._reset_epoch:
+            # 等模型返回期间被 /reset 清空过，这份总结描述的是已经丢弃的消息。
+            self.metrics.increment("observer.summaries_discarded_after_reset")
             return False
 
-        self.current_state = normalized_summary
+        self._apply_recent_summary(normalized_summary)
+        self.last_summary_fingerprint = buffer_fingerprint
+        self.scheduler.record_summary()
+        self.summarized_seq = snapshot_seq
+        self.new_message_count = self.message_seq - snapshot_seq
+        self.incremental_rounds = 0 if use_full_summarization else self.incremental_rounds + 1
+        self._journal_summary()
         return True
 
-    async def send_prompt(self, event, context, extra_prompt=""):
+    def _chunk_entries(self, entries: List[Tuple[int, str, str]]) -> List[List[Tuple[int, str, str]]]:
+        """把待总结消息切成若干块。
+
+        `subject` 模式先按 subject 分组，再把小分组按到达顺序装箱到 chunk 上限内，
+        这样同一个会话的上下文尽量落在同一块里；`size` 模式直接按条数顺序切分。
+        """
+        if self.map_chunk_by != "subject":
+            return [
+                entries[index:index + self.map_chunk_size]
+                for index in range(0, len(entries), self.map_chunk_size)
+            ]
+
+        groups: Dict[str, List[Tuple[int, str, str]]] = {}
+        for entry in entries:
+            groups.setdefault(entry[1], []).append(entry)
+
+        chunks: List[List[Tuple[int, str, str]]] = []
+        current_chunk: List[Tuple[int, str, str]] = []
+        for group in groups.values():
+            for index in range(0, len(group), self.map_chunk_size):
+                piece = group[index:index + self.map_chunk_size]
+                if current_chunk and len(current_chunk) + len(piece) > self.map_chunk_size:
+                    chunks.append(current_chunk)
+                    current_chunk = []
+                current_chunk.extend(piece)
+        if current_chunk:
+            chunks.append(current_chunk)
+
+        for chunk in chunks:
+            chunk.sort(key=lambda entry: entry[0])
+        return chunks
+
+    async def _map_reduce_summarization(self, event, context, entries: List[Tuple[int, str, str]]) -> Dict[str, Any]:
+        """大窗口下的分块并发总结。
+
+        map 阶段每块独立总结，并发数受 map_concurrency 限制；某一块失败或只得到占位总结时只丢掉这一块。
+        reduce 阶段默认做确定性合并，开启 reduce_with_llm 时再让模型合并一次，失败则回落到确定性合并。
+        """
+        chunks = self._chunk_entries(entries)
+        semaphore = asyncio.Semaphore(self.map_concurrency)
+
+        async def _summarize_chunk(chunk: List[Tuple[int, str, str]]) -> Dict[str, Any]:
+            async with semaphore:
+                try:
+                    raw_summary = await self.send_prompt(
+                        event,
+                        context,
+                        extra_prompt="\n".join(text for _, _, text in chunk),
+                    )
+                except Exception as e:
+                    logger.warning(f"Global observer chunk summarization failed: {e}")
+                    return {}
+            return self._parse_recent_summary(raw_summary)
+
+        partial_summaries = []
+        for partial in await asyncio.gather(*(_summarize_chunk(chunk) for chunk in chunks)):
+            if self._is_fallback_summary(partial):
+                self.metrics.increment("observer.chunk_summaries_dropped")
+            elif partial:
+                partial_summaries.append(partial)
+        if not partial_summaries:
+            return {}
+        if len(partial_summaries) == 1:
+            return partial_summaries[0]
+
+        if self.reduce_with_llm:
+            reduce_prompt = "\n".join(
+                json.dumps(partial, ensure_ascii=False, separators=(",", ":"))
+                for partial in partial_summaries
+            )
+            try:
+                merged_summary = self._parse_recent_summary(
+                    await self.send_prompt(event, context, extra_prompt=reduce_prompt, mode="reduce")
+                )
+                if merged_summary and not self._is_fallback_summary(merged_summary):
+                    return merged_summary
+            except Exception as e:
+                logger.warning(f"Global observer reduce summarization failed, using deterministic merge: {e}")
+
+        return self._merge_partial_summaries(partial_summaries)
+
+    def _is_fallback_summary(self, summary: Dict[str, Any]) -> bool:
+        return summary.get("summary") == self.FALLBACK_SUMMARY and not summary.get("events")
+
+    def _merge_partial_summaries(self, partial_summaries: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """把多份分块总结确定性地合并回 `{summary, events}`。
+
+        summary 去重后按顺序拼接，拼到 MAX_SUMMARY_CHARS 字为止，第一条本身超长时截断；
+        events 去重后按 subject 轮询取前 MAX_MERGED_EVENTS 条，避免某一块的事件占满名额。
+        """
+        summaries: List[str] = []
+        events_by_subject: Dict[str, List[Dict[str, str]]] = {}
+        seen_events = set()
+        for partial in partial_summaries:
+            summary = partial.get("summary", "")
+            if summary and summary not in summaries:
+                summaries.append(summary)
+            for event_data in partial.get("events", []):
+                event_key = (event_data["subject_id"], event_data["summary"])
+                if event_key in seen_events:
+                    continue
+                seen_events.add(event_key)
+                events_by_subject.setdefault(event_data["subject_id"], []).append(event_data)
+
+        merged_events: List[Dict[str, str]] = []
+        subject_queues = [deque(events) for events in events_by_subject.values()]
+        while subject_queues and len(merged_events) < self.MAX_MERGED_EVENTS:
+            for queue in subject_queues:
+                if queue and len(merged_events) < self.MAX_MERGED_EVENTS:
+                    merged_events.append(queue.popleft())
+            subject_queues = [queue for queue in subject_queues if queue]
+
+        merged_summary = summaries[0][:self.MAX_SUMMARY_CHARS] if summaries else ""
+        for summary in summaries[1:]:
+            if len(merged_summary) + 1 + len(summary) > self.MAX_SUMMARY_CHARS:
+                break
+            merged_summary += "；" + summary
+
+        return {
+            "summary": merged_summary,
+            "events": merged_events,
+        }
+
+    async def send_prompt(self, event, context, extra_prompt="", mode="full"):
+        if self.profiler is None:
+            return await self._send_prompt(event, context, extra_prompt, mode)
+        with self.profiler.profile("send_prompt"):
+            return await self._send_prompt(event, context, extra_prompt, mode)
+
+    async def _send_prompt(self, event, context, extra_prompt="", mode="full"):
         # provider_id = await self.context.get_current_chat_provider_id(uid)
         # logger.info(f"uid:{uid}")
 
@@ -728,45 +3561,343 @@ class GlobalObserver:
                         f"6. `subject_id` 必须直接使用输入记录里出现的 `[subject_id:xxx]` 标记值，不得自造、改写或省略。\n"
                         f"7. 不要输出可识别的具体用户名字；需要指代对象时只使用 `subject_id`。\n"
                         f"8. `summary` 最多 50 个字；每个 `events[].summary` 最多 30 个字；`events` 最多 5 条。\n"
-                        f"以下是你最近与多位用户的聊天记录。assistant表示AI助手的回复，user表示用户的提问：\n"
                     )
-        provider = context.get_using_provider()
-        llm_resp = await provider.text_chat(
-                prompt=extra_prompt,
-                session_id=None,
-                contexts="",
-                image_urls=[],
-                func_tool=None,
-                system_prompt=sys_msg,
+        if mode == "reduce":
+            sys_msg += (f"以下每一行都是同一时间窗口内某一段多用户聊天记录的分块总结 JSON。\n"
+                        f"请把它们合并成一份完整的新 JSON：summary 概括整体氛围，events 去重后保留最重要的事件。\n"
+                    )
+        elif mode == "incremental":
+            sys_msg += (f"以下 <previous_summary> 是你上一轮输出的总结，<new_messages> 是此后新增的多用户聊天记录。assistant表示AI助手的回复，user表示用户的提问。\n"
+                        f"请在上一轮总结的基础上结合新增记录输出一份完整的新 JSON：仍然成立的事件保留，已被新记录覆盖或过时的事件删除。\n"
+                    )
+        else:
+            sys_msg += f"以下是你最近与多位用户的聊天记录。assistant表示AI助手的回复，user表示用户的提问：\n"
+        sys_msg += (f"输出 JSON 总长度不要超过 {self.max_output_chars} 个字符。\n" if self.max_output_chars else "")
+        providers = self._resolve_summary_providers(context)
+        if not providers:
+            raise RuntimeError("没有可用的总结 provider")
+
+        last_error: Optional[Exception] = None
+        for provider_name, provider in providers:
+            try:
+                chat_call = provider.text_chat(
+                    prompt=extra_prompt,
+                    session_id=None,
+                    contexts="",
+                    image_urls=[],
+                    func_tool=None,
+                    system_prompt=sys_msg,
+                )
+                if self.provider_timeout_sec > 0:
+                    llm_resp = await asyncio.wait_for(chat_call, timeout=self.provider_timeout_sec)
+                else:
+                    llm_resp = await chat_call
+            except Exception as e:
+                # asyncio.TimeoutError 也走这里：换下一个 provider，全部失败再抛给调用方保留旧总结。
+                # 失败的请求多半也已经计费，按输入估算记一笔。
+                self.budget.record_observer_call(TokenBudget.estimate_tokens(sys_msg + extra_prompt), 0)
+                self.metrics.increment("observer.provider_timeouts" if isinstance(e, asyncio.TimeoutError) else "observer.provider_errors")
+                last_error = e
+                logger.warning(f"Global observer provider {provider_name} failed: {e!r}")
+                continue
+            # await conv_mgr.add_message_pair(
+            #     cid=curr_cid,
+            #     user_message=user_msg,
+            #     assistant_message=AssistantMessageSegment(
+            #         content=[TextPart(text=llm_resp.completion_text)]
+            #     ),
+            # )
+            completion_text = llm_resp.completion_text or ""
+            input_tokens, output_tokens = self._extract_token_usage(llm_resp)
+            self.budget.record_observer_call(
+                input_tokens or TokenBudget.estimate_tokens(sys_msg + extra_prompt),
+                output_tokens or TokenBudget.estimate_tokens(completion_text),
             )
-        # await conv_mgr.add_message_pair(
-        #     cid=curr_cid,
-        #     user_message=user_msg,
-        #     assistant_message=AssistantMessageSegment(
-        #         content=[TextPart(text=llm_resp.completion_text)]
-        #     ),
-        # )
-        return llm_resp.completion_text
+            if self.max_output_chars and len(completion_text) > self.max_output_chars:
+                # 超长输出截断后交给 json_repair 兜底，防止个别失控回复撑大后续 prompt。
+                completion_text = completion_text[:self.max_output_chars]
+            return completion_text
+
+        raise RuntimeError(f"所有总结 provider 均失败: {last_error!r}")
+
+    def _extract_token_usage(self, llm_resp: Any) -> Tuple[int, int]:
+        """尽量从 provider 响应里读出真实 token 用量；不同 provider 字段名不一致，读不到时返回 0 交给估算。"""
+        usage = getattr(llm_resp, "usage", None)
+        if usage is None:
+            return 0, 0
+
+        def _read(*field_names: str) -> int:
+            for field_name in field_names:
+                value = usage.get(field_name) if isinstance(usage, dict) else getattr(usage, field_name, None)
+                try:
+                    if value is not None:
+                        return max(0, int(value))
+                except (TypeError, ValueError):
+                    continue
+            return 0
+
+        return (
+            _read("input", "input_tokens", "prompt_tokens"),
+            _read("output", "output_tokens", "completion_tokens"),
+        )
+
+    def _resolve_summary_providers(self, context) -> List[Tuple[str, Any]]:
+        """按“指定 provider → 回退链 → 当前聊天 provider”的顺序列出可用的总结 provider。"""
+        providers: List[Tuple[str, Any]] = []
+        for candidate_id in [self.provider_id] + self.fallback_provider_ids:
+            if not candidate_id:
+                continue
+            provider = context.get_provider_by_id(candidate_id)
+            if provider is None:
+                logger.warning(f"Global observer provider {candidate_id} not found, skipping")
+                continue
+            providers.append((candidate_id, provider))
+
+        if not providers or self.fallback_to_chat_provider:
+            chat_provider = context.get_using_provider()
+            if chat_provider is not None and all(chat_provider is not provider for _, provider in providers):
+                providers.append(("chat_provider", chat_provider))
+        return providers
 
     def view_recent_messages(self):
-        logger.info(f"Recent messages: {list(self.recent_messages)}")
+        logger.debug("Recent messages: %s", self.recent_messages)
 
 @register("LivelyState", "兔子", "这是一个维护全局身体状态、情绪惯性与长期身体档案的状态记忆插件，让角色在不同对话上下文中依然保持统一反应与连续状态。", "v1.2.1")
 class LivelyState(Star):
+    # 这些快照字段每轮都会变化，只用于告诉模型“过去了多久”，不参与状态版本计算。
+    STATE_VOLATILE_SNAPSHOT_KEYS = ("elapsed_sec",)
+    # 增量注入最多追踪多少个会话，避免长期运行时会话表无限增长。
+    STATE_INJECTION_HISTORY_LIMIT = 1024
+    # 写进流量轨迹文件头的配置：都会影响回放出来的状态和注入内容；provider、Redis 地址等部署信息不记录。
+    REPLAY_CONFIG_KEYS = (
+        "fast_state_cooldown_sec",
+        "body_sheet_cooldown_sec",
+        "auto_update_interval_sec",
+        "active_state_timeout_sec",
+        "state_scope",
+        "state_injection_mode",
+        "state_full_refresh_turns",
+        "state_forecast_hint",
+        "state_forecast_horizons_min",
+        "context_list_max_items",
+        "post_event_marker_ttl_sec",
+        "pending_task_ttl_sec",
+        "last_event_ttl_sec",
+        "queue_max_size",
+        "trigger_threshold",
+        "observer_subject_max_size",
+        "observer_sample_size",
+        "observer_message_max_chars",
+        "observer_min_interval_sec",
+        "observer_max_staleness_sec",
+        "observer_full_refresh_rounds",
+        "observer_dedupe_window",
+        "observer_near_duplicate_bits",
+        "observer_map_reduce_threshold",
+        "observer_map_chunk_size",
+        "observer_map_chunk_by",
+        "observer_token_budget_per_minute",
+        "observer_token_budget_per_hour",
+    )
+
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
         self.context = context
         self.config = config
         self.fast_state_cooldown_sec = max(0, int(config.get("fast_state_cooldown_sec", 300)))
         self.body_sheet_cooldown_sec = max(0, int(config.get("body_sheet_cooldown_sec", 1800)))
-        self.global_state = CharacterState(
-            update_interval_sec=config.get("auto_update_interval_sec", 300),
-            active_state_timeout_sec=config.get("active_state_timeout_sec", 1800),
+        self.metrics = PluginMetrics()
+        # 状态推进和冷却判断统一从这个时钟取时间；模拟时可以通过 set_clock 换成 VirtualClock。
+        self.clock: SystemClock = SystemClock()
+        # 多节点部署时把状态放到 Redis，所有节点看到同一份“跨会话唯一事实”；默认仍是本地文件。
+        self.state_backend: Optional[RedisStateBackend] = None
+        if config.get("state_backend", "file") == "redis":
+            if redis is None:
+                logger.warning("state_backend=redis requires the redis package, falling back to local files")
+            else:
+                self.state_backend = RedisStateBackend.from_url(
+                    config.get("redis_url", "redis://localhost:6379/0"),
+                    key_prefix=config.get("redis_key_prefix", "livelystate"),
+                    metrics=self.metrics,
+                )
+        # 所有角色和分片共用一个到期堆；后台按间隔批量清理到期的上下文锚点。
+        self.context_expiry = ContextExpiryQueue()
+        self.context_expiry_sweep_interval_sec = max(1, int(config.get("context_expiry_sweep_interval_sec", 60)))
+        self._context_expiry_task: Optional[asyncio.Task] = None
+        self.state_timeline_enabled = bool(config.get("state_timeline_enabled", True))
+        self.global_state = self._new_character_state(
+            timeline=self._new_timeline(
+                StarTools.get_data_dir() / "state_timeline.bin",
+                CharacterState.STATE_MACHINE,
+                config.get("state_timeline_capacity", 20000),
+            ),
+        )
+        # 默认所有会话共享一份全局状态；state_scope 设为 session / sender 时按会话或发送者分片，
+        # 此时 global_state 只承担状态机规则、规范化等与具体状态无关的职责。
+        self.state_scope = config.get("state_scope", "global")
+        if self.state_scope not in ("global", "session", "sender"):
+            logger.warning(f"Unknown state_scope {self.state_scope!r}, falling back to global")
+            self.state_scope = "global"
+        self.state_manager = self._new_state_manager(StarTools.get_data_dir() / "states")
+        self.state_flush_interval_sec = max(1, int(config.get("state_flush_interval_sec", 30)))
+        self._state_flush_task: Optional[asyncio.Task] = None
+        self.profiler = HandlerProfiler(
+            output_dir=StarTools.get_data_dir() / "profiles",
+            enabled=config.get("profiler_enabled", False),
+            every_n=config.get("profiler_every_n", 50),
+            slow_threshold_ms=config.get("profiler_slow_threshold_ms", 0),
+            max_files=config.get("profiler_max_files", 20),
+            metrics=self.metrics,
+        )
+        self.traffic_recorder = TrafficRecorder(
+            output_dir=StarTools.get_data_dir() / "traces",
+            enabled=config.get("capture_enabled", False),
+            redact_text=config.get("capture_redact_text", True),
+            max_records=config.get("capture_max_records", 5000),
+            enum_values=list(CharacterState.STATE_MACHINE),
+            replay_config={key: config[key] for key in self.REPLAY_CONFIG_KEYS if key in config},
+            clock=self.clock,
         )
-        self.global_observer = GlobalObserver(max_size=config.get("queue_max_size", 50), trigger_threshold=config.get("trigger_threshold", 20))
+        self.token_budget = TokenBudget(
+            per_minute=config.get("observer_token_budget_per_minute", 0),
+            per_hour=config.get("observer_token_budget_per_hour", 0),
+            clock=self.clock,
+        )
+        self.global_observer = GlobalObserver(
+            max_size=config.get("queue_max_size", 50),
+            trigger_threshold=config.get("trigger_threshold", 20),
+            full_refresh_rounds=config.get("observer_full_refresh_rounds", 5),
+            subject_max_size=config.get("observer_subject_max_size", 0),
+            sample_size=config.get("observer_sample_size", 0),
+            map_reduce_threshold=config.get("observer_map_reduce_threshold", 0),
+            map_chunk_size=config.get("observer_map_chunk_size", 20),
+            map_chunk_by=config.get("observer_map_chunk_by", "subject"),
+            map_concurrency=config.get("observer_map_concurrency", 3),
+            reduce_with_llm=config.get("observer_reduce_with_llm", False),
+            dedupe_window=config.get("observer_dedupe_window", 20),
+            near_duplicate_bits=config.get("observer_near_duplicate_bits", 0),
+            min_interval_sec=config.get("observer_min_interval_sec", 60),
+            max_staleness_sec=config.get("observer_max_staleness_sec", 1800),
+            provider_id=config.get("observer_provider_id", ""),
+            fallback_provider_ids=config.get("observer_fallback_provider_ids", []),
+            fallback_to_chat_provider=config.get("observer_fallback_to_chat_provider", True),
+            provider_timeout_sec=config.get("observer_timeout_sec", 30),
+            max_output_chars=config.get("observer_max_output_chars", 2000),
+            budget=self.token_budget,
+            message_max_chars=config.get("observer_message_max_chars", 500),
+            metrics=self.metrics,
+            profiler=self.profiler,
+            clock=self.clock,
+            journal=ObserverJournal(
+                StarTools.get_data_dir() / "observer_journal.jsonl",
+                max_records=max(1, int(config.get("queue_max_size", 50))) * 4,
+                redact=config.get("observer_persist_redact", True),
+            ) if config.get("observer_persist", False) else None,
+        )
+        self._observer_flush_task: Optional[asyncio.Task] = None
+        # 可选：定期把指标导出成 Prometheus 文本文件，供 node_exporter textfile collector 之类采集。
+        self.metrics_prometheus_path = (
+            StarTools.get_data_dir() / "livelystate_metrics.prom"
+            if config.get("metrics_prometheus_file", False) else None
+        )
+        self.metrics_export_interval_sec = max(5, int(config.get("metrics_export_interval_sec", 60)))
+        self._metrics_export_task: Optional[asyncio.Task] = None
+        self.loop_watchdog = LoopWatchdog(
+            self.metrics,
+            interval_sec=config.get("loop_watchdog_interval_sec", 0.1),
+            threshold_ms=config.get("loop_watchdog_threshold_ms", 100),
+        ) if config.get("loop_watchdog_enabled", False) else None
+        self.hot_path_logger = HotPathLogger(
+            level=config.get("hot_path_log_level", "debug"),
+            sample_rate=config.get("hot_path_log_sample_rate", 1.0),
+            max_chars=config.get("hot_path_log_max_chars", 500),
+        )
+        injection_mode = str(config.get("state_injection_mode", "full")).strip().lower()
+        self.state_injection_mode = injection_mode if injection_mode in {"full", "delta"} else "full"
+        self.state_full_refresh_turns = max(1, int(config.get("state_full_refresh_turns", 10)))
+        self.state_forecaster = StateForecaster(self.global_state)
+        # 没有启用多角色或当前 persona 没有专属定义时，都落到这个默认角色上。
+        self.default_persona = PersonaRuntime("default", self.global_state, self.state_manager, self.state_forecaster)
+        self.character_registry = CharacterRegistry(
+            StarTools.get_data_dir() / "personas",
+            self._build_persona_runtime,
+            idle_unload_sec=config.get("persona_idle_unload_sec", 1800),
+            clock=self.clock,
+            metrics=self.metrics,
+        ) if config.get("persona_registry_enabled", False) else None
+        # 会话当前使用的 persona 在 add_state 读取会话时记下，同一轮里的工具调用据此找到对应角色。
+        self._session_personas: "OrderedDict[str, str]" = OrderedDict()
+        self.state_forecast_hint = config.get("state_forecast_hint", False)
+        self.state_forecast_horizons_min = [
+            max(1, int(horizon)) for horizon in config.get("state_forecast_horizons_min", [60, 180, 360])
+        ] or [60]
+        # 按 (unified_msg_origin, 对话 id) 缓存上一次生成的完整状态块及其版本，只在 delta 模式下使用。
+        self._state_injection_history: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
 
     async def initialize(self):
         """可选择实现异步的插件初始化方法，当实例化该插件类之后会自动调用该方法。"""
+        if self.loop_watchdog:
+            self.loop_watchdog.start()
+        if self.state_backend:
+            self.state_backend.start()
+        restored_message_count = self.global_observer.restore_from_journal()
+        if restored_message_count or self.global_observer.current_state:
+            logger.info(
+                f"Global observer restored {restored_message_count} messages "
+                f"and {'a' if self.global_observer.current_state else 'no'} previous summary from journal"
+            )
+        if self.global_observer.scheduler.max_staleness_sec > 0:
+            self._observer_flush_task = asyncio.create_task(self._observer_idle_flush_loop())
+        if self.metrics_prometheus_path:
+            self._metrics_export_task = asyncio.create_task(self._metrics_export_loop())
+        if self.state_manager:
+            self._state_flush_task = asyncio.create_task(self._state_flush_loop())
+        self._context_expiry_task = asyncio.create_task(self._context_expiry_loop())
+
+    async def _state_flush_loop(self):
+        # 分片是写回模式，这里定期落盘，进程意外退出时最多丢失一个间隔内的修改。
+        while True:
+            await asyncio.sleep(self.state_flush_interval_sec)
+            with self.metrics.span("state_shard.flush"):
+                self._flush_state_shards()
+
+    async def _context_expiry_loop(self):
+        # 读取时已经会惰性清理；这里负责长时间没人读的状态，让文件 / Redis 里的过期锚点也按时消失。
+        while True:
+            await asyncio.sleep(self.context_expiry_sweep_interval_sec)
+            with self.metrics.span("state.context_expiry_sweep"):
+                self._sweep_expired_context()
+
+    def _sweep_expired_context(self) -> int:
+        """批量清理已经到期的上下文锚点，返回处理的状态个数。"""
+        due_states = self.context_expiry.pop_due(self.clock.now())
+        for character_state in due_states:
+            try:
+                # 读取时会移除到期条目并写回，同时重新登记下一个到期时间。
+                character_state.get_whole_state(enable_update=False)
+            except (StateConflictError, StateBackendError) as e:
+                logger.warning(f"Failed to prune expired context anchors: {e}")
+        return len(due_states)
+
+    def _flush_state_shards(self) -> None:
+        self.default_persona.flush()
+        if self.character_registry:
+            self.character_registry.flush_all()
+
+    async def _metrics_export_loop(self):
+        while True:
+            await asyncio.sleep(self.metrics_export_interval_sec)
+            self.metrics.write_prometheus_file(self.metrics_prometheus_path)
+
+    async def _observer_idle_flush_loop(self):
+        """冷清时段没有新消息触发检查，这里定期看一眼观察者的总结是否已经过期。"""
+        check_interval_sec = max(5.0, min(60.0, self.global_observer.scheduler.max_staleness_sec / 4))
+        while True:
+            await asyncio.sleep(check_interval_sec)
+            try:
+                await self.global_observer.flush_if_stale(self.context)
+            except Exception as e:
+                logger.warning(f"Global observer idle flush failed: {e}")
 
     def _format_structured_state_block(self, data: Dict[str, Any], compact: bool = False) -> str:
         """把结构化状态转成 JSON 文本。
@@ -786,19 +3917,20 @@ class LivelyState(Star):
             if not str(key).startswith("_")
         }
 
-    def _build_state_style_rules(self, state_info: Dict[str, Any]) -> str:
+    def _build_state_style_rules(self, state_info: Dict[str, Any], character: Optional[CharacterState] = None) -> str:
         """把状态压成少量高收益的回复约束。"""
+        character = character or self.global_state
         energy_level = state_info.get("energy_level", 100)
         thirst = state_info.get("thirst", 0)
-        physical_state = self.global_state.normalize_physical_state(state_info.get("physical_state", "Idle"))
+        physical_state = character.normalize_physical_state(state_info.get("physical_state", "Idle"))
         emotion = state_info.get("emotion", "Normal")
         location = str(state_info.get("location", "")).strip()
-        post_event_markers = self.global_state.normalize_text_list(state_info.get("post_event_markers", []))
-        last_event = self.global_state.normalize_last_event(state_info.get("last_event", {}))
-        pending_tasks = self.global_state.normalize_text_list(state_info.get("pending_tasks", []))
-        body_sheet = self.global_state.normalize_body_sheet(state_info.get("Body_Sheet", {}))
-        history = self.global_state.normalize_history(state_info.get("History", {}))
-        state_meta = self.global_state.get_state_meta(physical_state)
+        post_event_markers = character.normalize_text_list(state_info.get("post_event_markers", []))
+        last_event = character.normalize_last_event(state_info.get("last_event", {}))
+        pending_tasks = character.normalize_text_list(state_info.get("pending_tasks", []))
+        body_sheet = character.normalize_body_sheet(state_info.get("Body_Sheet", {}))
+        history = character.normalize_history(state_info.get("History", {}))
+        state_meta = character.get_state_meta(physical_state)
 
         style_rules = [
             f"- 场景、动作、地点必须符合 {physical_state}（{state_meta['label']}）；若下一句会冲突，先调 apply_state_transition。",
@@ -855,24 +3987,34 @@ class LivelyState(Star):
             + "\n</persistent_facts>\n"
         )
 
-    def _build_global_state_system_prompt(self, uid: str, state_info: Dict[str, Any]) -> str:
-        """构建更短的高优先级全局状态约束。"""
+    def _project_global_state(
+        self,
+        uid: str,
+        state_info: Dict[str, Any],
+    ) -> Tuple[Dict[str, Any], Dict[str, Any], List[str]]:
+        """把全局状态投影到当前会话。
+
+        返回 `(state_snapshot, filtered_state_info, scope_rules)`：
+        完整注入和增量注入共用同一份投影，保证两条路径看到的可见字段完全一致。
+        """
         current_session_subject_id = str(uid).strip() or "global"
-        target_id = self.global_state.normalize_subject_id(
+        character = self._persona_for(uid).character
+        target_id = character.normalize_subject_id(
             state_info.get("target_id", "none"),
             fallback="none",
             allow_none_literal=True,
         )
-        last_update_time = float(state_info.get("LastUpdateTime", time.time()))
-        time_elapsed = max(0.0, time.time() - last_update_time)
-        physical_state = self.global_state.normalize_physical_state(state_info.get("physical_state", "Idle"))
-        state_meta = self.global_state.get_state_meta(physical_state)
-        context_subject_id = self.global_state.normalize_subject_id(
+        now = self.clock.now()
+        last_update_time = float(state_info.get("LastUpdateTime", now))
+        time_elapsed = max(0.0, now - last_update_time)
+        physical_state = character.normalize_physical_state(state_info.get("physical_state", "Idle"))
+        state_meta = character.get_state_meta(physical_state)
+        context_subject_id = character.normalize_subject_id(
             state_info.get("context_subject_id", "global"),
             fallback="global",
         )
-        last_event = self.global_state.normalize_last_event(state_info.get("last_event", {}))
-        last_event_subject_id = self.global_state.normalize_subject_id(
+        last_event = character.normalize_last_event(state_info.get("last_event", {}))
+        last_event_subject_id = character.normalize_subject_id(
             last_event.get("subject_id"),
             fallback="global",
         ) if last_event else "global"
@@ -883,7 +4025,7 @@ class LivelyState(Star):
             "emotion": state_info.get("emotion", "Normal"),
             "energy": state_info.get("energy_level", 100),
             "thirst": state_info.get("thirst", 0),
-            "updated_at": state_info.get("updated_at", self.global_state.format_timestamp(last_update_time)),
+            "updated_at": state_info.get("updated_at", character.format_timestamp(last_update_time)),
             "last_update_ts": round(last_update_time, 3),
             "elapsed_sec": round(time_elapsed, 1),
             "current_session_subject_id": current_session_subject_id,
@@ -892,7 +4034,7 @@ class LivelyState(Star):
         if context_fields_visible and location:
             state_snapshot["location"] = location
 
-        post_event_markers = self.global_state.normalize_text_list(state_info.get("post_event_markers", []))
+        post_event_markers = character.normalize_text_list(state_info.get("post_event_markers", []))
         if context_fields_visible and post_event_markers:
             state_snapshot["post_event_markers"] = post_event_markers
 
@@ -902,7 +4044,7 @@ class LivelyState(Star):
         if last_event and last_event_subject_id in {"global", current_session_subject_id}:
             state_snapshot["last_event"] = last_event
 
-        pending_tasks = self.global_state.normalize_text_list(state_info.get("pending_tasks", []))
+        pending_tasks = character.normalize_text_list(state_info.get("pending_tasks", []))
         if context_fields_visible and pending_tasks:
             state_snapshot["pending_tasks"] = pending_tasks
 
@@ -934,18 +4076,167 @@ class LivelyState(Star):
                 f"- target_id={target_id} 表示当前关注对象不是当前会话对象 {current_session_subject_id}；不要把该对象误写成当前用户。"
             )
 
-        rules_text = "\n".join(scope_rules + [self._build_state_style_rules(filtered_state_info)])
+        return state_snapshot, filtered_state_info, scope_rules
+
+    def _build_global_state_system_prompt(
+        self,
+        uid: str,
+        state_info: Dict[str, Any],
+        include_forecast: bool = True,
+    ) -> str:
+        """构建更短的高优先级全局状态约束。"""
+        persona = self._persona_for(uid)
+        state_snapshot, filtered_state_info, scope_rules = self._project_global_state(uid, state_info)
+        rules_text = "\n".join(scope_rules + [self._build_state_style_rules(filtered_state_info, persona.character)])
 
         return (
             "[GLOBAL_STATE MUST OBEY]\n"
             "- 以下状态是跨会话唯一事实；recent_global_context 仅供参考。\n"
             "- 若你的下一句会与当前快状态冲突，先调用 apply_state_transition；若要补录长期身体事实，调用 update_body_sheet。\n"
             f"state={self._format_structured_state_block(state_snapshot, compact=True)}\n"
+            f"{self._build_forecast_prompt(state_info, persona.forecaster) if include_forecast else ''}"
             f"{self._build_persistent_profile_prompt(state_info)}"
             "rules:\n"
             f"{rules_text}\n"
         )
 
+    def _build_forecast_prompt(self, state_info: Dict[str, Any], forecaster: Optional[StateForecaster] = None) -> str:
+        """按当前状态不变推算几个时间点的体力/欲望走向，让模型能提前规划语气和安排。"""
+        if not self.state_forecast_hint:
+            return ""
+
+        forecaster = forecaster or self.state_forecaster
+        forecast = forecaster.forecast(
+            state_info,
+            [horizon * 60 for horizon in self.state_forecast_horizons_min],
+        )
+        # 用列表保持时间顺序；结构化输出会按键名排序，键名里的时间点会被排乱。
+        forecast_hint: Dict[str, Any] = {
+            "trajectory": [
+                f"+{horizon}m:E{energy}/T{thirst}/{physical_state}"
+                for horizon, energy, thirst, physical_state in zip(
+                    self.state_forecast_horizons_min,
+                    forecast["energy"][0],
+                    forecast["thirst"][0],
+                    forecast["physical_state"][0],
+                )
+            ],
+        }
+        thresholds = forecaster.time_until(state_info)
+        if thresholds["energy_below_sec"]:
+            forecast_hint["energy<30_in_min"] = round(thresholds["energy_below_sec"] / 60)
+        if thresholds["thirst_above_sec"]:
+            forecast_hint["thirst>85_in_min"] = round(thresholds["thirst_above_sec"] / 60)
+        return (
+            f"forecast(若保持当前状态，仅供规划)={self._format_structured_state_block(forecast_hint, compact=True)}\n"
+        )
+
+    def _build_state_injection_prompt(
+        self,
+        uid: str,
+        state_info: Dict[str, Any],
+        conversation_id: Optional[str] = None,
+    ) -> Tuple[str, str]:
+        """按注入模式生成本轮追加到 system prompt 的状态块，返回 (缓存的完整块, 本轮增量)。
+
+        `full` 模式每轮都重建完整状态块，增量部分为空。
+        `delta` 模式下完整块只在首轮、长期事实变化和每隔 state_full_refresh_turns 轮时重建，
+        其余轮次原样复用上一次的字符串，后面只追加一小段增量（变化字段、elapsed_sec、预测）。
+        两部分都放在 system prompt 里，不会随用户轮次存进对话历史，历史里也就不会堆积过期的状态块；
+        完整块逐字节不变，provider 侧的前缀缓存可以命中。
+        """
+        if self.state_injection_mode != "delta":
+            return self._build_global_state_system_prompt(uid, state_info), ""
+
+        persona = self._persona_for(uid)
+        state_snapshot, filtered_state_info, scope_rules = self._project_global_state(uid, state_info)
+        # elapsed_sec 每轮都会变，不能算进版本号，否则增量模式永远退化成全量注入。
+        stable_snapshot = {
+            key: value
+            for key, value in state_snapshot.items()
+            if key not in self.STATE_VOLATILE_SNAPSHOT_KEYS
+        }
+        profile_text = self._build_persistent_profile_prompt(state_info)
+        rules_text = "\n".join(scope_rules + [
+            self._build_state_style_rules(filtered_state_info, persona.character)
+        ])
+        state_version = hashlib.sha1(
+            (self._format_structured_state_block(stable_snapshot, compact=True) + profile_text).encode("utf-8")
+        ).hexdigest()[:10]
+        # 预测随时间推移而变，每轮重新算，放在增量里而不是缓存的完整块里。
+        forecast_text = self._build_forecast_prompt(state_info, persona.forecaster)
+
+        session_key = f"{str(uid).strip() or 'global'}:{conversation_id or ''}"
+        last_injection = self._state_injection_history.get(session_key)
+        needs_full_injection = (
+            last_injection is None
+            or last_injection["turns_since_full"] + 1 >= self.state_full_refresh_turns
+            # 长期事实层体积大且很少变化，一旦变化直接全量刷新，避免拼出半份 persistent_facts。
+            or last_injection["profile_text"] != profile_text
+        )
+
+        if needs_full_injection:
+            self.metrics.increment("injection.full_refresh")
+            last_injection = {
+                "full_version": state_version,
+                "full_block": self._build_global_state_system_prompt(uid, state_info, include_forecast=False),
+                "snapshot": stable_snapshot,
+                "profile_text": profile_text,
+                "rules_text": rules_text,
+                "turns_since_full": 0,
+            }
+            self._remember_state_injection(session_key, last_injection)
+            return last_injection["full_block"], forecast_text
+
+        last_injection["turns_since_full"] += 1
+        self._state_injection_history.move_to_end(session_key)
+        volatile_fields = {
+            key: state_snapshot[key]
+            for key in self.STATE_VOLATILE_SNAPSHOT_KEYS
+            if key in state_snapshot
+        }
+
+        if state_version == last_injection["full_version"]:
+            self.metrics.increment("injection.unchanged_marker")
+            return last_injection["full_block"], (
+                "[GLOBAL_STATE 增量]\n"
+                "- 状态与上面的 GLOBAL_STATE 一致，只有以下字段是本轮最新值。\n"
+                f"state_delta={self._format_structured_state_block(volatile_fields, compact=True)}\n"
+                f"{forecast_text}"
+            )
+
+        # 增量始终相对缓存的完整块计算，不依赖中间轮次，丢掉哪一轮都不会让状态对不上。
+        full_snapshot = last_injection["snapshot"]
+        changed_fields = {
+            key: value
+            for key, value in stable_snapshot.items()
+            if full_snapshot.get(key) != value
+        }
+        # 被过滤掉或清空的字段显式写成 null，避免模型继续沿用旧锚点。
+        for key in full_snapshot:
+            if key not in stable_snapshot:
+                changed_fields[key] = None
+
+        delta_prompt = (
+            "[GLOBAL_STATE 增量 MUST OBEY]\n"
+            f"- 状态已变为 state_version={state_version}；state_delta 中的字段覆盖上面 GLOBAL_STATE 里的同名字段，"
+            "其余字段不变。\n"
+            f"state_delta={self._format_structured_state_block({**changed_fields, **volatile_fields}, compact=True)}\n"
+            f"{forecast_text}"
+        )
+        if rules_text != last_injection["rules_text"]:
+            delta_prompt += f"rules(覆盖上面的 rules):\n{rules_text}\n"
+
+        self.metrics.increment("injection.delta")
+        return last_injection["full_block"], delta_prompt
+
+    def _remember_state_injection(self, session_key: str, record: Dict[str, Any]) -> None:
+        """缓存某个会话最近一次生成的完整状态块，超过上限时淘汰最久未活跃的会话。"""
+        self._state_injection_history[session_key] = record
+        self._state_injection_history.move_to_end(session_key)
+        while len(self._state_injection_history) > self.STATE_INJECTION_HISTORY_LIMIT:
+            self._state_injection_history.popitem(last=False)
+
     def _build_recent_context_prompt(self, current_uid: str) -> str:
         """构建低优先级的最近对话观察摘要。
 
@@ -959,25 +4250,9 @@ class LivelyState(Star):
         recent_context_payload: Dict[str, Any]
         if isinstance(self.global_observer.current_state, dict):
             raw_summary = str(self.global_observer.current_state.get("summary", "")).strip()
-            recent_events: List[Dict[str, str]] = []
-            omitted_other_subject_events = 0
-            for event_data in self.global_observer.current_state.get("events", []):
-                if not isinstance(event_data, dict):
-                    continue
-                subject_id = self.global_state.normalize_subject_id(
-                    event_data.get("subject_id"),
-                    fallback="global",
-                )
-                summary = str(event_data.get("summary", "")).strip()
-                if not summary:
-                    continue
-                if subject_id in {"global", current_session_subject_id}:
-                    recent_events.append({
-                        "subject_id": subject_id,
-                        "summary": summary,
-                    })
-                else:
-                    omitted_other_subject_events += 1
+            recent_events, omitted_other_subject_events = self.global_observer.get_events_for_subject(
+                current_session_subject_id
+            )
 
             recent_context_payload = {
                 "summary": raw_summary,
@@ -1033,6 +4308,7 @@ class LivelyState(Star):
         - 如果你没有显式填写 `context_subject_id`，插件会优先用 `last_event.subject_id`，其次用 `target_id` 来推断；推断不到时保留旧值。
         - `last_event` 一旦填写，必须带上 `subject_id`；若该事件不强绑定某个 ID，则填写 `global`。
         - 如果要清空上下文锚点，可以传 `[]` 或 `{}`。
+        - 短暂的锚点可以带存活时长，到期后插件自动移除，不必再调用工具清理：列表条目写成 `{"text": "刚洗完澡", "ttl_min": 60}`，待办可写 `{"text": "稍后洗碗", "due_in_min": 30}`，`last_event` 里加 `"ttl_min": 120`；`0` 表示不过期。
 
         支持部分更新：只传入发生变化的字段即可，未传入字段会沿用旧值。
 
@@ -1054,16 +4330,16 @@ class LivelyState(Star):
             update_reason (str, optional): 状态更新原因。
             target_id (str, optional): 当前关注对象 ID。它只表示“此刻主要在和谁互动”，
                 不代表存在另一套独立状态；身体状态和情绪状态始终是全局唯一的。
-            post_event_markers (str, optional): 上下文锚点列表，需传 JSON 字符串数组；例如 `"[\"刚洗完澡\", \"头发未干\"]"`。
+            post_event_markers (str, optional): 上下文锚点列表，需传 JSON 字符串数组；例如 `"[\"刚洗完澡\", \"头发未干\"]"`，条目也可以是带 `ttl_min` 的对象。
             last_event (str, optional): 最近事件摘要，需传 JSON 字符串对象；对象里应包含 `subject_id`，若无强相关 ID 则填 `global`，例如 `"{\"type\":\"meal\",\"subject_id\":\"global\",\"note\":\"刚吃完晚饭\"}"`。
-            pending_tasks (str, optional): 待办列表，需传 JSON 字符串数组；例如 `"[\"稍后洗碗\"]"`。
+            pending_tasks (str, optional): 待办列表，需传 JSON 字符串数组；例如 `"[\"稍后洗碗\"]"`，条目也可以是带 `due_in_min` 的对象。
             history_delta (str, optional): 历史计数的增量更新，需传 JSON 字符串对象。
                 这里传入的是“本次增加多少”，不是最新总数，例如 `{"1_Count": 1}` 表示该计数加 1。
         '''
         
 
         cur_state = {
-            "LastUpdateTime": time.time(),
+            "LastUpdateTime": self.clock.now(),
             "emotion": emotion,
             "energy_level": energy_level,
             "thirst": thirst,
@@ -1077,8 +4353,18 @@ class LivelyState(Star):
             "pending_tasks": pending_tasks,
             "history_delta": history_delta,
         }
-        report = self._handle_apply(event, cur_state)
-        logger.info("State update report: %s", report)
+        async with self._state_lock(event):
+            from_state = self._current_physical_state(event) if self.traffic_recorder.enabled else None
+            with self.metrics.span("apply_state_transition.total"), self.profiler.profile("handle_apply"):
+                report = self._apply_with_retry(event, cur_state)
+        self._count_apply_report("apply_state_transition", report)
+        self.traffic_recorder.record_tool_call(
+            "apply_state_transition",
+            event.unified_msg_origin,
+            cur_state,
+            outcome=self._classify_apply_report(report, from_state) if self.traffic_recorder.enabled else None,
+        )
+        self.hot_path_logger.log("state_update_report", lambda: report)
         if report.startswith("Update Failed"):
             # await event.send(event.plain_result(report))
             return report
@@ -1114,29 +4400,352 @@ class LivelyState(Star):
         '''
 
         payload = {
-            "LastUpdateTime": time.time(),
+            "LastUpdateTime": self.clock.now(),
             "body_sheet_updates": body_sheet_updates,
             "update_reason": update_reason,
         }
-        report = self._handle_apply(event, payload)
-        logger.info("Body sheet update report: %s", report)
+        async with self._state_lock(event):
+            with self.metrics.span("update_body_sheet.total"), self.profiler.profile("handle_apply"):
+                report = self._apply_with_retry(event, payload)
+        self._count_apply_report("update_body_sheet", report)
+        self.traffic_recorder.record_tool_call(
+            "update_body_sheet",
+            event.unified_msg_origin,
+            payload,
+            outcome=self._classify_apply_report(report) if self.traffic_recorder.enabled else None,
+        )
+        self.hot_path_logger.log("body_sheet_update_report", lambda: report)
         return report
 
 
     @filter.command("state_check")
     async def state_check(self, event: AstrMessageEvent) -> MessageEventResult:
-        pretty_state = self._format_structured_state_block(self._to_public_state(self.global_state.get_whole_state()))
+        try:
+            state_info = self._state_for(event).get_whole_state()
+        except StateBackendError as e:
+            logger.error(f"读取共享状态失败: {e}")
+            await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"读取共享状态失败: {e}"))
+            event.stop_event()
+            return
+        pretty_state = self._format_structured_state_block(self._to_public_state(state_info))
         await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"当前状态信息：\n{pretty_state}"))
         event.stop_event()
 
     @filter.command("state_del")
     async def state_del(self, event: AstrMessageEvent) -> MessageEventResult:
-        self.global_state.delete()
+        self._state_for(event).delete()
+        # 观察者缓存和日志里存着聊天内容，重置状态时一并清掉。
+        self.global_observer.reset()
         await self.context.send_message(event.unified_msg_origin, MessageChain().message("状态已重置。"))
         event.stop_event()
 
+    @filter.command("state_timeline")
+    async def state_timeline(self, event: AstrMessageEvent, hours: str = "24", points: str = "24") -> MessageEventResult:
+        # 与 /state_check 一样按当前会话的角色和分片取时间线。
+        timeline = self._state_for(event).timeline
+        if timeline is None:
+            if not self.state_timeline_enabled:
+                reason = "状态时间线未开启（state_timeline_enabled）。"
+            elif self._persona_for(event.unified_msg_origin).state_manager is not None:
+                reason = "当前会话使用分片状态，分片时间线已关闭（state_shard_timeline_capacity=0）。"
+            else:
+                reason = "状态时间线容量为 0，未记录样本（state_timeline_capacity）。"
+            await self.context.send_message(event.unified_msg_origin, MessageChain().message(reason))
+            event.stop_event()
+            return
+
+        try:
+            window_hours = max(0.1, float(hours))
+            max_points = max(1, min(200, int(points)))
+        except (TypeError, ValueError):
+            await self.context.send_message(event.unified_msg_origin, MessageChain().message("用法：/state_timeline [小时数] [点数]"))
+            event.stop_event()
+            return
+
+        end_ts = self.clock.now()
+        samples = timeline.query(end_ts - window_hours * 3600, end_ts, max_points=max_points)
+        if not samples:
+            message = f"最近 {window_hours:g} 小时没有状态记录。"
+        else:
+            lines = [
+                f"{time.strftime('%m-%d %H:%M', time.localtime(sample['t']))} "
+                f"E{sample['energy']:g} T{sample['thirst']:g} {sample['physical_state']} {sample['emotion']}"
+                + (f" (x{sample['samples']})" if sample["samples"] > 1 else "")
+                for sample in samples
+            ]
+            message = f"最近 {window_hours:g} 小时状态时间线：\n" + "\n".join(lines)
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(message))
+        event.stop_event()
+
+    @filter.command("state_observer")
+    async def state_observer(self, event: AstrMessageEvent) -> MessageEventResult:
+        observer = self.global_observer
+        observer_status = {
+            "buffered_messages": observer.buffered_message_count,
+            "subjects": len(observer.subject_buffers),
+            "scheduler": observer.scheduler.snapshot(observer.new_message_count),
+            "token_budget": self.token_budget.snapshot(),
+        }
+        pretty_status = self._format_structured_state_block(observer_status)
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"全局观察者状态：\n{pretty_status}"))
+        event.stop_event()
+
+    @filter.command("state_metrics")
+    async def state_metrics(self, event: AstrMessageEvent) -> MessageEventResult:
+        metrics_snapshot = self.metrics.snapshot()
+        if self.loop_watchdog:
+            metrics_snapshot["loop_watchdog"] = self.loop_watchdog.snapshot()
+        if self.state_manager:
+            metrics_snapshot["state_shards"] = self.state_manager.snapshot()
+        if self.character_registry:
+            metrics_snapshot["personas"] = self.character_registry.snapshot()
+        next_context_expiry = self.context_expiry.next_due()
+        metrics_snapshot["context_expiry"] = {
+            "scheduled_states": len(self.context_expiry),
+            "next_due_in_sec": round(max(0.0, next_context_expiry - self.clock.now()), 1) if next_context_expiry else None,
+        }
+        pretty_metrics = self._format_structured_state_block(metrics_snapshot)
+        if self.metrics_prometheus_path:
+            self.metrics.write_prometheus_file(self.metrics_prometheus_path)
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"LivelyState 指标：\n{pretty_metrics}"))
+        event.stop_event()
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("state_profile")
+    async def state_profile(self, event: AstrMessageEvent, action: str = "status") -> MessageEventResult:
+        action = str(action or "status").strip().lower()
+        if action in ("on", "off"):
+            self.profiler.enabled = action == "on"
+        elif action != "status":
+            await self.context.send_message(event.unified_msg_origin, MessageChain().message("用法：/state_profile [on|off|status]"))
+            event.stop_event()
+            return
+
+        pretty_status = self._format_structured_state_block(self.profiler.snapshot())
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"LivelyState 采样分析：\n{pretty_status}"))
+        event.stop_event()
+
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("state_capture")
+    async def state_capture(self, event: AstrMessageEvent, action: str = "status") -> MessageEventResult:
+        action = str(action or "status").strip().lower()
+        if action in ("on", "off"):
+            self.traffic_recorder.enabled = action == "on"
+        elif action != "status":
+            await self.context.send_message(event.unified_msg_origin, MessageChain().message("用法：/state_capture [on|off|status]"))
+            event.stop_event()
+            return
+
+        pretty_status = self._format_structured_state_block(self.traffic_recorder.snapshot())
+        await self.context.send_message(event.unified_msg_origin, MessageChain().message(f"LivelyState 流量录制：\n{pretty_status}"))
+        event.stop_event()
+
+    def _new_character_state(self, **overrides) -> CharacterState:
+        options = {
+            "update_interval_sec": self.config.get("auto_update_interval_sec", 300),
+            "active_state_timeout_sec": self.config.get("active_state_timeout_sec", 1800),
+            "metrics": self.metrics,
+            "clock": self.clock,
+            "context_ttl_sec": {
+                "post_event_markers": self.config.get("post_event_marker_ttl_sec", 0),
+                "pending_tasks": self.config.get("pending_task_ttl_sec", 0),
+                "last_event": self.config.get("last_event_ttl_sec", 0),
+            },
+            "context_max_items": self.config.get("context_list_max_items", 10),
+            "expiry_queue": self.context_expiry,
+        }
+        options.update(overrides)
+        if self.state_backend is not None:
+            # Redis 里的 key 沿用本地文件相对数据目录的路径，全局、分片和角色状态一一对应。
+            state_path = Path(options.get("path") or StarTools.get_data_dir() / "global_state.json")
+            try:
+                store_name = state_path.relative_to(StarTools.get_data_dir()).with_suffix("").as_posix()
+            except ValueError:
+                store_name = state_path.stem
+            options["store"] = self.state_backend.store(store_name)
+        return CharacterState(**options)
+
+    def _new_timeline(self, path: Path, state_machine: Dict[str, Any], capacity: int) -> Optional[StateTimeline]:
+        if not self.state_timeline_enabled or int(capacity) <= 0:
+            return None
+        return StateTimeline(path, list(state_machine), capacity=capacity)
+
+    def _new_state_manager(self, shard_dir: Path, **character_overrides) -> Optional[StateManager]:
+        if self.state_scope == "global":
+            return None
+        state_machine = character_overrides.get("state_machine") or CharacterState.STATE_MACHINE
+        # 分片可能很多，各自的时间线放在分片文件旁边，容量单独配置，随分片一起加载和淘汰。
+        return StateManager(
+            shard_dir,
+            lambda shard_path: self._new_character_state(
+                path=shard_path,
+                write_back=True,
+                timeline=self._new_timeline(
+                    shard_path.with_suffix(".timeline.bin"),
+                    state_machine,
+                    self.config.get("state_shard_timeline_capacity", 2000),
+                ),
+                **character_overrides,
+            ),
+            max_hot_shards=self.config.get("state_max_hot_shards", 64),
+            metrics=self.metrics,
+        )
+
+    def _build_persona_runtime(
+        self,
+        persona_id: str,
+        persona_dir: Path,
+        definition: Optional[StateMachineDefinition],
+    ) -> PersonaRuntime:
+        template_path = persona_dir / CharacterRegistry.TEMPLATE_FILE
+        character_overrides: Dict[str, Any] = {
+            "template_path": template_path if template_path.exists() else None,
+        }
+        if definition is not None:
+            character_overrides["state_machine"] = definition.state_machine
+            character_overrides["state_aliases"] = definition.state_aliases
+        character = self._new_character_state(
+            path=persona_dir / "global_state.json",
+            timeline=self._new_timeline(
+                persona_dir / "state_timeline.bin",
+                character_overrides.get("state_machine") or CharacterState.STATE_MACHINE,
+                self.config.get("state_timeline_capacity", 20000),
+            ),
+            **character_overrides,
+        )
+
+        # 预测器只依赖状态机和流转间隔，相同定义的角色共用一个。
+        forecaster = self.state_forecaster
+        if definition is not None:
+            if definition.forecaster is None:
+                definition.forecaster = StateForecaster(character)
+            forecaster = definition.forecaster
+        return PersonaRuntime(
+            persona_id,
+            character,
+            self._new_state_manager(persona_dir / "states", **character_overrides),
+            forecaster,
+            definition,
+        )
+
+    def _remember_session_persona(self, uid: str, conversation: Any) -> None:
+        if self.character_registry is None:
+            return
+        persona_id = str(getattr(conversation, "persona_id", None) or "").strip()
+        # AstrBot 用 "[%None]" 表示该会话显式不使用人格。
+        if not persona_id or persona_id.startswith("[%"):
+            self._session_personas.pop(uid, None)
+            return
+        self._session_personas[uid] = persona_id
+        self._session_personas.move_to_end(uid)
+        while len(self._session_personas) > self.STATE_INJECTION_HISTORY_LIMIT:
+            self._session_personas.popitem(last=False)
+
+    def _persona_for(self, uid: str) -> PersonaRuntime:
+        if self.character_registry is None:
+            return self.default_persona
+        persona_id = self._session_personas.get(uid)
+        if not persona_id:
+            return self.default_persona
+        return self.character_registry.get(persona_id) or self.default_persona
+
+    def set_clock(self, clock: SystemClock) -> None:
+        """替换状态引擎、冷却判断、观察者调度和 token 预算使用的时钟，供模拟和回放工具使用。"""
+        self.clock = clock
+        self.global_observer.set_clock(clock)
+        self.token_budget.set_clock(clock)
+        self.traffic_recorder.clock = clock
+        runtimes = [self.default_persona]
+        if self.character_registry:
+            self.character_registry.clock = clock
+            runtimes += self.character_registry.loaded()
+        for runtime in runtimes:
+            runtime.character.clock = clock
+            if runtime.state_manager:
+                for shard in runtime.state_manager.hot_shards():
+                    shard.clock = clock
+
+    def _state_subject_id(self, event: AstrMessageEvent) -> str:
+        if self.state_scope == "sender":
+            get_sender_id = getattr(event, "get_sender_id", None)
+            sender_id = get_sender_id() if callable(get_sender_id) else ""
+            return str(sender_id or event.get_sender_name() or event.unified_msg_origin)
+        return str(event.unified_msg_origin)
+
+    def _state_for(self, event: AstrMessageEvent) -> CharacterState:
+        """返回这次事件对应的状态存储：先按会话的 persona 找到角色，开启分片后再取该会话 / 发送者的分片。"""
+        runtime = self._persona_for(event.unified_msg_origin)
+        if runtime.state_manager is None:
+            return runtime.character
+        return runtime.state_manager.get(self._state_subject_id(event))
+
+    def _state_lock(self, event: AstrMessageEvent) -> asyncio.Lock:
+        runtime = self._persona_for(event.unified_msg_origin)
+        if runtime.state_manager is None:
+            return runtime.lock
+        return runtime.state_manager.lock(self._state_subject_id(event))
+
+    def _count_apply_report(self, tool_name: str, report: str) -> None:
+        outcome = "rejected" if str(report).startswith("Update Failed") else "applied"
+        self.metrics.increment(f"{tool_name}.{outcome}")
+
+    # _handle_apply 的拒绝报告是给模型看的自然语言，这里按固定前缀归成稳定的原因代码，供录制和离线分析使用。
+    APPLY_REJECT_REASONS = (
+        ("快状态更新冷却中", "cooldown_fast_state"),
+        ("Body_Sheet 更新冷却中", "cooldown_body_sheet"),
+        ("不允许从", "transition_not_allowed"),
+        ("physical_state 非法", "invalid_physical_state"),
+        ("未检测到实际状态变化", "no_effective_change"),
+        ("至少需要提供一个可更新字段", "empty_update"),
+        ("其他节点同时更新", "state_conflict"),
+        ("状态存储暂不可用", "backend_unavailable"),
+    )
+
+    # 共享存储下读改写遇到其他节点抢先写入时，基于最新状态重做的次数。
+    STATE_CONFLICT_RETRIES = 3
+
+    def _apply_with_retry(self, event: AstrMessageEvent, payload: dict) -> str:
+        """执行 _handle_apply；版本冲突时重新读取状态再做一次，冷却和状态机校验都基于最新状态。"""
+        try:
+            for _ in range(self.STATE_CONFLICT_RETRIES):
+                try:
+                    return self._handle_apply(event, payload)
+                except StateConflictError:
+                    self.metrics.increment("apply.state_conflicts")
+        except StateBackendError as e:
+            logger.error(f"写入共享状态失败: {e}")
+            return f"Update Failed：状态存储暂不可用，请稍后重试（{e}）"
+        return "Update Failed：状态正被其他节点同时更新，请稍后重试"
+
+    def _current_physical_state(self, event: AstrMessageEvent) -> Optional[str]:
+        try:
+            return self._state_for(event).get_whole_state(enable_update=False).get("physical_state", "Idle")
+        except StateBackendError:
+            # 只用于录制时标注状态转移；共享存储不可用时这次就不标注，真正的写入会报告错误。
+            return None
+
+    def _classify_apply_report(self, report: str, from_state: Optional[str] = None) -> Dict[str, Any]:
+        report = str(report)
+        outcome: Dict[str, Any] = {"status": "applied", "reason": ""}
+        if report.startswith("Update Failed"):
+            outcome["status"] = "rejected"
+            outcome["reason"] = next(
+                (code for marker, code in self.APPLY_REJECT_REASONS if marker in report),
+                "invalid_arguments",
+            )
+            wait_match = re.search(r"还需等待 ([\d.]+) 秒", report)
+            if wait_match:
+                outcome["cooldown_wait_sec"] = float(wait_match.group(1))
+        if from_state is not None:
+            outcome["from_state"] = from_state
+        return outcome
+
     @filter.on_llm_request()
     async def add_state(self, event: AstrMessageEvent, req: ProviderRequest) -> MessageEventResult:
+        with self.metrics.span("add_state.total", blocking=False), self.profiler.profile("add_state"):
+            return await self._inject_state(event, req)
+
+    async def _inject_state(self, event: AstrMessageEvent, req: ProviderRequest) -> MessageEventResult:
         uid = event.unified_msg_origin
         user_name = event.get_sender_name()
         # 保存原始提示，后面会把“全局状态事实”叠加到 system prompt，
@@ -1146,45 +4755,80 @@ class LivelyState(Star):
         #获取会话历史
         conv_mgr = self.context.conversation_manager
         try:
-            curr_cid = await conv_mgr.get_curr_conversation_id(uid)
-            conversation = await conv_mgr.get_conversation(uid, curr_cid)  # Conversation
+            with self.metrics.span("add_state.conversation_fetch", blocking=False):
+                curr_cid = await conv_mgr.get_curr_conversation_id(uid)
+                conversation = await conv_mgr.get_conversation(uid, curr_cid)  # Conversation
         except Exception as e:
+            self.metrics.increment("add_state.conversation_fetch_failures")
             logger.error(f"获取会话历史失败: {e}")
             return f"获取会话历史失败: {e}" 
+        self._remember_session_persona(uid, conversation)
         history = json.loads(conversation.history) if conversation and conversation.history else []
+        observer_add_started = time.perf_counter()
+        last_reply_text = None
         if len(history) >=2:
-            logger.info(f"上一个会话历史: {(history[-1])}")
+            self.hot_path_logger.log("previous_history_entry", lambda: history[-1])
             if history[-1]["role"] == "assistant":
                 last_reply = [msg.get("text", "")
                             for msg in history[-1].get("content", [])
                             if isinstance(msg, Dict) and msg.get("type") == "text"]
-                last_reply_text = f"[role:assistant,reply to user:name:{user_name}]: " + "\n".join(last_reply)
-                await self.global_observer.add_message(last_reply_text, event, self.context)
+                last_reply_text = "\n".join(last_reply)
+                await self.global_observer.add_message(
+                    last_reply_text, event, self.context, role=ObserverRole.ASSISTANT, sender_name=user_name
+                )
             elif history[-2]["role"] == "assistant":
                 last_reply = [msg.get("text", "")
                             for msg in history[-2].get("content", [])
                             if isinstance(msg, Dict) and msg.get("type") == "text"]
-                last_reply_text = f"[role:assistant,reply to user:name:{user_name}]: " + "\n".join(last_reply)
-                await self.global_observer.add_message(last_reply_text, event, self.context)
+                last_reply_text = "\n".join(last_reply)
+                await self.global_observer.add_message(
+                    last_reply_text, event, self.context, role=ObserverRole.ASSISTANT, sender_name=user_name
+                )
             else:
                 logger.warning("无法找到上一条助手回复，不更新状态观察器。")
 
         message_str = event.message_str
-        await self.global_observer.add_message(f"[role:user,name:{user_name}]: {message_str}", event, self.context)
-        # logger.info(f"Added message to observer: [role:user,uid:{uid}]: {message_str}")
-        self.global_observer.view_recent_messages()
-        state_info = self.global_state.get_whole_state()
-        global_state_prompt = self._build_global_state_system_prompt(uid, state_info)
-        req.system_prompt = "\n\n".join(
-            part for part in [(req.system_prompt or "").strip(), global_state_prompt.strip()] if part
+        self.traffic_recorder.record_add_state(
+            uid, user_name, message_str, last_reply_text, ori_prompt or "", req.system_prompt or ""
         )
+        await self.global_observer.add_message(message_str, event, self.context, role=ObserverRole.USER, sender_name=user_name)
+        self.metrics.observe("add_state.observer_add", (time.perf_counter() - observer_add_started) * 1000)
+        # logger.info(f"Added message to observer: [role:user,uid:{uid}]: {message_str}")
+        self.hot_path_logger.log("observer_recent_messages", lambda: self.global_observer.recent_messages)
+        try:
+            with self.metrics.span("add_state.state_get"):
+                state_info = self._state_for(event).get_whole_state()
+        except StateBackendError as e:
+            self.metrics.increment("add_state.state_get_failures")
+            logger.error(f"读取共享状态失败: {e}")
+            return f"读取共享状态失败: {e}"
+        with self.metrics.span("add_state.prompt_build"):
+            global_state_prompt, global_state_delta_prompt = self._build_state_injection_prompt(
+                uid,
+                state_info,
+                conversation_id=curr_cid,
+            )
+            req.system_prompt = "\n\n".join(
+                part
+                for part in [
+                    (req.system_prompt or "").strip(),
+                    global_state_prompt.strip(),
+                    global_state_delta_prompt.strip(),
+                ]
+                if part
+            )
 
-        prompt_sections = []
-        recent_context_prompt = self._build_recent_context_prompt(uid)
-        if recent_context_prompt:
-            prompt_sections.append(recent_context_prompt)
-        prompt_sections.append(ori_prompt)
-        req.prompt = "\n".join(prompt_sections)
+            prompt_sections = []
+            recent_context_prompt = self._build_recent_context_prompt(uid)
+            if recent_context_prompt:
+                prompt_sections.append(recent_context_prompt)
+            prompt_sections.append(ori_prompt)
+            req.prompt = "\n".join(prompt_sections)
+        self.token_budget.record_injection({
+            "global_state": TokenBudget.estimate_tokens(global_state_prompt),
+            "global_state_delta": TokenBudget.estimate_tokens(global_state_delta_prompt),
+            "recent_context": TokenBudget.estimate_tokens(recent_context_prompt),
+        })
         # logger.info(f"当前系统提示词——LivelyState: {req.system_prompt}")
 
     def _parse_tool_json_object_arg(self, raw_value: Any, field_name: str) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
@@ -1211,6 +4855,7 @@ class LivelyState(Star):
         try:
             parsed_value = json_repair.loads(json_text)
         except Exception as e:
+            self.metrics.increment("apply.parse_failures")
             return None, f"{field_name} 不是合法的 JSON 对象字符串: {e}"
 
         if not isinstance(parsed_value, dict):
@@ -1238,6 +4883,7 @@ class LivelyState(Star):
         try:
             parsed_value = json_repair.loads(json_text)
         except Exception as e:
+            self.metrics.increment("apply.parse_failures")
             return None, f"{field_name} 不是合法的 JSON 数组字符串: {e}"
 
         if not isinstance(parsed_value, list):
@@ -1253,7 +4899,9 @@ class LivelyState(Star):
             return "状态更新数据必须是对象"
 
         uid = event.unified_msg_origin
-        current_state = self.global_state.get_whole_state()
+        state_store = self._state_for(event)
+        with self.metrics.span("apply.state_read"):
+            current_state = state_store.get_whole_state()
 
         updatable_fields = [
             "emotion",
@@ -1272,32 +4920,6 @@ class LivelyState(Star):
         ]
         required_numeric_fields = ["energy_level", "thirst"]
 
-        invalid_text_fields = []
-        for field_name in ["emotion", "physical_state", "context_subject_id", "update_reason", "target_id"]:
-            value = payload.get(field_name)
-            if value is not None and not str(value).strip():
-                invalid_text_fields.append(field_name)
-
-        if invalid_text_fields:
-            return f"Update Failed：文本字段不能为空 {', '.join(invalid_text_fields)}"
-
-        invalid_numeric_fields = []
-        for field_name in required_numeric_fields:
-            value = payload.get(field_name)
-            if value is None:
-                continue
-            try:
-                numeric_value = int(value)
-            except (TypeError, ValueError):
-                invalid_numeric_fields.append(f"{field_name}(非整数)")
-                continue
-
-            if numeric_value < 0 or numeric_value > 100:
-                invalid_numeric_fields.append(f"{field_name}(超出0-100)")
-
-        if invalid_numeric_fields:
-            return f"Update Failed：数值字段非法 {', '.join(invalid_numeric_fields)}"
-
         def _clamp_int(value: Any, fallback: int, min_value: int = 0, max_value: int = 100) -> int:
             try:
                 if value is None:
@@ -1317,221 +4939,272 @@ class LivelyState(Star):
                 return fallback
             return str(value).strip()
 
-        raw_post_event_markers = payload.get("post_event_markers")
-        post_event_markers, post_event_markers_parse_error = self._parse_tool_json_list_arg(
-            raw_post_event_markers,
-            "post_event_markers",
-        )
-        if post_event_markers_parse_error:
-            return f"Update Failed：{post_event_markers_parse_error}"
+        with self.metrics.span("apply.parse_validate"):
+            invalid_text_fields = []
+            for field_name in ["emotion", "physical_state", "context_subject_id", "update_reason", "target_id"]:
+                value = payload.get(field_name)
+                if value is not None and not str(value).strip():
+                    invalid_text_fields.append(field_name)
 
-        raw_last_event = payload.get("last_event")
-        last_event_payload, last_event_parse_error = self._parse_tool_json_object_arg(
-            raw_last_event,
-            "last_event",
-        )
-        if last_event_parse_error:
-            return f"Update Failed：{last_event_parse_error}"
+            if invalid_text_fields:
+                return f"Update Failed：文本字段不能为空 {', '.join(invalid_text_fields)}"
 
-        raw_pending_tasks = payload.get("pending_tasks")
-        pending_tasks, pending_tasks_parse_error = self._parse_tool_json_list_arg(
-            raw_pending_tasks,
-            "pending_tasks",
-        )
-        if pending_tasks_parse_error:
-            return f"Update Failed：{pending_tasks_parse_error}"
+            invalid_numeric_fields = []
+            for field_name in required_numeric_fields:
+                value = payload.get(field_name)
+                if value is None:
+                    continue
+                try:
+                    numeric_value = int(value)
+                except (TypeError, ValueError):
+                    invalid_numeric_fields.append(f"{field_name}(非整数)")
+                    continue
 
-        raw_body_sheet_updates = payload.get("body_sheet_updates")
-        body_sheet_updates, body_sheet_parse_error = self._parse_tool_json_object_arg(
-            raw_body_sheet_updates,
-            "body_sheet_updates",
-        )
-        if body_sheet_parse_error:
-            return f"Update Failed：{body_sheet_parse_error}"
+                if numeric_value < 0 or numeric_value > 100:
+                    invalid_numeric_fields.append(f"{field_name}(超出0-100)")
 
-        normalized_body_sheet_updates = self.global_state.normalize_body_sheet(body_sheet_updates)
-        if isinstance(body_sheet_updates, dict) and body_sheet_updates and not normalized_body_sheet_updates:
-            return "Update Failed：body_sheet_updates 至少需要包含一个合法的部位与属性描述"
+            if invalid_numeric_fields:
+                return f"Update Failed：数值字段非法 {', '.join(invalid_numeric_fields)}"
 
-        raw_history_delta = payload.get("history_delta")
-        history_delta, history_delta_parse_error = self._parse_tool_json_object_arg(
-            raw_history_delta,
-            "history_delta",
-        )
-        if history_delta_parse_error:
-            return f"Update Failed：{history_delta_parse_error}"
-
-        normalized_history_delta = self.global_state.normalize_history(history_delta)
-        if isinstance(history_delta, dict) and history_delta and not normalized_history_delta:
-            return "Update Failed：history_delta 至少需要包含一个合法的非负整数增量"
-
-        current_history = self.global_state.normalize_history(current_state.get("History", {}))
-        unknown_history_keys = sorted(set(normalized_history_delta.keys()) - set(current_history.keys()))
-        if unknown_history_keys:
-            return (
-                "Update Failed：history_delta 包含未注册的计数字段 "
-                f"{', '.join(unknown_history_keys)}；请先在 state_profile_template.json 中定义它们"
+            raw_post_event_markers = payload.get("post_event_markers")
+            post_event_markers, post_event_markers_parse_error = self._parse_tool_json_list_arg(
+                raw_post_event_markers,
+                "post_event_markers",
             )
+            if post_event_markers_parse_error:
+                return f"Update Failed：{post_event_markers_parse_error}"
 
-        has_scalar_update = any(payload.get(field_name) is not None for field_name in [
-            "emotion", "energy_level", "thirst", "physical_state", "context_subject_id", "location", "update_reason", "target_id",
-            "post_event_markers", "last_event", "pending_tasks"
-        ])
-        if not has_scalar_update and not normalized_body_sheet_updates and not normalized_history_delta:
-            return "Update Failed：至少需要提供一个可更新字段"
-
-        normalized_physical_state = current_state.get("physical_state", "Idle")
-        requested_physical_state = payload.get("physical_state")
-        if requested_physical_state is not None:
-            normalized_physical_state, is_recognized = self.global_state.resolve_physical_state(
-                requested_physical_state,
-                fallback=current_state.get("physical_state", "Idle"),
+            raw_last_event = payload.get("last_event")
+            last_event_payload, last_event_parse_error = self._parse_tool_json_object_arg(
+                raw_last_event,
+                "last_event",
+            )
+            if last_event_parse_error:
+                return f"Update Failed：{last_event_parse_error}"
+
+            raw_pending_tasks = payload.get("pending_tasks")
+            pending_tasks, pending_tasks_parse_error = self._parse_tool_json_list_arg(
+                raw_pending_tasks,
+                "pending_tasks",
+            )
+            if pending_tasks_parse_error:
+                return f"Update Failed：{pending_tasks_parse_error}"
+
+            raw_body_sheet_updates = payload.get("body_sheet_updates")
+            body_sheet_updates, body_sheet_parse_error = self._parse_tool_json_object_arg(
+                raw_body_sheet_updates,
+                "body_sheet_updates",
+            )
+            if body_sheet_parse_error:
+                return f"Update Failed：{body_sheet_parse_error}"
+
+            normalized_body_sheet_updates = state_store.normalize_body_sheet(body_sheet_updates)
+            if isinstance(body_sheet_updates, dict) and body_sheet_updates and not normalized_body_sheet_updates:
+                return "Update Failed：body_sheet_updates 至少需要包含一个合法的部位与属性描述"
+
+            raw_history_delta = payload.get("history_delta")
+            history_delta, history_delta_parse_error = self._parse_tool_json_object_arg(
+                raw_history_delta,
+                "history_delta",
             )
-            if not is_recognized:
-                available_states = ", ".join(self.global_state.list_available_states())
-                return f"Update Failed：physical_state 非法，可用规范状态：{available_states}"
+            if history_delta_parse_error:
+                return f"Update Failed：{history_delta_parse_error}"
 
-            current_physical_state = self.global_state.normalize_physical_state(current_state.get("physical_state", "Idle"))
-            if not self.global_state.is_transition_allowed(current_physical_state, normalized_physical_state):
-                allowed_states = ", ".join(self.global_state.get_allowed_transitions(current_physical_state))
+            normalized_history_delta = state_store.normalize_history(history_delta)
+            if isinstance(history_delta, dict) and history_delta and not normalized_history_delta:
+                return "Update Failed：history_delta 至少需要包含一个合法的非负整数增量"
+
+            current_history = state_store.normalize_history(current_state.get("History", {}))
+            unknown_history_keys = sorted(set(normalized_history_delta.keys()) - set(current_history.keys()))
+            if unknown_history_keys:
                 return (
-                    f"Update Failed：不允许从 {current_physical_state} 直接切换到 {normalized_physical_state}，"
-                    f"当前允许转移到：{allowed_states}"
+                    "Update Failed：history_delta 包含未注册的计数字段 "
+                    f"{', '.join(unknown_history_keys)}；请先在 state_profile_template.json 中定义它们"
                 )
 
-        reason = _safe_text(payload.get("update_reason"), current_state.get("update_reason", "无理由说明。"))
-        current_target_id = self.global_state.normalize_subject_id(
-            current_state.get("target_id", "none"),
-            fallback="none",
-            allow_none_literal=True,
-        )
-        target_id = self.global_state.normalize_subject_id(
-            payload.get("target_id"),
-            fallback=current_target_id,
-            allow_none_literal=True,
-        )
-        current_energy_level = _clamp_int(current_state.get("energy_level"), 100)
-        current_thirst = _clamp_int(current_state.get("thirst"), 0)
-        next_emotion = _safe_text(payload.get("emotion"), current_state.get("emotion", "Normal"))
-        next_energy_level = _clamp_int(payload.get("energy_level"), current_energy_level)
-        next_thirst = _clamp_int(payload.get("thirst"), current_thirst)
-        current_context_subject_id = self.global_state.normalize_subject_id(
-            current_state.get("context_subject_id", "global"),
-            fallback="global",
-        )
-        current_location = str(current_state.get("location", "")).strip()
-        next_location = _safe_optional_text(payload.get("location"), current_location)
-        next_target_id = target_id
-        current_post_event_markers = self.global_state.normalize_text_list(current_state.get("post_event_markers", []))
-        next_post_event_markers = (
-            current_post_event_markers
-            if post_event_markers is None
-            else self.global_state.normalize_text_list(post_event_markers)
-        )
-        current_last_event = self.global_state.normalize_last_event(current_state.get("last_event", {}))
-        next_last_event = (
-            current_last_event
-            if last_event_payload is None
-            else self.global_state.normalize_last_event(last_event_payload)
-        )
-        current_pending_tasks = self.global_state.normalize_text_list(current_state.get("pending_tasks", []))
-        next_pending_tasks = (
-            current_pending_tasks
-            if pending_tasks is None
-            else self.global_state.normalize_text_list(pending_tasks)
-        )
-        next_context_subject_id = current_context_subject_id
-        requested_context_subject_id = payload.get("context_subject_id")
-        if requested_context_subject_id is not None:
-            next_context_subject_id = self.global_state.normalize_subject_id(
-                requested_context_subject_id,
-                fallback=current_context_subject_id,
+            has_scalar_update = any(payload.get(field_name) is not None for field_name in [
+                "emotion", "energy_level", "thirst", "physical_state", "context_subject_id", "location", "update_reason", "target_id",
+                "post_event_markers", "last_event", "pending_tasks"
+            ])
+            if not has_scalar_update and not normalized_body_sheet_updates and not normalized_history_delta:
+                return "Update Failed：至少需要提供一个可更新字段"
+
+            normalized_physical_state = current_state.get("physical_state", "Idle")
+            requested_physical_state = payload.get("physical_state")
+            if requested_physical_state is not None:
+                normalized_physical_state, is_recognized = state_store.resolve_physical_state(
+                    requested_physical_state,
+                    fallback=current_state.get("physical_state", "Idle"),
+                )
+                if not is_recognized:
+                    available_states = ", ".join(state_store.list_available_states())
+                    return f"Update Failed：physical_state 非法，可用规范状态：{available_states}"
+
+        with self.metrics.span("apply.merge_diff"):
+            reason = _safe_text(payload.get("update_reason"), current_state.get("update_reason", "无理由说明。"))
+            current_target_id = state_store.normalize_subject_id(
+                current_state.get("target_id", "none"),
+                fallback="none",
+                allow_none_literal=True,
+            )
+            target_id = state_store.normalize_subject_id(
+                payload.get("target_id"),
+                fallback=current_target_id,
+                allow_none_literal=True,
+            )
+            current_energy_level = _clamp_int(current_state.get("energy_level"), 100)
+            current_thirst = _clamp_int(current_state.get("thirst"), 0)
+            next_emotion = _safe_text(payload.get("emotion"), current_state.get("emotion", "Normal"))
+            next_energy_level = _clamp_int(payload.get("energy_level"), current_energy_level)
+            next_thirst = _clamp_int(payload.get("thirst"), current_thirst)
+            current_context_subject_id = state_store.normalize_subject_id(
+                current_state.get("context_subject_id", "global"),
+                fallback="global",
             )
-        elif any(payload.get(field_name) is not None for field_name in ["location", "post_event_markers", "pending_tasks"]):
-            inferred_context_subject_id = current_context_subject_id
+            current_location = str(current_state.get("location", "")).strip()
+            next_location = _safe_optional_text(payload.get("location"), current_location)
+            next_target_id = target_id
+            now = self.clock.now()
+            current_context_expiry = current_state.get("_context_expiry") or {}
+            next_context_expiry = dict(current_context_expiry)
+            current_post_event_markers = state_store.normalize_context_list(current_state.get("post_event_markers", []))
+            next_post_event_markers = current_post_event_markers
+            if post_event_markers is not None:
+                next_post_event_markers, next_context_expiry["post_event_markers"] = state_store.merge_context_list(
+                    "post_event_markers",
+                    post_event_markers,
+                    current_post_event_markers,
+                    current_context_expiry.get("post_event_markers") or {},
+                    now,
+                )
+            current_last_event = state_store.normalize_last_event(current_state.get("last_event", {}))
+            next_last_event = current_last_event
             if last_event_payload is not None:
-                inferred_context_subject_id = self.global_state.normalize_subject_id(
-                    next_last_event.get("subject_id"),
-                    fallback=inferred_context_subject_id,
+                if isinstance(last_event_payload, dict):
+                    last_event_payload = dict(last_event_payload)
+                last_event_ttl_sec = state_store.pop_last_event_ttl_sec(last_event_payload)
+                next_last_event = state_store.normalize_last_event(last_event_payload)
+                if last_event_ttl_sec is None:
+                    last_event_ttl_sec = state_store.context_ttl_sec["last_event"]
+                next_context_expiry["last_event"] = (
+                    now + last_event_ttl_sec if next_last_event and last_event_ttl_sec > 0 else None
                 )
-            elif payload.get("target_id") is not None:
-                inferred_context_subject_id = self.global_state.normalize_subject_id(
-                    target_id,
-                    fallback="global",
-                    allow_none_literal=True,
+            current_pending_tasks = state_store.normalize_context_list(current_state.get("pending_tasks", []))
+            next_pending_tasks = current_pending_tasks
+            if pending_tasks is not None:
+                next_pending_tasks, next_context_expiry["pending_tasks"] = state_store.merge_context_list(
+                    "pending_tasks",
+                    pending_tasks,
+                    current_pending_tasks,
+                    current_context_expiry.get("pending_tasks") or {},
+                    now,
                 )
-                if inferred_context_subject_id == "none":
-                    inferred_context_subject_id = "global"
-            next_context_subject_id = inferred_context_subject_id
-        current_body_sheet = self.global_state.normalize_body_sheet(current_state.get("Body_Sheet", {}))
-        merged_body_sheet = self.global_state.merge_body_sheet(current_body_sheet, normalized_body_sheet_updates)
-        merged_history = self.global_state.apply_history_delta(current_history, normalized_history_delta)
-
-        has_effective_fast_state_change = any([
-            next_emotion != current_state.get("emotion", "Normal"),
-            next_energy_level != current_energy_level,
-            next_thirst != current_thirst,
-            normalized_physical_state != current_state.get("physical_state", "Idle"),
-            next_context_subject_id != current_context_subject_id,
-            next_location != current_location,
-            next_target_id != current_target_id,
-            next_post_event_markers != current_post_event_markers,
-            next_last_event != current_last_event,
-            next_pending_tasks != current_pending_tasks,
-        ])
-        has_effective_body_sheet_change = merged_body_sheet != current_body_sheet
-        has_effective_history_change = merged_history != current_history
+            next_context_expiry = {key: value for key, value in next_context_expiry.items() if value}
+            next_context_subject_id = current_context_subject_id
+            requested_context_subject_id = payload.get("context_subject_id")
+            if requested_context_subject_id is not None:
+                next_context_subject_id = state_store.normalize_subject_id(
+                    requested_context_subject_id,
+                    fallback=current_context_subject_id,
+                )
+            elif any(payload.get(field_name) is not None for field_name in ["location", "post_event_markers", "pending_tasks"]):
+                inferred_context_subject_id = current_context_subject_id
+                if last_event_payload is not None:
+                    inferred_context_subject_id = state_store.normalize_subject_id(
+                        next_last_event.get("subject_id"),
+                        fallback=inferred_context_subject_id,
+                    )
+                elif payload.get("target_id") is not None:
+                    inferred_context_subject_id = state_store.normalize_subject_id(
+                        target_id,
+                        fallback="global",
+                        allow_none_literal=True,
+                    )
+                    if inferred_context_subject_id == "none":
+                        inferred_context_subject_id = "global"
+                next_context_subject_id = inferred_context_subject_id
+            current_body_sheet = state_store.normalize_body_sheet(current_state.get("Body_Sheet", {}))
+            merged_body_sheet = state_store.merge_body_sheet(current_body_sheet, normalized_body_sheet_updates)
+            merged_history = state_store.apply_history_delta(current_history, normalized_history_delta)
+
+            has_effective_fast_state_change = any([
+                next_emotion != current_state.get("emotion", "Normal"),
+                next_energy_level != current_energy_level,
+                next_thirst != current_thirst,
+                normalized_physical_state != current_state.get("physical_state", "Idle"),
+                next_context_subject_id != current_context_subject_id,
+                next_location != current_location,
+                next_target_id != current_target_id,
+                next_post_event_markers != current_post_event_markers,
+                next_last_event != current_last_event,
+                next_pending_tasks != current_pending_tasks,
+                next_context_expiry != current_context_expiry,
+            ])
+            has_effective_body_sheet_change = merged_body_sheet != current_body_sheet
+            has_effective_history_change = merged_history != current_history
+
+            if not has_effective_fast_state_change and not has_effective_body_sheet_change and not has_effective_history_change:
+                return "Update Failed：未检测到实际状态变化"
+
+        with self.metrics.span("apply.checks"):
+            if requested_physical_state is not None:
+                current_physical_state = state_store.normalize_physical_state(current_state.get("physical_state", "Idle"))
+                if not state_store.is_transition_allowed(current_physical_state, normalized_physical_state):
+                    allowed_states = ", ".join(state_store.get_allowed_transitions(current_physical_state))
+                    return (
+                        f"Update Failed：不允许从 {current_physical_state} 直接切换到 {normalized_physical_state}，"
+                        f"当前允许转移到：{allowed_states}"
+                    )
 
-        if not has_effective_fast_state_change and not has_effective_body_sheet_change and not has_effective_history_change:
-            return "Update Failed：未检测到实际状态变化"
+            if has_effective_fast_state_change and self.fast_state_cooldown_sec > 0:
+                elapsed_fast_update = max(0.0, now - float(current_state.get("_last_fast_state_update_time", 0.0)))
+                if elapsed_fast_update < self.fast_state_cooldown_sec:
+                    self.metrics.increment("apply.cooldown_rejects")
+                    return (
+                        "Update Failed：快状态更新冷却中，"
+                        f"还需等待 {self.fast_state_cooldown_sec - elapsed_fast_update:.1f} 秒"
+                    )
 
-        now = time.time()
-        if has_effective_fast_state_change and self.fast_state_cooldown_sec > 0:
-            elapsed_fast_update = max(0.0, now - float(current_state.get("_last_fast_state_update_time", 0.0)))
-            if elapsed_fast_update < self.fast_state_cooldown_sec:
-                return (
-                    "Update Failed：快状态更新冷却中，"
-                    f"还需等待 {self.fast_state_cooldown_sec - elapsed_fast_update:.1f} 秒"
-                )
+            if has_effective_body_sheet_change and self.body_sheet_cooldown_sec > 0:
+                elapsed_body_sheet_update = max(0.0, now - float(current_state.get("_last_body_sheet_update_time", 0.0)))
+                if elapsed_body_sheet_update < self.body_sheet_cooldown_sec:
+                    self.metrics.increment("apply.cooldown_rejects")
+                    return (
+                        "Update Failed：Body_Sheet 更新冷却中，"
+                        f"还需等待 {self.body_sheet_cooldown_sec - elapsed_body_sheet_update:.1f} 秒"
+                    )
 
-        if has_effective_body_sheet_change and self.body_sheet_cooldown_sec > 0:
-            elapsed_body_sheet_update = max(0.0, now - float(current_state.get("_last_body_sheet_update_time", 0.0)))
-            if elapsed_body_sheet_update < self.body_sheet_cooldown_sec:
-                return (
-                    "Update Failed：Body_Sheet 更新冷却中，"
-                    f"还需等待 {self.body_sheet_cooldown_sec - elapsed_body_sheet_update:.1f} 秒"
-                )
-        
-        last_update_time = now if has_effective_fast_state_change else current_state.get("LastUpdateTime", now)
-        new_state_data = {
-            # 慢变化字段不应该顺手把身体状态的时间轴重置掉；
-            # 只有快状态真的发生变化时才刷新 LastUpdateTime。
-            "LastUpdateTime": last_update_time,
-            "updated_at": self.global_state.format_timestamp(last_update_time),
-            "emotion": next_emotion,
-            "energy_level": next_energy_level,
-            "thirst": next_thirst,
-            "physical_state": normalized_physical_state,
-            "context_subject_id": next_context_subject_id,
-            "location": next_location,
-            "post_event_markers": next_post_event_markers,
-            "last_event": next_last_event,
-            "pending_tasks": next_pending_tasks,
-            "update_reason": reason,
-            "target_id": next_target_id,
-            "Body_Sheet": merged_body_sheet,
-            "History": merged_history,
-            "_last_fast_state_update_time": now if has_effective_fast_state_change else float(current_state.get("_last_fast_state_update_time", 0.0)),
-            "_last_body_sheet_update_time": now if has_effective_body_sheet_change else float(current_state.get("_last_body_sheet_update_time", 0.0)),
-        }
-            # Ensure required fields exist and are normalized
-            
+        with self.metrics.span("apply.persist"):
+            last_update_time = now if has_effective_fast_state_change else current_state.get("LastUpdateTime", now)
+            new_state_data = {
+                # 慢变化字段不应该顺手把身体状态的时间轴重置掉；
+                # 只有快状态真的发生变化时才刷新 LastUpdateTime。
+                "LastUpdateTime": last_update_time,
+                "updated_at": state_store.format_timestamp(last_update_time),
+                "emotion": next_emotion,
+                "energy_level": next_energy_level,
+                "thirst": next_thirst,
+                "physical_state": normalized_physical_state,
+                "context_subject_id": next_context_subject_id,
+                "location": next_location,
+                "post_event_markers": next_post_event_markers,
+                "last_event": next_last_event,
+                "pending_tasks": next_pending_tasks,
+                "update_reason": reason,
+                "target_id": next_target_id,
+                "Body_Sheet": merged_body_sheet,
+                "History": merged_history,
+                "_last_fast_state_update_time": now if has_effective_fast_state_change else float(current_state.get("_last_fast_state_update_time", 0.0)),
+                "_last_body_sheet_update_time": now if has_effective_body_sheet_change else float(current_state.get("_last_body_sheet_update_time", 0.0)),
+                # 显式给出 physical_state（包括确认仍在继续同一个状态）时重新开始计算自动回退的超时。
+                "_physical_state_since": now if requested_physical_state is not None else float(current_state.get("_physical_state_since", last_update_time)),
+                "_context_expiry": next_context_expiry,
+            }
             # Persist state
-        self.global_state.save(new_state_data)
-        logger.info(f"查看新数据：{new_state_data}")
-        report = f"状态已更新，原因：{reason}，状态：{self._to_public_state(self.global_state.get_whole_state(enable_update=False))}"
-        
-        return report
+            state_store.save(new_state_data)
+            self.hot_path_logger.log("new_state_data", lambda: self._to_public_state(new_state_data))
+            report = f"状态已更新，原因：{reason}，状态：{self._to_public_state(state_store.get_whole_state(enable_update=False))}"
+            return report
 
     def _extract_json_block(self, text: str) -> Optional[str]:
         stripped = text.strip()
@@ -1549,4 +5222,26 @@ class LivelyState(Star):
         return None
 
     async def terminate(self):
-        """可选择实现异步的插件销毁方法，当插件被卸载/停用时会调用。"""
\ No newline at end of file
+        """可选择实现异步的插件销毁方法，当插件被卸载/停用时会调用。"""
+        if self._observer_flush_task:
+            self._observer_flush_task.cancel()
+            self._observer_flush_task = None
+        if self._metrics_export_task:
+            self._metrics_export_task.cancel()
+            self._metrics_export_task = None
+            self.metrics.write_prometheus_file(self.metrics_prometheus_path)
+        if self._state_flush_task:
+            self._state_flush_task.cancel()
+            self._state_flush_task = None
+        if self._context_expiry_task:
+            self._context_expiry_task.cancel()
+            self._context_expiry_task = None
+        # 写回分片并关闭全局、角色和分片各自的时间线。
+        self.default_persona.close()
+        if self.character_registry:
+            self.character_registry.close_all()
+        if self.state_backend:
+            self.state_backend.stop()
+        if self.loop_watchdog:
+            self.loop_watchdog.stop()
+        self.global_observer.cancel_background_summarization()
\ No newline at end of file